@@ -4,8 +4,10 @@ import logging
 from psychopy import core, visual, event, gui, data
 
 import config
+import data_management as dm
 import hardware_setup as hw
 import triggering
+import frame_timing
 
 # --- Baseline Trigger Codes (hex) ---
 TRIG_RESET = b"\x00"             # all lines low
@@ -41,18 +43,31 @@ csv_path = os.path.join(
 # -----------------------------------------------------------------
 # 2. Initialize Hardware
 # -----------------------------------------------------------------
-trigger_port = hw.initialize_trigger_port(exp_info["com_trigger"])
-rcs = hw.initialize_eeg_rcs(
-    host_ip=exp_info["eeg_ip"],
-    workspace_path=exp_info["eeg_workspace"],
-    participant=f"{exp_info['participant']}_{exp_info['date']}",
-    exp_name="BaselineEEG"
+# Reuse the devices held open by the session's hardware broker when it runs
+broker = hw.connect_broker(
+    participant=f"{exp_info['participant']}_{exp_info['date']}", exp_name="BaselineEEG"
 )
+if broker is not None:
+    trigger_port, rcs = broker.trigger_port, broker.rcs
+else:
+    trigger_port = hw.initialize_trigger_port(exp_info["com_trigger"])
+    rcs = hw.initialize_eeg_rcs(
+        host_ip=exp_info["eeg_ip"],
+        workspace_path=exp_info["eeg_workspace"],
+        participant=f"{exp_info['participant']}_{exp_info['date']}",
+        exp_name="BaselineEEG"
+    )
 
 if trigger_port is None:
     logger.error("Trigger port failed to open. Exiting.")
     core.quit()
 
+# --- Trigger Bus & Scheduler ---
+# The bus owns the trigger port and logs every write; the scheduler writes
+# pulses from a background thread so the caller never waits for them to end.
+trigger_bus = triggering.TriggerBus(trigger_port)
+trigger_scheduler = triggering.TriggerScheduler(trigger_bus)
+
 # -----------------------------------------------------------------
 # 3. Setup PsychoPy Window
 # -----------------------------------------------------------------
@@ -66,6 +81,12 @@ win = visual.Window(
     units="height",
 )
 win.mouseVisible = False
+# Flip-locked triggers go through the monitor, which times them against the flips
+flip_monitor = triggering.FlipTriggerMonitor(trigger_bus)
+flip_monitor.attach(win)
+# Every flip is timed and tagged with the routine and trial it belongs to
+frame_profiler = frame_timing.FrameProfiler()
+frame_profiler.attach(win)
 fixation_cross = visual.TextStim(win, text="+", height=0.1, color="white")
 
 # -----------------------------------------------------------------
@@ -78,7 +99,9 @@ if rcs:
         logger.info("Commanding EEG to start recording...")
         rcs.startRecording()
         eeg_rec_command_time = core.monotonicClock.getTime()
-        triggering.send_event_pulse(trigger_port, TRIG_EEG_REC_START, TRIG_RESET)
+        triggering.send_event_pulse(
+            trigger_bus, TRIG_EEG_REC_START, TRIG_RESET, scheduler=trigger_scheduler
+        )
         rcs_start_status = "success"
     except Exception as e:
         logger.error("EEG start recording error: %s", e)
@@ -94,11 +117,12 @@ baseline_timer = core.CountdownTimer(300.0)  # 5 minutes
 
 def mark_baseline_start():
     baseline_start_time["t"] = core.monotonicClock.getTime()
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(TRIG_BASELINE_START)
-    else:
-        print(f"SKIPPED trigger {TRIG_BASELINE_START.hex()} (port not available/open).")
+    flip_monitor.send(TRIG_BASELINE_START)
 
+# The EEG start pulse's reset is still queued for TRIGGER_PULSE_SECS; it must go
+# out before the baseline level, or it would clear it for the whole period
+trigger_scheduler.flush()
+frame_profiler.begin("baseline")
 win.callOnFlip(mark_baseline_start)
 while baseline_timer.getTime() > 0:
     fixation_cross.draw()
@@ -106,10 +130,7 @@ while baseline_timer.getTime() > 0:
     if event.getKeys(keyList=["escape"]):
         break
 baseline_end_time = core.monotonicClock.getTime()
-if trigger_port and trigger_port.is_open:
-    trigger_port.write(TRIG_RESET)
-else:
-    print(f"SKIPPED reset after baseline (port not available/open).")
+trigger_bus.send(TRIG_RESET)
 
 # -----------------------------------------------------------------
 # 6. Stop EEG and Clean Up
@@ -122,9 +143,18 @@ if rcs:
     except Exception as e:
         logger.error("EEG stop/close error: %s", e)
 
-if trigger_port and trigger_port.is_open:
-    trigger_port.write(TRIG_RESET)
-    trigger_port.close()
+trigger_scheduler.close()
+trigger_bus.close()
+dm.save_trigger_log(exp_info, "BaselineEEG", trigger_bus.write_log(), _thisDir)
+dm.save_trigger_jitter(
+    exp_info, "BaselineEEG", flip_monitor.records(), flip_monitor.stats(), _thisDir
+)
+dm.save_frame_timing(
+    exp_info, "BaselineEEG", frame_profiler.records(), frame_profiler.summary(), _thisDir
+)
+
+if broker is not None:
+    broker.release()  # Devices stay open for the experiment runs
 
 # --- Save Baseline Session Summary ---
 log_data = {
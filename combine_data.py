@@ -3,6 +3,10 @@ import glob
 import pandas as pd
 import argparse
 
+import numpy as np
+
+import data_management as dm
+
 
 def combine_trial_summaries(participant_id: str, runs: int = 5, data_dir: str = "data") -> str:
     """Combine per-run TrialSummary CSVs into a single file.
@@ -51,6 +55,68 @@ def combine_trial_summaries(participant_id: str, runs: int = 5, data_dir: str =
     return out_path
 
 
+def combine_temperature_traces(participant_id: str, runs: int = 5, data_dir: str = "data") -> str:
+    """Combine the per-run temperature traces of the BACKUP archives.
+
+    Traces stay encoded (see ``data_management.encode_temperature_trace``) and
+    trials are renumbered as in :func:`combine_trial_summaries`.
+
+    Returns
+    -------
+    str
+        Path to the ``_ALL_TemperatureTraces.npz`` written to disk, holding
+        ``trial_number``, ``temperature_trace_codec`` and ``temperature_trace_offsets``.
+    """
+    participant_dir = os.path.join(data_dir, participant_id)
+    if not os.path.isdir(participant_dir):
+        raise FileNotFoundError(f"Participant directory not found: {participant_dir}")
+
+    codecs, offsets = [], [np.zeros(1, dtype=np.int64)]
+    for run in range(1, runs + 1):
+        pattern = os.path.join(
+            participant_dir,
+            f"{participant_id}_ThermalPainEEGFMRI_run{run}_*_BACKUP.npz",
+        )
+        matches = glob.glob(pattern)
+        if not matches:
+            raise FileNotFoundError(f"No BACKUP archive found for run {run}: {pattern}")
+        with np.load(matches[0]) as backup:
+            if "temperature_trace_codec" not in backup.files:
+                raise ValueError(f"{matches[0]} has no encoded temperature traces")
+            codec = backup["temperature_trace_codec"]
+            run_offsets = backup["temperature_trace_offsets"]
+        # Shift this run's byte offsets behind the previous runs
+        offsets.append(run_offsets[1:] + offsets[-1][-1])
+        codecs.append(codec)
+
+    offsets = np.concatenate(offsets)
+    out_path = os.path.join(
+        participant_dir,
+        f"{participant_id}_ThermalPainEEGFMRI_ALL_TemperatureTraces.npz",
+    )
+    np.savez(
+        out_path,
+        trial_number=np.arange(1, len(offsets)),
+        temperature_trace_codec=np.concatenate(codecs),
+        temperature_trace_offsets=offsets,
+    )
+    return out_path
+
+
+def load_temperature_traces(path: str):
+    """Decode every trial of an ``_ALL_TemperatureTraces.npz`` file.
+
+    Returns
+    -------
+    list[tuple]
+        ``(times, temps)`` arrays per trial, see ``data_management.decode_temperature_trace``.
+    """
+    with np.load(path) as traces:
+        codec = traces["temperature_trace_codec"].tobytes()
+        offsets = traces["temperature_trace_offsets"]
+    return [dm.decode_temperature_trace(codec[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Combine per-run TrialSummary CSV files.")
     parser.add_argument("participant_id", help="Participant ID (folder name inside data)")
@@ -65,6 +131,14 @@ if __name__ == "__main__":
         default=5,
         help="Number of runs to combine (default: 5)",
     )
+    parser.add_argument(
+        "--traces",
+        action="store_true",
+        help="Also combine the encoded temperature traces of the BACKUP archives",
+    )
     args = parser.parse_args()
     out_csv = combine_trial_summaries(args.participant_id, args.runs, args.data_dir)
     print(f"Combined trial summary saved to {out_csv}")
+    if args.traces:
+        out_npz = combine_temperature_traces(args.participant_id, args.runs, args.data_dir)
+        print(f"Combined temperature traces saved to {out_npz}")
@@ -1,8 +1,15 @@
 
 import os
+import struct
+import zlib
 import pandas as pd
 import numpy as np
 
+# Temperature trace codec header: magic, n_zones, samples per degree, n_samples, first time stamp
+_TRACE_CODEC = struct.Struct('<4sHHId')
+_TRACE_CODEC_MAGIC = b'TTD1'
+_TRACE_MISSING = -32768 # int16 code of NaN samples
+
 def create_data_collector():
     """Return a fresh data dictionary for trial information.
 
@@ -41,12 +48,19 @@ def create_data_collector():
         Timestamp for the start of the VAS rating routine.
     vas_end_time : list[float]
         Timestamp for the end of the VAS rating routine.
-    temperature_traces : list[list[list[float]]]
-        Temperature samples for each trial as lists of lists
-        ``[[neutral, z1, z2, z3, z4, z5], ...]``.
-    temperature_times : list[list[float]]
+    temperature_traces : list[array_like]
+        Temperature samples for each trial, shape ``(n, 6)`` with columns
+        ``[neutral, z1, z2, z3, z4, z5]``.
+    temperature_times : list[array_like]
         Time stamps for each temperature sample in seconds from
         stimulation onset.
+    temperature_sample_range : list[list[int]]
+        ``[start, end)`` sample indices of each trial in the run's
+        temperature trace file, when traces are recorded to disk instead of
+        kept in memory (see :func:`fill_temperature_traces`).
+    ramp_metrics : list[dict]
+        Ramp fidelity of each stimulation (time to target, overshoot, plateau
+        mean/SD, return time, ...) from ``pytcsii.ramp_fidelity_tracker``.
     """
     return {
         'trial_number': [],
@@ -65,9 +79,129 @@ def create_data_collector():
         'vas_start_time': [],
         'vas_end_time': [],
         'temperature_traces': [],
-        'temperature_times': []
+        'temperature_times': [],
+        'temperature_sample_range': [],
+        'ramp_metrics': []
     }
 
+def _output_paths(exp_info, exp_name, this_dir):
+    """Return ``(participant_dir, base_filename)`` for a run, creating the directory."""
+    participant_id = str(exp_info.get('participant', 'UNKNOWN'))
+    date_str = str(exp_info.get('date', 'NODATE'))
+
+    participant_dir = os.path.join(this_dir, 'data', participant_id)
+    os.makedirs(participant_dir, exist_ok=True)
+
+    return participant_dir, f"{participant_id}_{exp_name}_{date_str}"
+
+def fill_temperature_traces(data, times, temps):
+    """Fill the per-trial temperature traces from a recorded trace file.
+
+    Parameters
+    ----------
+    data : dict
+        Collector whose ``temperature_sample_range`` and ``stim_start_time``
+        hold each trial's sample range and onset.
+    times, temps : numpy.ndarray
+        Whole-run samples as returned by ``pytcsii.load_temp_trace``.
+
+    ``temperature_traces`` and ``temperature_times`` (relative to each trial's
+    stimulation onset) are replaced by one array per trial.
+    """
+    data['temperature_traces'] = []
+    data['temperature_times'] = []
+    for (start, end), onset in zip(data['temperature_sample_range'], data['stim_start_time']):
+        data['temperature_traces'].append(temps[start:end])
+        data['temperature_times'].append(times[start:end] - onset)
+
+def encode_temperature_trace(times, temps, scale=10):
+    """Pack one temperature trace into a compact byte string.
+
+    Temperatures are stored as int16 in ``1 / scale`` degrees (the thermode's
+    resolution) and time stamps as int32 microseconds. Both are delta encoded
+    along time, zone by zone, and the result is zlib compressed, so slowly
+    changing traces shrink to a few bytes per sample.
+
+    Parameters
+    ----------
+    times : array_like, shape (n,)
+        Sample time stamps in seconds.
+    temps : array_like, shape (n, n_zones)
+        Temperatures in degrees Celsius; NaN samples are kept.
+    scale : int, optional
+        Codes per degree, by default 10 (use 100 for high resolution traces).
+
+    Returns
+    -------
+    bytes
+        Decoded by :func:`decode_temperature_trace`.
+    """
+    times = np.asarray(times, dtype=np.float64).reshape(-1)
+    temps = np.asarray(temps, dtype=np.float64)
+    if temps.ndim == 1: # Single zone, or an empty trial
+        temps = temps[:, None]
+    t0 = float(times[0]) if times.size else 0.0
+    ticks = np.rint((times - t0) * 1e6).astype(np.int64)
+    codes = np.rint(temps * scale)
+    codes[np.isnan(codes)] = _TRACE_MISSING
+    codes = codes.astype(np.int16)
+    # Deltas wrap around in int16 and the cumulative sum wraps back, so decoding is exact
+    dticks = np.diff(ticks, prepend=0).astype('<i4')
+    dcodes = np.diff(codes, axis=0, prepend=np.zeros((1, codes.shape[1]), np.int16)).astype('<i2')
+    payload = dticks.tobytes() + np.ascontiguousarray(dcodes.T).tobytes()
+    header = _TRACE_CODEC.pack(_TRACE_CODEC_MAGIC, codes.shape[1], scale, times.size, t0)
+    return header + zlib.compress(payload, 6)
+
+def decode_temperature_trace(blob):
+    """Unpack a trace written by :func:`encode_temperature_trace`.
+
+    Returns
+    -------
+    tuple
+        ``(times, temps)`` arrays of shape ``(n,)`` (float64) and
+        ``(n, n_zones)`` (float32).
+    """
+    magic, n_zones, scale, n, t0 = _TRACE_CODEC.unpack_from(blob)
+    if magic != _TRACE_CODEC_MAGIC:
+        raise ValueError('not an encoded temperature trace')
+    payload = zlib.decompress(memoryview(blob)[_TRACE_CODEC.size:])
+    dticks = np.frombuffer(payload, dtype='<i4', count=n)
+    dcodes = np.frombuffer(payload, dtype='<i2', count=n * n_zones, offset=4 * n).reshape(n_zones, n)
+    times = t0 + np.cumsum(dticks, dtype=np.int64) / 1e6
+    codes = np.cumsum(dcodes, axis=1, dtype=np.int16).T
+    temps = codes.astype(np.float32) / np.float32(scale)
+    temps[codes == _TRACE_MISSING] = np.nan
+    return times, temps
+
+def _encode_trials(times_list, temps_list):
+    """Concatenated codec blobs of all trials and their ``[start, end)`` byte offsets."""
+    blobs = [encode_temperature_trace(times, temps) for times, temps in zip(times_list, temps_list)]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+    return np.frombuffer(b''.join(blobs), dtype=np.uint8), offsets
+
+def load_backup(path):
+    """Read a ``_BACKUP.npz`` written by :func:`save_all_data`.
+
+    Returns
+    -------
+    dict
+        The collector, with ``temperature_traces`` and ``temperature_times``
+        decoded to one array per trial.
+    """
+    data = {}
+    with np.load(path, allow_pickle=True) as backup:
+        for key in backup.files:
+            if key not in ('temperature_trace_codec', 'temperature_trace_offsets'):
+                data[key] = backup[key].tolist()
+        if 'temperature_trace_codec' in backup.files:
+            codec = backup['temperature_trace_codec'].tobytes()
+            offsets = backup['temperature_trace_offsets']
+            traces = [decode_temperature_trace(codec[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+            data['temperature_times'] = [times for times, _ in traces]
+            data['temperature_traces'] = [temps for _, temps in traces]
+    return data
+
 def save_all_data(exp_info, exp_name, data, this_dir):
     """Write experiment data to disk in multiple convenient formats.
 
@@ -87,21 +221,17 @@ def save_all_data(exp_info, exp_name, data, this_dir):
     Three files are produced inside ``data/<participant_id>``:
 
     ``<id>_<exp>_<date>_TrialSummary.csv``
-        One row per trial with key outcome measures.
+        One row per trial with key outcome measures (and the ``ramp_*``
+        metrics when recorded).
     ``<id>_<exp>_<date>_VASTraces_Long.csv``
         Long-format file of sampled VAS ratings for every trial.
     ``<id>_<exp>_<date>_BACKUP.npz``
         Numpy compressed archive of the raw collector dictionary for any custom
-        post-processing.
+        post-processing. Temperature traces are stored with
+        :func:`encode_temperature_trace`; read it back with :func:`load_backup`.
     """
     participant_id = str(exp_info.get('participant', 'UNKNOWN'))
-    date_str = str(exp_info.get('date', 'NODATE'))
-    
-    # Create output directory
-    participant_dir = os.path.join(this_dir, 'data', participant_id)
-    os.makedirs(participant_dir, exist_ok=True)
-    
-    base_filename = f"{participant_id}_{exp_name}_{date_str}"
+    participant_dir, base_filename = _output_paths(exp_info, exp_name, this_dir)
 
     # --- Save Trial Summary CSV ---
     try:
@@ -120,6 +250,8 @@ def save_all_data(exp_info, exp_name, data, this_dir):
             'vas_start_time': data['vas_start_time'],
             'vas_end_time': data['vas_end_time']
         })
+        if len(data.get('ramp_metrics', [])) == len(summary_df):
+            summary_df = summary_df.join(pd.DataFrame(data['ramp_metrics']).add_prefix('ramp_'))
         summary_filename = os.path.join(participant_dir, f"{base_filename}_TrialSummary.csv")
         summary_df.to_csv(summary_filename, index=False, na_rep='NA')
         print(f"Trial summary saved to {summary_filename}")
@@ -151,8 +283,122 @@ def save_all_data(exp_info, exp_name, data, this_dir):
     # --- Save Raw Lists Backup ---
     try:
         backup_filename = os.path.join(participant_dir, f"{base_filename}_BACKUP.npz")
+        traces = ('temperature_traces', 'temperature_times')
+        codec, offsets = _encode_trials(data['temperature_times'], data['temperature_traces'])
         # Use dtype=object for lists of lists/uneven arrays
-        np.savez_compressed(backup_filename, **{k: np.array(v, dtype=object) for k, v in data.items()})
+        arrays = {k: np.array(v, dtype=object) for k, v in data.items() if k not in traces}
+        np.savez_compressed(backup_filename, temperature_trace_codec=codec,
+                            temperature_trace_offsets=offsets, **arrays)
         print(f"Raw data backup saved to {backup_filename}")
     except Exception as e:
         print(f"ERROR saving raw backup: {e}")
+
+def save_latency_report(exp_info, exp_name, report, this_dir):
+    """Write the thermode command latency report next to the run's data files.
+
+    Parameters
+    ----------
+    exp_info, exp_name, this_dir
+        Same as for :func:`save_all_data`.
+    report : list[dict]
+        Rows returned by ``pytcsii.latency_recorder.report`` (one per command
+        type with count and latency percentiles in ms).
+
+    The report is saved as ``<id>_<exp>_<date>_ThermodeLatency.csv``.
+    """
+    try:
+        participant_dir, base_filename = _output_paths(exp_info, exp_name, this_dir)
+        latency_filename = os.path.join(participant_dir, f"{base_filename}_ThermodeLatency.csv")
+        pd.DataFrame(report).to_csv(latency_filename, index=False, float_format='%.4f', na_rep='NA')
+        print(f"Thermode latency report saved to {latency_filename}")
+    except Exception as e:
+        print(f"ERROR saving thermode latency report: {e}")
+
+def save_trigger_log(exp_info, exp_name, log, this_dir):
+    """Write every trigger write of the run next to the run's data files.
+
+    Parameters
+    ----------
+    exp_info, exp_name, this_dir
+        Same as for :func:`save_all_data`.
+    log : numpy.ndarray
+        Structured array returned by ``triggering.TriggerBus.write_log`` with
+        ``code``, ``intended``, ``actual``, ``duration`` and ``ok`` fields.
+
+    The log is saved as ``<id>_<exp>_<date>_TriggerLog.csv`` with times in
+    seconds (monotonic clock) and the write duration in ms.
+    """
+    try:
+        participant_dir, base_filename = _output_paths(exp_info, exp_name, this_dir)
+        trigger_filename = os.path.join(participant_dir, f"{base_filename}_TriggerLog.csv")
+        df = pd.DataFrame({
+            'code': [f"{code:02x}" for code in log['code']],
+            'intended_time': log['intended'],
+            'actual_time': log['actual'],
+            'write_duration_ms': log['duration'] * 1000,
+            'ok': log['ok'].astype(int),
+        })
+        df.to_csv(trigger_filename, index=False, float_format='%.6f')
+        print(f"Trigger log saved to {trigger_filename}")
+    except Exception as e:
+        print(f"ERROR saving trigger log: {e}")
+
+def save_trigger_jitter(exp_info, exp_name, records, stats, this_dir):
+    """Write the flip-to-trigger timing of the run's flip-locked triggers.
+
+    Parameters
+    ----------
+    exp_info, exp_name, this_dir
+        Same as for :func:`save_all_data`.
+    records : dict
+        Raw arrays from ``triggering.FlipTriggerMonitor.records``.
+    stats : dict
+        Summary from ``triggering.FlipTriggerMonitor.stats``.
+
+    Two files are produced: ``<id>_<exp>_<date>_TriggerJitter.csv`` with one
+    row per trigger (``delay_ms`` from the flip to the write's return) and
+    ``<id>_<exp>_<date>_TriggerJitterStats.csv`` with the run statistics.
+    """
+    try:
+        participant_dir, base_filename = _output_paths(exp_info, exp_name, this_dir)
+        df = pd.DataFrame(records)
+        df['code'] = [f"{code:02x}" for code in records['code']]
+        df['delay_ms'] = (df['write_done'] - df['flip_time']) * 1000
+        df['ok'] = df['ok'].astype(int)
+        raw_filename = os.path.join(participant_dir, f"{base_filename}_TriggerJitter.csv")
+        df.to_csv(raw_filename, index=False, float_format='%.6f', na_rep='NA')
+        stats_filename = os.path.join(participant_dir, f"{base_filename}_TriggerJitterStats.csv")
+        pd.DataFrame([stats]).to_csv(stats_filename, index=False, float_format='%.4f')
+        print(f"Trigger jitter saved to {raw_filename}")
+    except Exception as e:
+        print(f"ERROR saving trigger jitter: {e}")
+
+def save_frame_timing(exp_info, exp_name, records, summary, this_dir):
+    """Write the frame intervals of every routine.
+
+    Parameters
+    ----------
+    exp_info, exp_name, this_dir
+        Same as for :func:`save_all_data`.
+    records : dict
+        Per-frame arrays from ``frame_timing.FrameProfiler.records``.
+    summary : list of dict
+        Per-routine rows from ``frame_timing.FrameProfiler.summary``.
+
+    Two files are produced: ``<id>_<exp>_<date>_FrameTiming.csv`` with one row
+    per flip (routine, trial, flip time, interval, onset and dropped flags) and
+    ``<id>_<exp>_<date>_FrameTimingSummary.csv`` with the dropped-frame counts
+    and interval percentiles of each routine.
+    """
+    try:
+        participant_dir, base_filename = _output_paths(exp_info, exp_name, this_dir)
+        df = pd.DataFrame(records)
+        df['onset'] = df['onset'].astype(int)
+        df['dropped'] = df['dropped'].astype(int)
+        raw_filename = os.path.join(participant_dir, f"{base_filename}_FrameTiming.csv")
+        df.to_csv(raw_filename, index=False, float_format='%.6f', na_rep='NA')
+        summary_filename = os.path.join(participant_dir, f"{base_filename}_FrameTimingSummary.csv")
+        pd.DataFrame(summary).to_csv(summary_filename, index=False, float_format='%.4f', na_rep='NA')
+        print(f"Frame timing saved to {raw_filename}")
+    except Exception as e:
+        print(f"ERROR saving frame timing: {e}")
@@ -0,0 +1,119 @@
+# frame_timing.py
+
+import numpy as np
+
+class FrameProfiler:
+    """Record the time of every screen flip, tagged with routine and trial.
+
+    :meth:`attach` wraps ``win.flip`` (after ``FlipTriggerMonitor.attach``, the
+    wrappers chain) and stores the time stamp each flip returns in
+    preallocated arrays, with the routine and trial set by :meth:`begin`.
+
+    Intervals are attributed to the frame that ends them. An interval longer
+    than ``drop_threshold`` frame periods counts as a dropped frame, as in
+    PsychoPy's ``win.nDroppedFrames``. The first interval of each routine
+    (its onset frame) spans the setup code between routines, so it is kept
+    out of the interval statistics and counted separately. The per-frame
+    arrays and the per-routine summary are saved by
+    ``data_management.save_frame_timing``.
+    """
+
+    def __init__(self, frame_period=None, capacity=131072, drop_threshold=1.5):
+        self.frame_period = frame_period # Taken from the window on attach if None
+        self.drop_threshold = drop_threshold
+        self.routines = [] # Routine names, indexed by the stored routine codes
+        self._codes = {}
+        self._time = np.full(capacity, np.nan)
+        self._routine = np.zeros(capacity, dtype=np.int16)
+        self._trial = np.zeros(capacity, dtype=np.int32)
+        self._n = 0
+        self._current_routine = self._code('setup')
+        self._current_trial = 0
+
+    def _code(self, routine):
+        if routine not in self._codes:
+            self._codes[routine] = len(self.routines)
+            self.routines.append(routine)
+        return self._codes[routine]
+
+    def attach(self, win):
+        """Wrap ``win.flip`` to record every flip (returns the window)."""
+        if self.frame_period is None:
+            self.frame_period = getattr(win, 'monitorFramePeriod', None) or 1 / 60.0
+        flip = win.flip
+
+        def profiled_flip(*args, **kwargs):
+            flip_time = flip(*args, **kwargs)
+            self._record(flip_time)
+            return flip_time
+
+        win.flip = profiled_flip
+        return win
+
+    def begin(self, routine, trial=0):
+        """Tag the following flips with ``routine`` and ``trial`` (1-based, 0 outside the trials)."""
+        self._current_routine = self._code(routine)
+        self._current_trial = trial
+
+    def _record(self, flip_time):
+        n = self._n
+        if n == len(self._time):
+            self._time = np.concatenate((self._time, np.full(n, np.nan)))
+            self._routine = np.concatenate((self._routine, np.zeros(n, dtype=np.int16)))
+            self._trial = np.concatenate((self._trial, np.zeros(n, dtype=np.int32)))
+        self._time[n] = flip_time if flip_time is not None else np.nan
+        self._routine[n] = self._current_routine
+        self._trial[n] = self._current_trial
+        self._n = n + 1
+
+    def _intervals(self):
+        """Interval ending at each frame, onset flags and dropped flags."""
+        n = self._n
+        interval = np.full(n, np.nan)
+        onset = np.ones(n, dtype=np.bool_)
+        if n > 1:
+            interval[1:] = np.diff(self._time[:n])
+            onset[1:] = ((self._routine[1:n] != self._routine[:n - 1])
+                         | (self._trial[1:n] != self._trial[:n - 1]))
+        with np.errstate(invalid='ignore'):
+            dropped = interval > self.drop_threshold * (self.frame_period or 1 / 60.0)
+        return interval, onset, dropped
+
+    def records(self):
+        """Per-frame arrays (times in s, intervals in ms)."""
+        n = self._n
+        interval, onset, dropped = self._intervals()
+        return {'routine': np.asarray(self.routines, dtype=object)[self._routine[:n]],
+                'trial': self._trial[:n].copy(),
+                'flip_time': self._time[:n].copy(),
+                'interval_ms': interval * 1000,
+                'onset': onset,
+                'dropped': dropped}
+
+    def summary(self):
+        """One row per routine: frame and dropped-frame counts, interval percentiles in ms."""
+        n = self._n
+        interval, onset, dropped = self._intervals()
+        routine = self._routine[:n]
+        rows = []
+        for code, name in enumerate(self.routines):
+            frames = routine == code
+            if not frames.any():
+                continue
+            within = frames & ~onset & ~np.isnan(interval)
+            values = interval[within] * 1000
+            row = {'routine': name,
+                   'frames': int(frames.sum()),
+                   'onsets': int((frames & onset).sum()),
+                   'onset_dropped': int((frames & onset & dropped).sum()),
+                   'intervals': int(values.size),
+                   'dropped': int((within & dropped).sum()),
+                   'dropped_pct': float(100 * (within & dropped).sum() / values.size) if values.size else np.nan,
+                   'frame_period_ms': (self.frame_period or 1 / 60.0) * 1000}
+            if values.size:
+                p50, p95, p99 = np.percentile(values, [50, 95, 99])
+                row.update({'mean_ms': float(values.mean()), 'sd_ms': float(values.std()),
+                            'min_ms': float(values.min()), 'p50_ms': float(p50), 'p95_ms': float(p95),
+                            'p99_ms': float(p99), 'max_ms': float(values.max())})
+            rows.append(row)
+        return rows
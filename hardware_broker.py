@@ -0,0 +1,446 @@
+"""
+Session hardware broker.
+
+A long-running process opens the thermode, the trigger port and the EEG
+Remote Control Server once per session and keeps them open. Each run's
+script then connects to it (``hardware_setup.connect_broker``) instead of
+opening the devices itself, so it skips the port opening waits, the baseline
+set and the RCS re-open.
+
+Start it once before the first run:
+
+    python hardware_broker.py --thermode COM15 --trigger COM17 --eeg-ip 192.168.1.2 --workspace C:\\...\\workspace.rwksp
+
+Clients talk to it over a local socket: a Unix socket where the platform has
+one, otherwise TCP on the loopback interface (Windows). Messages are binary.
+A request is a header (opcode, target device, payload length) followed by the
+payload; a reply is (status, payload length) followed by the payload.
+Trigger codes and raw thermode commands are sent as raw bytes. Other method
+calls and attributes go through pickle.
+
+Since unpickling runs code, only clients of the same user get that far: the
+socket lives in a per-user directory (mode 0700, socket 0600) and at start-up
+the broker writes a random key next to it, readable by the user only. A
+client's first request must be OP_HELLO carrying that key; any other first
+request, or a wrong key, closes the connection before a payload is unpickled.
+
+Each proxy attribute read or method call is one round trip on the socket,
+about 30-40 µs on a Linux Unix socket (loopback TCP on Windows is slower).
+A client has one request in flight at a time, so a request waits for the one
+before it: ``thermode.trigger()`` in the stimulus flip callback costs one
+round trip, plus the rest of any request another thread (the watchdog) has
+in flight. To keep that short, the broker polls the thermode's 'Q' and 'E'
+replies from its own thread and answers those queries from the latest
+replies instead of reading the serial port while the client waits. A
+watchdog check costs three round trips ('Q', the ``acquiring`` read, 'E')
+and every ``TriggerBus`` write two (the ``is_open`` read and the write).
+
+Handles stay with the broker: ``close()`` on a proxy only releases it. If a
+client disconnects without releasing (crash, ``core.quit()``), the broker
+aborts the thermode and resets the trigger lines.
+"""
+
+import argparse
+import getpass
+import hmac
+import os
+import pickle
+import secrets
+import socket
+import struct
+import tempfile
+import threading
+
+REQUEST = struct.Struct('<BBI') # opcode, target, payload length
+REPLY = struct.Struct('<BI') # status, payload length
+
+# Opcodes
+OP_HELLO = 0 # -> bitmask of the devices held
+OP_WRITE = 1 # raw bytes written to the device
+OP_QUERY = 2 # raw thermode command -> reply line
+OP_CALL = 3 # pickled (method, args, kwargs) -> pickled result
+OP_GETATTR = 4 # pickled name -> b'\x01' for a method, else b'\x00' + pickled value
+OP_SETATTR = 5 # pickled (name, value)
+OP_RELEASE = 6 # client done, keep the handles open
+OP_SHUTDOWN = 7 # close the handles and stop the broker
+
+# Targets
+THERMODE, TRIGGER, RCS = 0, 1, 2
+TARGET_NAMES = ('thermode', 'trigger_port', 'rcs')
+
+POLLED_QUERIES = (b'Q', b'E') # Thermode queries answered from the broker's latest replies
+
+STATUS_OK, STATUS_ERROR = 0, 1
+
+DEFAULT_TCP_PORT = 47653
+
+
+def _runtime_dir():
+    """Per-user directory holding the socket and the key, private to the user"""
+    path = os.path.join(tempfile.gettempdir(), 'thermal_eeg_broker-%s' % getpass.getuser())
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    os.chmod(path, 0o700)
+    return path
+
+
+def default_address():
+    """Unix socket path where supported, loopback TCP address otherwise"""
+    if hasattr(socket, 'AF_UNIX'):
+        return os.path.join(_runtime_dir(), 'broker.sock')
+    return ('127.0.0.1', DEFAULT_TCP_PORT)
+
+
+def key_path(address):
+    """File holding the key of the broker at ``address``"""
+    if isinstance(address, str):
+        return address + '.key'
+    return os.path.join(_runtime_dir(), 'broker-%d.key' % address[1])
+
+
+def _write_key(path, key):
+    if os.path.exists(path):
+        os.unlink(path) # Recreate rather than reuse a file with other permissions
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+
+
+def _socket_for(address):
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:], n - got)
+        if k == 0:
+            raise ConnectionError('broker connection closed')
+        got += k
+    return bytes(buf)
+
+
+class BrokerError(RuntimeError):
+    """An exception raised by the device call inside the broker"""
+
+
+class HardwareBroker:
+    def __init__(self, address=None, thermode=None, trigger_port=None, rcs=None, reset_code=b'\x00',
+                 poll_interval_s=0.05):
+        """Serve already opened device handles to one client at a time.
+
+        Parameters
+        ----------
+        address : str or tuple, optional
+            Unix socket path or (host, port); defaults to :func:`default_address`.
+        thermode, trigger_port, rcs : object, optional
+            Device handles (``None`` for devices that are not available).
+        reset_code : bytes
+            Written to the trigger port when a client disconnects uncleanly.
+        poll_interval_s : float or None
+            Period of the thermode 'Q'/'E' polling whose replies answer those
+            queries; ``None`` disables it (queries then read the port).
+        """
+        self.address = address if address is not None else default_address()
+        self.devices = [thermode, trigger_port, rcs]
+        self.reset_code = reset_code
+        self._running = False
+        self._sock = None
+        self._key = secrets.token_bytes(32)
+        self.key_path = None
+        self.poll_interval_s = poll_interval_s
+        self._polled = {} # Latest reply to each of POLLED_QUERIES
+        self._poll_stop = threading.Event()
+        self._poll_thread = None
+
+    def _bind(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address) # Stale socket from a previous session
+        self._sock = _socket_for(self.address)
+        if not isinstance(self.address, str):
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(self.address)
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)
+        self._sock.listen(1)
+        if not isinstance(self.address, str):
+            self.address = self._sock.getsockname() # Resolve port 0
+        self.key_path = key_path(self.address)
+        _write_key(self.key_path, self._key)
+
+    def serve_forever(self):
+        """Accept clients until a shutdown request, then close the devices"""
+        if self._sock is None:
+            self._bind()
+        self._running = True
+        self._start_polling()
+        try:
+            while self._running:
+                conn, _ = self._sock.accept()
+                with conn:
+                    if not isinstance(self.address, str):
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self._serve(conn)
+        finally:
+            self._stop_polling()
+            self._sock.close()
+            for path in (self.address if isinstance(self.address, str) else None, self.key_path):
+                if path is not None and os.path.exists(path):
+                    os.unlink(path)
+            self._close_devices()
+
+    def _start_polling(self):
+        if self.devices[THERMODE] is None or self.poll_interval_s is None:
+            return
+        self._poll_stop.clear()
+        self._poll_thread = threading.Thread(target=self._poll, name='broker-poll', daemon=True)
+        self._poll_thread.start()
+
+    def _stop_polling(self):
+        self._poll_stop.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join(timeout=1.0)
+            self._poll_thread = None
+        self._polled.clear()
+
+    def _poll(self):
+        """Keep the latest thermode replies to POLLED_QUERIES (b'' when unanswered)"""
+        thermode = self.devices[THERMODE]
+        while True:
+            for command in POLLED_QUERIES:
+                if command == b'E' and thermode.acquiring:
+                    self._polled.pop(command, None) # Stream lines would be taken as the reply
+                    continue
+                try:
+                    self._polled[command] = thermode.query(command)
+                except (TimeoutError, OSError):
+                    self._polled[command] = b''
+            if self._poll_stop.wait(self.poll_interval_s):
+                return
+
+    def _authenticate(self, conn):
+        """Check the key of the first request, before anything is unpickled"""
+        op, _, length = REQUEST.unpack(_recv_exact(conn, REQUEST.size))
+        if op == OP_HELLO and length == len(self._key) and hmac.compare_digest(_recv_exact(conn, length), self._key):
+            return True
+        reply = b'unauthorized'
+        conn.sendall(REPLY.pack(STATUS_ERROR, len(reply)) + reply)
+        return False
+
+    def _serve(self, conn):
+        try:
+            if not self._authenticate(conn):
+                return
+        except ConnectionError:
+            return
+        conn.sendall(REPLY.pack(STATUS_OK, 1) + self._handle(OP_HELLO, 0, b''))
+        released = False
+        try:
+            while True:
+                op, target, length = REQUEST.unpack(_recv_exact(conn, REQUEST.size))
+                payload = _recv_exact(conn, length) if length else b''
+                if op == OP_RELEASE:
+                    released = True
+                elif op == OP_SHUTDOWN:
+                    released = True
+                    self._running = False
+                try:
+                    status, reply = STATUS_OK, self._handle(op, target, payload)
+                except Exception as e:
+                    status, reply = STATUS_ERROR, ('%s: %s' % (type(e).__name__, e)).encode()
+                conn.sendall(REPLY.pack(status, len(reply)) + reply)
+                if op in (OP_RELEASE, OP_SHUTDOWN):
+                    return
+        except ConnectionError:
+            if not released:
+                self._fail_safe()
+
+    def _handle(self, op, target, payload):
+        if op == OP_HELLO:
+            return bytes([sum(1 << i for i, device in enumerate(self.devices) if device is not None)])
+        if op == OP_RELEASE:
+            self._disable_profiles()
+        if op in (OP_RELEASE, OP_SHUTDOWN):
+            return b''
+        device = self.devices[target]
+        if device is None:
+            raise ValueError('broker holds no %s' % TARGET_NAMES[target])
+        if op == OP_WRITE:
+            if target == THERMODE:
+                device._send(payload)
+            else:
+                device.write(payload)
+            return b''
+        if op == OP_QUERY:
+            if target == THERMODE and payload in self._polled:
+                return self._polled[payload] # No serial read while the client waits
+            return device.query(payload)
+        if op == OP_CALL:
+            name, args, kwargs = pickle.loads(payload)
+            return pickle.dumps(getattr(device, name)(*args, **kwargs))
+        if op == OP_GETATTR:
+            value = getattr(device, pickle.loads(payload))
+            if callable(value):
+                return b'\x01'
+            return b'\x00' + pickle.dumps(value)
+        if op == OP_SETATTR:
+            name, value = pickle.loads(payload)
+            setattr(device, name, value)
+            return b''
+        raise ValueError('unknown opcode %d' % op)
+
+    def _fail_safe(self):
+        """Client vanished: stop any stimulation and reset the trigger lines"""
+        thermode, trigger_port, _ = self.devices
+        try:
+            if thermode is not None:
+                thermode.abort()
+            if trigger_port is not None and trigger_port.is_open:
+                trigger_port.write(self.reset_code)
+        except Exception as e:
+            print(f"ERROR during broker fail-safe: {e}")
+        self._disable_profiles()
+
+    def _disable_profiles(self):
+        """Leave no temperature profile enabled for the next run's 'C'/'V'/'R'/'D' stimulations"""
+        thermode = self.devices[THERMODE]
+        if thermode is not None:
+            try:
+                thermode.disable_profiles()
+            except Exception as e:
+                print(f"ERROR disabling thermode profiles: {e}")
+
+    def _close_devices(self):
+        thermode, trigger_port, rcs = self.devices
+        for name, close in (('thermode', lambda: thermode.port.close()),
+                            ('trigger port', lambda: trigger_port.close()),
+                            ('RCS', lambda: rcs.close())):
+            try:
+                close()
+            except AttributeError:
+                pass # Device not held
+            except Exception as e:
+                print(f"ERROR closing {name}: {e}")
+
+
+class BrokerClient:
+    def __init__(self, address=None, timeout=5.0):
+        """Connect to a running :class:`HardwareBroker`.
+
+        The held devices are available as the ``thermode``, ``trigger_port``
+        and ``rcs`` proxies (``None`` if the broker does not hold them).
+        Raises ``OSError`` if no broker is listening or its key cannot be read.
+        """
+        self.address = address if address is not None else default_address()
+        with open(key_path(self.address), 'rb') as f:
+            key = f.read()
+        self._sock = _socket_for(self.address)
+        self._sock.settimeout(timeout)
+        self._sock.connect(self.address)
+        self._lock = threading.Lock() # One request in flight (e.g. main thread and a watchdog)
+        held = self.request(OP_HELLO, payload=key)[0]
+        proxies = [_DeviceProxy(self, target) if held & (1 << target) else None for target in range(3)]
+        self.thermode, self.trigger_port, self.rcs = proxies
+
+    def request(self, op, target=0, payload=b''):
+        with self._lock:
+            self._sock.sendall(REQUEST.pack(op, target, len(payload)) + payload)
+            status, length = REPLY.unpack(_recv_exact(self._sock, REPLY.size))
+            reply = _recv_exact(self._sock, length) if length else b''
+        if status != STATUS_OK:
+            raise BrokerError(reply.decode(errors='replace'))
+        return reply
+
+    def release(self):
+        """Disconnect and leave the devices open for the next run"""
+        if self._sock is not None:
+            try:
+                self.request(OP_RELEASE)
+            finally:
+                self._sock.close()
+                self._sock = None
+
+    def shutdown(self):
+        """Close the devices and stop the broker"""
+        try:
+            self.request(OP_SHUTDOWN)
+        finally:
+            self._sock.close()
+            self._sock = None
+
+
+class _DeviceProxy:
+    """Forwards attribute access and method calls to a device held by the broker"""
+
+    def __init__(self, client, target):
+        object.__setattr__(self, '_client', client)
+        object.__setattr__(self, '_target', target)
+        object.__setattr__(self, '_methods', set()) # Names known to be methods, called without a lookup
+
+    def write(self, data):
+        """Raw write (trigger codes, thermode commands), without pickling"""
+        self._client.request(OP_WRITE, self._target, bytes(data))
+
+    def query(self, command, timeout=None):
+        if isinstance(command, str):
+            command = command.encode()
+        return self._client.request(OP_QUERY, self._target, command)
+
+    def close(self):
+        """The broker keeps the handle open; release the client instead"""
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name not in self._methods:
+            reply = self._client.request(OP_GETATTR, self._target, pickle.dumps(name))
+            if reply[:1] == b'\x00':
+                return pickle.loads(reply[1:])
+            self._methods.add(name)
+        return lambda *args, **kwargs: self._call(name, args, kwargs)
+
+    def __setattr__(self, name, value):
+        self._client.request(OP_SETATTR, self._target, pickle.dumps((name, value)))
+
+    def _call(self, name, args, kwargs):
+        return pickle.loads(self._client.request(OP_CALL, self._target, pickle.dumps((name, args, kwargs))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hold the experiment hardware open for a whole session.')
+    parser.add_argument('--thermode', help='Thermode serial port (e.g. COM15)')
+    parser.add_argument('--baseline', type=float, default=None, help='Thermode baseline (default: config.BASELINE_TEMP)')
+    parser.add_argument('--trigger', help='Trigger serial port (e.g. COM17)')
+    parser.add_argument('--eeg-ip', help='BrainProducts RCS host')
+    parser.add_argument('--workspace', help='BrainVision Recorder workspace path')
+    args = parser.parse_args()
+
+    import config
+    import hardware_setup as hw
+
+    thermode = trigger_port = rcs = None
+    if args.thermode:
+        baseline = args.baseline if args.baseline is not None else config.BASELINE_TEMP
+        thermode = hw.initialize_thermode(args.thermode, baseline, record_latency=True)
+    if args.trigger:
+        trigger_port = hw.initialize_trigger_port(args.trigger)
+    if args.eeg_ip:
+        rcs = hw.initialize_eeg_rcs(args.eeg_ip, args.workspace, participant='session', exp_name='broker')
+
+    broker = HardwareBroker(thermode=thermode, trigger_port=trigger_port, rcs=rcs,
+                            reset_code=config.TRIG_RESET)
+    broker._bind()
+    print(f"Hardware broker listening on {broker.address}. Stop with Ctrl+C.")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        print("Hardware broker stopped.")
+
+
+if __name__ == '__main__':
+    main()
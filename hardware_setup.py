@@ -2,15 +2,20 @@
 
 import serial
 from psychopy import core
-from pytcsii import tcsii_serial
+from pytcsii import tcsii_serial, tcsii_multi, tcsii_watchdog
+from hardware_broker import BrokerClient
 from psychopy.hardware import brainproducts
 from config import TRIG_RESET
 
-def initialize_thermode(port_name, baseline_temp):
-    """Initialize the thermode device and set its baseline temperature."""
+def initialize_thermode(port_name, baseline_temp, record_latency=False):
+    """Initialize the thermode device and set its baseline temperature.
+
+    With ``record_latency`` the driver keeps per-command latency histograms
+    (``thermode.latency``) for the run's latency report.
+    """
     print(f"Initializing Thermode on {port_name}...")
     try:
-        thermode = tcsii_serial(port_name, beep=True)
+        thermode = tcsii_serial(port_name, beep=True, record_latency=record_latency)
         thermode.set_baseline(baseline_temp)
         print(f"SUCCESS: Thermode initialized on {port_name} with baseline {baseline_temp}°C.")
         return thermode
@@ -18,6 +23,60 @@ def initialize_thermode(port_name, baseline_temp):
         print(f"FATAL ERROR: Thermode initialization failed on {port_name}: {e}")
         return None
 
+def initialize_thermodes(port_names, baseline_temp, record_latency=False):
+    """Initialize several thermodes and group them in a ``tcsii_multi``.
+
+    Returns ``None`` if any of the devices fails to initialize; the ones that
+    did open are closed again.
+    """
+    thermodes = [initialize_thermode(port_name, baseline_temp, record_latency) for port_name in port_names]
+    if any(thermode is None for thermode in thermodes):
+        for thermode in thermodes:
+            if thermode is not None:
+                thermode.port.close()
+        print(f"FATAL ERROR: Thermodes could not all be initialized on {', '.join(port_names)}.")
+        return None
+    return tcsii_multi(thermodes, names=list(port_names), clock=core.monotonicClock.getTime)
+
+def start_thermode_watchdog(thermode, limit_temp=None):
+    """Start a background watchdog that aborts the stimulation on a thermode fault.
+
+    The thermode is sent 'A' on an error state, a temperature above
+    ``limit_temp`` (default: the thermode's maximum + 1°C) or when the script
+    exits, e.g. through ``core.quit()``. ``watchdog.status`` holds the outcome.
+    """
+    watchdog = tcsii_watchdog(thermode, limit_temp=limit_temp, clock=core.monotonicClock.getTime)
+    watchdog.start()
+    print(f"SUCCESS: Thermode watchdog started (limit {watchdog.limit_temp}°C).")
+    return watchdog
+
+def connect_broker(participant=None, exp_name=None, address=None):
+    """Connect to the session's hardware broker if one is running.
+
+    The broker (``python hardware_broker.py ...``) keeps the thermode, trigger
+    port and RCS open across runs. The returned client exposes them as
+    ``broker.thermode``, ``broker.trigger_port`` and ``broker.rcs``; call
+    ``broker.release()`` at the end of the run. The RCS participant and
+    experiment name are set for this run and the thermode latency histograms
+    are restarted.
+
+    Returns ``None`` if no broker is listening, so the caller can initialize
+    the devices itself.
+    """
+    try:
+        broker = BrokerClient(address)
+    except OSError:
+        print("No hardware broker running; devices will be initialized directly.")
+        return None
+    if broker.rcs is not None and participant is not None:
+        broker.rcs.participant = participant
+        broker.rcs.expName = exp_name
+        broker.rcs.mode = 'monitor'
+    if broker.thermode is not None:
+        broker.thermode.reset_latency()
+    print(f"SUCCESS: Connected to hardware broker at {broker.address}.")
+    return broker
+
 def initialize_trigger_port(port_address, baudrate=2000000):
     """Open the serial port for triggers and send an initial reset."""
     print(f"Initializing Trigger port {port_address}...")
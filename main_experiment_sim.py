@@ -11,6 +11,7 @@ from psychopy.hardware import keyboard
 # experiment_logic.py, and data_management.py are in the same directory.
 import config
 import triggering
+import frame_timing
 import experiment_logic as logic
 import data_management as dm
 
@@ -24,10 +25,34 @@ class FakeThermode:
     def set_stim(self, **kwargs):
         print(f"SIMULATION: set_stim {kwargs}")
 
+    def compile_profile_table(self, trials):
+        return list(trials)
+
+    def upload_profiles(self, table):
+        print(f"SIMULATION: upload_profiles ({len(table)} trials)")
+        return 0
+
+    def disable_profiles(self):
+        print("SIMULATION: disable_profiles")
+
+    def load_stim(self, compiled, force=False):
+        print(f"SIMULATION: load_stim {compiled}")
+
     def trigger(self):
         print("SIMULATION: thermode trigger")
 
 
+class FakeWatchdog:
+    tripped = False
+
+    def __init__(self):
+        self.status = {"state": "ok", "message": ""}
+
+    def stop(self):
+        self.status["state"] = "stopped"
+        return self.status
+
+
 class FakeTriggerPort:
     def __init__(self):
         self.is_open = True
@@ -57,6 +82,11 @@ def initialize_thermode(port_name, baseline_temp):
     return FakeThermode()
 
 
+def start_thermode_watchdog(thermode):
+    print("SIMULATION: start thermode watchdog")
+    return FakeWatchdog()
+
+
 def initialize_trigger_port(port_address, baudrate=2000000):
     print(f"SIMULATION: initialize trigger port {port_address}")
     return FakeTriggerPort()
@@ -119,6 +149,17 @@ if thermode is None or trigger_port is None:
     logger.error("Critical hardware failed to initialize. Exiting.")
     core.quit()
 
+# --- Trigger Bus & Scheduler ---
+# The bus owns the trigger port and logs every write; the scheduler writes
+# pulses from a background thread so the caller never waits for them to end.
+trigger_bus = triggering.TriggerBus(trigger_port)
+trigger_scheduler = triggering.TriggerScheduler(trigger_bus)
+
+# --- Thermode Safety Watchdog ---
+# Sends 'A' (abort) on a thermode error, an over-limit temperature, or when the
+# script exits (escape -> core.quit()).
+watchdog = start_thermode_watchdog(thermode)
+
 # --- Prepare Experiment Sequences & Values ---
 ramp_rates = logic.precalculate_ramp_rates(
     config.POSSIBLE_THERMODE_TEMPS,
@@ -129,6 +170,29 @@ ramp_rates = logic.precalculate_ramp_rates(
 )
 num_trials = len(temp_order)
 
+# --- Upload the Whole Run as Thermode Profiles ---
+# Every trial is encoded once here as a per-surface temperature profile and
+# each surface's first profile is written before the run. During the ITI the
+# trial loop only selects the surface, rewriting a profile when that surface's
+# next stimulus differs; the stimulus itself is fired with a single 'L'.
+dur_ms = int((config.RAMP_UP_SECS_CONST + config.STIM_HOLD_DURATION_SECS) * 1000)
+stim_table = thermode.compile_profile_table(
+    [
+        {
+            "target": temp,
+            "rise_rate": ramp_rates[temp]["rise"],
+            "return_rate": ramp_rates[temp]["return"],
+            "dur_ms": dur_ms,
+            "surfaces": [surface],
+        }
+        for temp, surface in zip(temp_order, surface_order)
+    ]
+)
+profile_rewrites = thermode.upload_profiles(stim_table)
+logger.info(
+    "Thermode profiles uploaded (%s rewrites during the run).", profile_rewrites
+)
+
 # --- Setup PsychoPy Window & Keyboard ---
 win = visual.Window(
     size=(1920, 1080),
@@ -140,6 +204,12 @@ win = visual.Window(
     units="height",
 )
 win.mouseVisible = False
+# Flip-locked triggers go through the monitor, which times them against the flips
+flip_monitor = triggering.FlipTriggerMonitor(trigger_bus)
+flip_monitor.attach(win)
+# Every flip is timed and tagged with the routine and trial it belongs to
+frame_profiler = frame_timing.FrameProfiler()
+frame_profiler.attach(win)
 kb = keyboard.Keyboard()
 event.clearEvents()
 fixation_cross = visual.TextStim(win, text="+", height=0.1, color="white")
@@ -178,7 +248,10 @@ if rcs:
         rcs.startRecording()
         thisExp.addData("eeg_rec_command_sent_time", core.monotonicClock.getTime())
         triggering.send_event_pulse(
-            trigger_port, config.TRIG_EEG_REC_START, config.TRIG_RESET
+            trigger_bus,
+            config.TRIG_EEG_REC_START,
+            config.TRIG_RESET,
+            scheduler=trigger_scheduler,
         )
         logger.debug("Sent %s pulse for EEG Start.", config.TRIG_EEG_REC_START.hex())
     except Exception as e:
@@ -197,6 +270,7 @@ scanner_stim = visual.TextStim(
 )
 press_count = 0
 event.clearEvents()
+frame_profiler.begin("scanner_wait")
 continue_wait = True
 while continue_wait:
     scanner_stim.draw()
@@ -224,6 +298,7 @@ welcome_text = (
 welcome_stim = visual.TextStim(
     win, text=welcome_text, font="Arial", height=0.04, wrapWidth=1.2, color="white"
 )
+frame_profiler.begin("welcome")
 continue_routine = True
 while continue_routine:
     welcome_stim.draw()
@@ -257,19 +332,24 @@ for this_trial in main_loop:
     thisExp.addData("iti_start_time", iti_start_time)
 
     iti_timer = core.CountdownTimer(iti_duration)
+
+    # Stage this trial's thermode parameters while the fixation cross is shown
+    thermode.load_stim(stim_table[current_loop_index])
+    logger.debug(
+        "Trial %s: Temp=%s°C, Surface=%s. Thermode parameters staged.",
+        current_loop_index + 1,
+        temp_order[current_loop_index],
+        surface_order[current_loop_index],
+    )
     logger.debug(
         "ITI routine started. TRIG_ITI_START (%s) code queued.",
         config.TRIG_ITI_START.hex(),
     )
 
     def trigger_iti_onset():
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_ITI_START)
-        else:
-            print(
-                f"SKIPPED trigger {config.TRIG_ITI_START.hex()} (port not available/open)."
-            )
+        flip_monitor.send(config.TRIG_ITI_START)
 
+    frame_profiler.begin("ITI", trial=current_loop_index + 1)
     win.callOnFlip(trigger_iti_onset)
     while iti_timer.getTime() > 0:
         fixation_cross.draw()
@@ -284,10 +364,7 @@ for this_trial in main_loop:
     thisExp.addData("iti_end_time", iti_end_time)
     thisExp.addData("iti_actual_duration", round(iti_end_time - iti_start_time, 4))
 
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
-    else:
-        print("SKIPPED reset after ITI (port not available/open).")
+    trigger_bus.send(config.TRIG_RESET)
     logger.debug("ITI ended. Lines reset.")
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
@@ -295,23 +372,6 @@ for this_trial in main_loop:
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
     current_temp = temp_order[current_loop_index]
     current_surface = surface_order[current_loop_index]
-    current_rates = ramp_rates[current_temp]
-
-    dur_ms = int((config.RAMP_UP_SECS_CONST + config.STIM_HOLD_DURATION_SECS) * 1000)
-
-    thermode.set_stim(
-        target=current_temp,
-        rise_rate=current_rates["rise"],
-        return_rate=current_rates["return"],
-        dur_ms=dur_ms,
-        surfaces=[current_surface],
-    )
-    logger.debug(
-        "Trial %s: Temp=%s°C, Surface=%s. Thermode parameters set.",
-        current_loop_index + 1,
-        current_temp,
-        current_surface,
-    )
 
     stim_duration = (
         config.RAMP_UP_SECS_CONST
@@ -325,15 +385,13 @@ for this_trial in main_loop:
     stim_onset_time = {"t": None}
 
     def trigger_and_log_stim_onset():
-        thermode.trigger()
+        # A tripped watchdog has stopped monitoring: never stimulate unwatched
+        if not watchdog.tripped:
+            thermode.trigger()
         stim_onset_time["t"] = core.monotonicClock.getTime()
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_STIM_ON)
-        else:
-            print(
-                f"SKIPPED trigger {config.TRIG_STIM_ON.hex()} (port not available/open)."
-            )
+        flip_monitor.send(config.TRIG_STIM_ON)
 
+    frame_profiler.begin("stimulus", trial=current_loop_index + 1)
     win.callOnFlip(trigger_and_log_stim_onset)
     while stim_timer.getTime() > 0:
         fixation_cross.draw()
@@ -341,10 +399,7 @@ for this_trial in main_loop:
         if event.getKeys(keyList=["escape"]):
             core.quit()
 
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
-    else:
-        print("SKIPPED reset after stimulus (port not available/open).")
+    trigger_bus.send(config.TRIG_RESET)
     stim_reset_time = core.monotonicClock.getTime()
     thisExp.addData("stim_offset_trigger_time", stim_reset_time)
     logger.debug("Stimulus ended. Lines reset.")
@@ -360,6 +415,11 @@ for this_trial in main_loop:
     thisExp.addData(
         "stim_routine_actual_duration", round(stim_end_time - stim_start_time, 4)
     )
+    thisExp.addData("thermode_watchdog_state", watchdog.status["state"])
+    if watchdog.tripped:
+        logger.error(
+            "Thermode watchdog aborted the stimulation: %s", watchdog.status["message"]
+        )
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
     # Pain Question Routine
@@ -377,13 +437,9 @@ for this_trial in main_loop:
     )
 
     def trigger_pain_q_onset():
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_PAIN_Q_ON)
-        else:
-            print(
-                f"SKIPPED trigger {config.TRIG_PAIN_Q_ON.hex()} (port not available/open)."
-            )
+        flip_monitor.send(config.TRIG_PAIN_Q_ON)
 
+    frame_profiler.begin("pain_question", trial=current_loop_index + 1)
     win.callOnFlip(trigger_pain_q_onset)
     continue_routine = True
     while continue_routine:
@@ -408,10 +464,7 @@ for this_trial in main_loop:
     thisExp.addData(
         "pain_q_actual_duration", round(pain_q_end_time - pain_q_start_time, 4)
     )
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
-    else:
-        print("SKIPPED reset after pain question (port not available/open).")
+    trigger_bus.send(config.TRIG_RESET)
     logger.debug("Pain question ended. Lines reset.")
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
@@ -466,13 +519,9 @@ for this_trial in main_loop:
     held_move_key = None
     
     def trigger_vas_onset():
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_VAS_ON)
-        else:
-            print(
-                f"SKIPPED trigger {config.TRIG_VAS_ON.hex()} (port not available/open)."
-            )
+        flip_monitor.send(config.TRIG_VAS_ON)
 
+    frame_profiler.begin("VAS", trial=current_loop_index + 1)
     win.callOnFlip(trigger_vas_onset)
     vas_start_time = core.monotonicClock.getTime()
 
@@ -584,10 +633,7 @@ for this_trial in main_loop:
     vas_end_time = core.monotonicClock.getTime()
     thisExp.addData("vas_end_time", vas_end_time)
     thisExp.addData("vas_actual_duration", round(vas_end_time - vas_start_time, 4))
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
-    else:
-        print("SKIPPED reset after VAS (port not available/open).")
+    trigger_bus.send(config.TRIG_RESET)
     logger.debug("VAS ended. Lines reset.")
 
     # --- Append data to collector for final saving ---
@@ -609,6 +655,13 @@ for this_trial in main_loop:
 
     thisExp.nextEntry()
 
+    if watchdog.tripped:
+        logger.error(
+            "Ending the run after trial %s: the thermode watchdog tripped.",
+            current_loop_index + 1,
+        )
+        break
+
 
 # =================================================================
 # 3. END EXPERIMENT & SAVE DATA
@@ -624,13 +677,22 @@ if rcs:
     except Exception as e:
         logger.error("EEG stop/close error: %s", e)
 
-if trigger_port and trigger_port.is_open:
-    trigger_port.write(config.TRIG_RESET)
-    trigger_port.close()
-    logger.info("Trigger port closed.")
+watchdog.stop()
+thermode.disable_profiles()
+
+trigger_scheduler.close()
+trigger_bus.close()
+logger.info("Trigger port closed.")
 
 # --- Save All Collected Data from our custom collector ---
 dm.save_all_data(exp_info, exp_name, exp_data_collector, _thisDir)
+dm.save_trigger_log(exp_info, exp_name, trigger_bus.write_log(), _thisDir)
+dm.save_trigger_jitter(
+    exp_info, exp_name, flip_monitor.records(), flip_monitor.stats(), _thisDir
+)
+dm.save_frame_timing(
+    exp_info, exp_name, frame_profiler.records(), frame_profiler.summary(), _thisDir
+)
 
 # --- End of Experiment Screen ---
 end_msg = visual.TextStim(
@@ -10,8 +10,10 @@ from psychopy.hardware import keyboard
 import config
 import hardware_setup as hw
 import triggering
+import frame_timing
 import experiment_logic as logic
 import data_management as dm
+from pytcsii import temp_trace_recorder, load_temp_trace, ramp_fidelity_tracker
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -63,7 +65,7 @@ base_filename = f"{exp_info['participant']}_{exp_name}_{exp_info['date']}"
 
 # --- Initialize Hardware ---
 thermode = hw.initialize_thermode(
-    exp_info["com_thermode"], config.BASELINE_TEMP
+    exp_info["com_thermode"], config.BASELINE_TEMP, record_latency=True
 )
 trigger_port = hw.initialize_trigger_port(exp_info["com_trigger"])
 rcs = hw.initialize_eeg_rcs(
@@ -77,6 +79,32 @@ if thermode is None or trigger_port is None:
     logger.error("Critical hardware failed to initialize. Exiting.")
     core.quit()
 
+# --- Trigger Bus & Scheduler ---
+# The bus owns the trigger port and logs every write; the scheduler writes
+# pulses from a background thread so the caller never waits for them to end.
+trigger_bus = triggering.TriggerBus(trigger_port)
+trigger_scheduler = triggering.TriggerScheduler(trigger_bus)
+
+# --- Thermode Safety Watchdog ---
+# Sends 'A' (abort) on a thermode error, an over-limit temperature, or when the
+# script exits (escape -> core.quit()).
+watchdog = hw.start_thermode_watchdog(thermode)
+
+# Temperatures are collected in a background thread for the whole run so the
+# render loop never waits on the thermode's serial replies. In stream mode the
+# thermode pushes its 100 Hz display during each stimulation. Every sample is
+# also appended to a memory-mapped trace file, which survives a crash and keeps
+# memory flat; trials only keep their sample range. The ramp tracker measures
+# each stimulation's ramps and plateau from the same samples as they arrive.
+trace_path = os.path.join(participant_dir, f"{base_filename}_TemperatureTrace.bin")
+trace_recorder = temp_trace_recorder(trace_path)
+ramp_tracker = ramp_fidelity_tracker()
+thermode.start_acquisition(
+    clock=core.monotonicClock.getTime,
+    mode="stream",
+    sinks=[trace_recorder, ramp_tracker],
+)
+
 # --- Prepare Experiment Sequences & Values ---
 ramp_rates = logic.precalculate_ramp_rates(
     config.POSSIBLE_THERMODE_TEMPS,
@@ -87,6 +115,29 @@ ramp_rates = logic.precalculate_ramp_rates(
 )
 num_trials = len(temp_order)
 
+# --- Upload the Whole Run as Thermode Profiles ---
+# Every trial is encoded once here as a per-surface temperature profile and
+# each surface's first profile is written before the run. During the ITI the
+# trial loop only selects the surface, rewriting a profile when that surface's
+# next stimulus differs; the stimulus itself is fired with a single 'L'.
+dur_ms = int((config.RAMP_UP_SECS_CONST + config.STIM_HOLD_DURATION_SECS) * 1000)
+stim_table = thermode.compile_profile_table(
+    [
+        {
+            "target": temp,
+            "rise_rate": ramp_rates[temp]["rise"],
+            "return_rate": ramp_rates[temp]["return"],
+            "dur_ms": dur_ms,
+            "surfaces": [surface],
+        }
+        for temp, surface in zip(temp_order, surface_order)
+    ]
+)
+profile_rewrites = thermode.upload_profiles(stim_table)
+logger.info(
+    "Thermode profiles uploaded (%s rewrites during the run).", profile_rewrites
+)
+
 # --- Setup PsychoPy Window & Keyboard ---
 win = visual.Window(
     size=(1920, 1080),
@@ -98,6 +149,12 @@ win = visual.Window(
     units="height",
 )
 win.mouseVisible = False
+# Flip-locked triggers go through the monitor, which times them against the flips
+flip_monitor = triggering.FlipTriggerMonitor(trigger_bus)
+flip_monitor.attach(win)
+# Every flip is timed and tagged with the routine and trial it belongs to
+frame_profiler = frame_timing.FrameProfiler()
+frame_profiler.attach(win)
 kb = keyboard.Keyboard()
 event.clearEvents()
 fixation_cross = visual.TextStim(win, text="+", height=0.1, color="white")
@@ -134,7 +191,10 @@ if rcs:
         rcs.startRecording()
         thisExp.addData("eeg_rec_command_sent_time", core.monotonicClock.getTime())
         triggering.send_event_pulse(
-            trigger_port, config.TRIG_EEG_REC_START, config.TRIG_RESET
+            trigger_bus,
+            config.TRIG_EEG_REC_START,
+            config.TRIG_RESET,
+            scheduler=trigger_scheduler,
         )
         logger.debug("Sent %s pulse for EEG Start.", config.TRIG_EEG_REC_START.hex())
     except Exception as e:
@@ -153,6 +213,7 @@ scanner_stim = visual.TextStim(
 )
 press_count = 0
 event.clearEvents()
+frame_profiler.begin("scanner_wait")
 continue_wait = True
 while continue_wait:
     scanner_stim.draw()
@@ -183,6 +244,7 @@ welcome_stim = visual.TextStim(
     win, text=welcome_text, font="Arial", height=0.04, wrapWidth=1.2, color="white"
 )
 
+frame_profiler.begin("welcome")
 continue_routine = True
 while continue_routine:
     welcome_stim.draw()
@@ -218,10 +280,13 @@ for this_trial in main_loop:
 
     iti_timer = core.CountdownTimer(iti_duration)
 
+    # Stage this trial's thermode parameters while the fixation cross is shown
+    thermode.load_stim(stim_table[current_loop_index])
+
     def trigger_iti_onset():
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_ITI_START)
+        flip_monitor.send(config.TRIG_ITI_START)
 
+    frame_profiler.begin("ITI", trial=current_loop_index + 1)
     win.callOnFlip(trigger_iti_onset)
     while iti_timer.getTime() > 0:
         fixation_cross.draw()
@@ -235,25 +300,13 @@ for this_trial in main_loop:
     iti_end_time = core.monotonicClock.getTime()
     thisExp.addData("iti_end_time", iti_end_time)
     thisExp.addData("iti_actual_duration", round(iti_end_time - iti_start_time, 4))
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
+    trigger_bus.send(config.TRIG_RESET)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
     # Stimulus Routine with temperature logging
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
     current_temp = temp_order[current_loop_index]
     current_surface = surface_order[current_loop_index]
-    current_rates = ramp_rates[current_temp]
-
-    dur_ms = int((config.RAMP_UP_SECS_CONST + config.STIM_HOLD_DURATION_SECS) * 1000)
-
-    thermode.set_stim(
-        target=current_temp,
-        rise_rate=current_rates["rise"],
-        return_rate=current_rates["return"],
-        dur_ms=dur_ms,
-        surfaces=[current_surface],
-    )
 
     stim_duration = (
         config.RAMP_UP_SECS_CONST
@@ -264,31 +317,35 @@ for this_trial in main_loop:
     stim_timer = core.CountdownTimer(stim_duration)
 
     stim_onset_time = {"t": None}
-    temp_samples = []
-    temp_sample_times = []
-    temp_clock = core.Clock()
+    temp_sample_mark = {"count": None, "trace": None}
 
     def trigger_and_log_stim_onset():
-        thermode.trigger()
+        # A tripped watchdog has stopped monitoring: never stimulate unwatched
+        if not watchdog.tripped:
+            thermode.trigger()
         stim_onset_time["t"] = core.monotonicClock.getTime()
-        temp_clock.reset()
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_STIM_ON)
+        temp_sample_mark["count"] = thermode.acquisition_buffer.count
+        temp_sample_mark["trace"] = trace_recorder.count
+        ramp_tracker.arm(
+            stim_onset_time["t"],
+            current_temp,
+            config.BASELINE_TEMP,
+            [current_surface],
+            config.RAMP_UP_SECS_CONST + config.STIM_HOLD_DURATION_SECS,
+            rise_rate=ramp_rates[current_temp]["rise"],
+            return_rate=ramp_rates[current_temp]["return"],
+        )
+        flip_monitor.send(config.TRIG_STIM_ON)
 
+    frame_profiler.begin("stimulus", trial=current_loop_index + 1)
     win.callOnFlip(trigger_and_log_stim_onset)
     while stim_timer.getTime() > 0:
-        thermode.port.write(b"E")
-        out = thermode.port.readline().decode().strip()
-        if out:
-            temp_samples.append(out)
-            temp_sample_times.append(temp_clock.getTime())
         fixation_cross.draw()
         win.flip()
         if event.getKeys(keyList=["escape"]):
             core.quit()
 
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
+    trigger_bus.send(config.TRIG_RESET)
 
     stim_reset_time = core.monotonicClock.getTime()
     thisExp.addData("stim_offset_trigger_time", stim_reset_time)
@@ -303,17 +360,22 @@ for this_trial in main_loop:
     thisExp.addData("stim_start_time", stim_start_time)
     thisExp.addData("stim_end_time", stim_end_time)
     thisExp.addData("stim_routine_actual_duration", round(stim_end_time - stim_start_time, 4))
-
-    # Parse temperature samples and plot
-    try:
-        temp_array = (
-            np.asarray([s.split("+") for s in temp_samples], dtype=float) / 10.0
-            if temp_samples
-            else np.empty((0, 6))
+    thisExp.addData("thermode_watchdog_state", watchdog.status["state"])
+    if watchdog.tripped:
+        logger.error(
+            "Thermode watchdog aborted the stimulation: %s", watchdog.status["message"]
         )
-    except Exception as e:
-        logger.error("Temperature parsing error: %s", e)
-        temp_array = np.empty((0, 6))
+
+    # Collect the samples acquired since stimulus onset and plot
+    temp_times_abs, temp_array = thermode.temperature_snapshot(
+        since=temp_sample_mark["count"]
+    )
+    temp_trace_range = [temp_sample_mark["trace"], trace_recorder.count]
+    ramp_metrics = ramp_tracker.finish()
+    for key, value in ramp_metrics.items():
+        thisExp.addData(f"ramp_{key}", value)
+    temp_array = temp_array.astype(float)
+    temp_sample_times = (temp_times_abs - stim_onset_time["t"]).tolist()
 
     if temp_array.size:
         fig = plt.figure()
@@ -353,9 +415,9 @@ for this_trial in main_loop:
     painKey.clearEvents()
 
     def trigger_pain_q_onset():
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_PAIN_Q_ON)
+        flip_monitor.send(config.TRIG_PAIN_Q_ON)
 
+    frame_profiler.begin("pain_question", trial=current_loop_index + 1)
     win.callOnFlip(trigger_pain_q_onset)
     continue_routine = True
     while continue_routine:
@@ -378,8 +440,7 @@ for this_trial in main_loop:
     pain_q_end_time = core.monotonicClock.getTime()
     thisExp.addData("pain_q_end_time", pain_q_end_time)
     thisExp.addData("pain_q_actual_duration", round(pain_q_end_time - pain_q_start_time, 4))
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
+    trigger_bus.send(config.TRIG_RESET)
 
     # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~#
     # VAS Routine
@@ -426,9 +487,9 @@ for this_trial in main_loop:
     event.clearEvents(eventType="keyboard")
 
     def trigger_vas_onset():
-        if trigger_port and trigger_port.is_open:
-            trigger_port.write(config.TRIG_VAS_ON)
+        flip_monitor.send(config.TRIG_VAS_ON)
 
+    frame_profiler.begin("VAS", trial=current_loop_index + 1)
     win.callOnFlip(trigger_vas_onset)
     vas_start_time = core.monotonicClock.getTime()
 
@@ -537,8 +598,7 @@ for this_trial in main_loop:
     vas_end_time = core.monotonicClock.getTime()
     thisExp.addData("vas_end_time", vas_end_time)
     thisExp.addData("vas_actual_duration", round(vas_end_time - vas_start_time, 4))
-    if trigger_port and trigger_port.is_open:
-        trigger_port.write(config.TRIG_RESET)
+    trigger_bus.send(config.TRIG_RESET)
 
     # --- Append data to collector for final saving ---
     exp_data_collector["trial_number"].append(current_loop_index + 1)
@@ -556,11 +616,18 @@ for this_trial in main_loop:
     exp_data_collector["pain_q_end_time"].append(pain_q_end_time)
     exp_data_collector["vas_start_time"].append(vas_start_time)
     exp_data_collector["vas_end_time"].append(vas_end_time)
-    exp_data_collector["temperature_traces"].append(temp_array.tolist())
-    exp_data_collector["temperature_times"].append(temp_sample_times)
+    exp_data_collector["temperature_sample_range"].append(temp_trace_range)
+    exp_data_collector["ramp_metrics"].append(ramp_metrics)
 
     thisExp.nextEntry()
 
+    if watchdog.tripped:
+        logger.error(
+            "Ending the run after trial %s: the thermode watchdog tripped.",
+            current_loop_index + 1,
+        )
+        break
+
 
 # =================================================================
 # 3. END EXPERIMENT & SAVE DATA
@@ -575,12 +642,27 @@ if rcs:
     except Exception as e:
         logger.error("EEG stop/close error: %s", e)
 
-if trigger_port and trigger_port.is_open:
-    trigger_port.write(config.TRIG_RESET)
-    trigger_port.close()
-    logger.info("Trigger port closed.")
+watchdog.stop()
+thermode.stop_acquisition()
+trace_recorder.close()
+logger.info("Temperature trace saved to %s", trace_path)
+
+thermode.disable_profiles()
+
+trigger_scheduler.close()
+trigger_bus.close()
+logger.info("Trigger port closed.")
 
+dm.fill_temperature_traces(exp_data_collector, *load_temp_trace(trace_path))
 dm.save_all_data(exp_info, exp_name, exp_data_collector, _thisDir)
+dm.save_latency_report(exp_info, exp_name, thermode.latency_report(), _thisDir)
+dm.save_trigger_log(exp_info, exp_name, trigger_bus.write_log(), _thisDir)
+dm.save_trigger_jitter(
+    exp_info, exp_name, flip_monitor.records(), flip_monitor.stats(), _thisDir
+)
+dm.save_frame_timing(
+    exp_info, exp_name, frame_profiler.records(), frame_profiler.summary(), _thisDir
+)
 
 end_msg = visual.TextStim(
     win, text="Merci! L'exp\u00e9rience est termin\u00e9e.", height=0.07, color="white"
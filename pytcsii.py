@@ -1,5 +1,19 @@
+import atexit
+import collections
+import functools
+import math
+import mmap
+import os
+import queue
+import re
 import serial
+import shutil
+import struct
+import threading
 import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal, ROUND_HALF_UP
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -60,51 +74,651 @@ es for neutral and area 1 to 5 in 1/100 degrees
 
 """
 
+ZONE_LABELS = ['neutral', 'z1', 'z2', 'z3', 'z4', 'z5']
+
+_fixed_point_lut = {} # (value, scale, width) -> encoded field
+_FIXED_POINT_LUT_MAX = 4096
+
+
+def encode_fixed(value, scale, width):
+    """Encode a value as a fixed-width integer field for the TCSII
+
+    The value is converted to units of 1/``scale`` (10 for 1/10 degrees, 100
+    for 1/100 degrees, 1 for ms) and rounded half up from its shortest decimal
+    representation, so 44.3 always gives 443 and 10.333333333333334 gives 103
+    whatever the float error. Results are kept in a lookup table, so encoding
+    the known temperatures and rates of an experiment is a dict access.
+
+    Args:
+        value (float): Value in degrees, degrees/s or ms
+        scale (int): Units per value unit
+        width (int): Number of digits of the field
+
+    Returns:
+        str: zero-padded field of exactly ``width`` digits
+    """
+    key = (value, scale, width)
+    field = _fixed_point_lut.get(key)
+    if field is None:
+        units = int((Decimal(repr(float(value))) * scale).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+        if units < 0 or units >= 10 ** width:
+            raise ValueError(f'{value} does not fit in {width} digits at 1/{scale} resolution')
+        field = str(units).zfill(width)
+        if len(_fixed_point_lut) < _FIXED_POINT_LUT_MAX:
+            _fixed_point_lut[key] = field
+    return field
+
+
+def encode_profile(segments, start_temp, areas='11111'):
+    """Encode a user-defined temperature profile command ('Uw')
+
+    Each segment ramps linearly from the end of the previous one. Segment
+    durations are sent in 10 ms units ('001' to '999'), so longer segments are
+    split into equal pieces with interpolated temperatures. Durations are
+    rounded on the cumulative time, so rounding does not drift over the profile.
+
+    Args:
+        segments (list of tuple): (duration_ms, end_temp) of each segment
+        start_temp (float): Temperature at the start of the profile (the baseline)
+        areas (str, optional): Areas the profile is written to. Defaults to '11111'.
+
+    Returns:
+        str: the 'Uw' command
+    """
+    fields = []
+    elapsed_ms = 0
+    prev_temp = start_temp
+    for duration_ms, temp in segments:
+        start_tick = round(elapsed_ms / 10)
+        elapsed_ms += duration_ms
+        ticks = round(elapsed_ms / 10) - start_tick
+        if ticks <= 0:
+            if temp == prev_temp:
+                continue # Empty hold
+            ticks = 1 # Fastest possible step
+        n_pieces = math.ceil(ticks / 999)
+        for k in range(1, n_pieces + 1):
+            piece = ticks * k // n_pieces - ticks * (k - 1) // n_pieces
+            piece_temp = prev_temp + (temp - prev_temp) * k / n_pieces
+            fields.append(encode_fixed(piece, 1, 3) + encode_fixed(piece_temp, 10, 3))
+        prev_temp = temp
+    if len(fields) > 999:
+        raise ValueError('profile has more than 999 segments')
+    return 'Uw' + areas + encode_fixed(len(fields), 1, 3) + ''.join(fields)
+
+
+def parse_temp_block(buf, n_fields=6, scale=10, raw=False):
+    """Parse a block of temperature replies in one vectorized pass
+
+    Works directly on the received bytes, e.g. several 'E' replies or a chunk
+    of the 'Ob' stream: b'320+321+322+323+324+325\\r\\n330+...'. Lines that do
+    not hold exactly ``n_fields`` '+'-separated integers are masked instead of
+    raising, so one corrupted reply does not discard a whole trace. Empty
+    lines are skipped and a trailing line without terminator is parsed too.
+
+    Args:
+        buf (bytes or bytearray): Raw bytes read from the port
+        n_fields (int, optional): Integers expected per line. Defaults to 6 (neutral + 5 zones).
+        scale (int, optional): Units per degree (10 for 'E', 100 for 'Oe'). Defaults to 10.
+        raw (bool, optional): Return the undivided int16 values (0 on masked lines). Defaults to False.
+
+    Returns:
+        tuple: (values, valid) with values of shape (n_lines, n_fields), float32 degrees
+        (NaN on masked lines) or int16 if ``raw``, and the boolean mask of well-formed lines
+    """
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if b.size and b[-1] not in (10, 13):
+        b = np.append(b, np.uint8(10)) # Terminate the last line
+    eol = (b == 10) | (b == 13)
+    bound = eol | (b == 43) # Fields end on '+' or end of line
+    digit = (b >= 48) & (b <= 57)
+
+    # Line and field index of every byte (a terminator belongs to what it ends)
+    line_id = np.cumsum(eol) - eol
+    tok_id = np.cumsum(bound) - bound
+    n_lines = int(eol.sum())
+    bound_pos = np.flatnonzero(bound)
+    tok_line = line_id[bound_pos]
+
+    # Field values: each digit weighted by its position from the end of its field
+    idx = np.flatnonzero(digit)
+    power = bound_pos[tok_id[idx]] - idx - 1
+    values = np.rint(np.bincount(tok_id[idx], weights=(b[idx] - 48) * 10.0 ** power,
+                                 minlength=bound_pos.size)).astype(np.int64)
+
+    # A field is valid if it is 1-4 digits (the widest the device sends, 'Oe'
+    # in 1/100 degrees) and nothing else; wider ones would not fit in int16
+    tok_len = np.diff(bound_pos, prepend=-1) - 1
+    tok_digits = np.bincount(tok_id[idx], minlength=bound_pos.size)
+    tok_ok = (tok_len > 0) & (tok_len <= 4) & (tok_digits == tok_len)
+
+    tokens_per_line = np.bincount(tok_line, minlength=n_lines)
+    bad_per_line = np.bincount(tok_line, weights=~tok_ok, minlength=n_lines)
+    line_ok = (tokens_per_line == n_fields) & (bad_per_line == 0)
+    nonempty = np.bincount(line_id[~eol], minlength=n_lines) > 0
+
+    field = np.arange(bound_pos.size) - (np.cumsum(tokens_per_line) - tokens_per_line)[tok_line]
+    keep = line_ok[tok_line]
+    out = np.zeros((n_lines, n_fields), dtype=np.int16)
+    out[tok_line[keep], field[keep]] = values[keep]
+    out, valid = out[nonempty], line_ok[nonempty]
+    if raw:
+        return out, valid
+    temps = out.astype(np.float32) / scale
+    temps[~valid] = np.nan
+    return temps, valid
+
+
+def parse_temp_buttons_block(buf):
+    """Parse 'Og' replies (temperatures followed by the 'stim'/'resp' buttons)
+
+    b'320+321+322+323+324+325+10\r\n' is neutral + 5 zones in 1/10 degrees
+    and the two button digits ('10': 'stim' pressed, 'resp' released).
+
+    Args:
+        buf (bytes or bytearray): Raw bytes read from the port
+
+    Returns:
+        tuple: (temps, buttons, valid) with float32 temperatures of shape (n_lines, 6)
+        (NaN on masked lines), uint8 button states of shape (n_lines, 2) as
+        ('stim', 'resp') with 1 = pressed, and the boolean mask of well-formed lines
+    """
+    n_zones = len(ZONE_LABELS)
+    raw, valid = parse_temp_block(buf, n_fields=n_zones + 1, raw=True)
+    temps = raw[:, :n_zones].astype(np.float32) / 10
+    temps[~valid] = np.nan
+    code = raw[:, n_zones]
+    valid = valid & (code % 10 <= 1) & (code // 10 <= 1)
+    buttons = np.stack([code // 10, code % 10], axis=1).astype(np.uint8)
+    buttons[~valid] = 0
+    return temps, buttons, valid
+
+
+class latency_histogram():
+    def __init__(self, lowest_s=1e-6, highest_s=10.0, precision=0.01):
+        """HDR-style latency histogram with fixed memory and relative precision
+
+        Buckets grow geometrically by ``1 + precision``, so every recorded value
+        is reported within that relative error whatever its magnitude. Values
+        outside [lowest_s, highest_s] are clamped to the first/last bucket.
+
+        Args:
+            lowest_s (float, optional): Smallest resolved latency. Defaults to 1 µs.
+            highest_s (float, optional): Largest resolved latency. Defaults to 10 s.
+            precision (float, optional): Relative bucket width. Defaults to 0.01.
+        """
+        self.lowest_s = lowest_s
+        self._log_base = math.log1p(precision)
+        self.counts = np.zeros(int(math.log(highest_s / lowest_s) / self._log_base) + 2, dtype=np.int64)
+        self.n = 0
+        self.total_s = 0.0
+        self.min_s = math.inf
+        self.max_s = 0.0
+
+    def record(self, latency_s):
+        if latency_s > self.lowest_s:
+            idx = min(int(math.log(latency_s / self.lowest_s) / self._log_base) + 1, self.counts.size - 1)
+        else:
+            idx = 0
+        self.counts[idx] += 1
+        self.n += 1
+        self.total_s += latency_s
+        self.min_s = min(self.min_s, latency_s)
+        self.max_s = max(self.max_s, latency_s)
+
+    def percentile(self, q):
+        """Latency in s below which q % of the recorded values fall (bucket upper edge)"""
+        if not self.n:
+            return math.nan
+        idx = int(np.searchsorted(np.cumsum(self.counts), math.ceil(q / 100 * self.n)))
+        return min(self.lowest_s * math.exp(idx * self._log_base), self.max_s)
+
+
+class latency_recorder():
+    def __init__(self):
+        """Latency histograms per thermode command type"""
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def record(self, label, latency_s):
+        with self._lock:
+            hist = self.histograms.get(label)
+            if hist is None:
+                hist = self.histograms[label] = latency_histogram()
+            hist.record(latency_s)
+
+    def report(self, percentiles=(50, 90, 99, 99.9)):
+        """Summary rows (one dict per command type, times in ms)"""
+        rows = []
+        with self._lock:
+            for label, hist in sorted(self.histograms.items()):
+                row = {'command': label, 'n': hist.n,
+                       'min_ms': hist.min_s * 1000, 'mean_ms': hist.total_s / hist.n * 1000}
+                for q in percentiles:
+                    row[f'p{q:g}_ms'] = hist.percentile(q) * 1000
+                row['max_ms'] = hist.max_s * 1000
+                rows.append(row)
+        return rows
+
+
+def _command_label(command):
+    """Command type used to group latencies ('C', 'Om', 'Uw', ...)"""
+    command = command.decode(errors='replace') if isinstance(command, (bytes, bytearray)) else command
+    return command[:2] if command[:1] in ('O', 'U', 'X') else command[:1]
+
+
+class temp_ring_buffer():
+    def __init__(self, capacity=8192, n_zones=6, buttons=False):
+        """Preallocated ring buffer of timestamped zone temperatures
+
+        A single acquisition thread writes into the buffer while any other
+        thread may take snapshots without locking. The write counter is only
+        advanced once a sample is fully stored, and samples overwritten while a
+        snapshot is being copied are dropped from that snapshot. The slot
+        being written counts as overwritten, so a snapshot holds at most
+        ``capacity - 1`` samples.
+
+        Args:
+            capacity (int, optional): Number of samples kept. Defaults to 8192.
+            n_zones (int, optional): Temperatures per sample. Defaults to 6 (neutral + 5 zones).
+            buttons (bool, optional): Also store the 'stim'/'resp' button state of
+                each sample (as read with 'Og'). Defaults to False.
+        """
+        self.capacity = int(capacity)
+        self.n_zones = n_zones
+        self.times = np.full(self.capacity, np.nan)
+        self.temps = np.full((self.capacity, n_zones), np.nan, dtype=np.float32)
+        self.buttons = np.zeros((self.capacity, 2), dtype=np.uint8) if buttons else None
+        self.count = 0 # Total number of samples written since creation
+
+    def append(self, t, temps, buttons=None):
+        """Store one sample (called from the writer thread only)"""
+        i = self.count % self.capacity
+        self.times[i] = t
+        self.temps[i] = temps
+        if self.buttons is not None and buttons is not None:
+            self.buttons[i] = buttons
+        self.count += 1 # Publish the sample
+
+    def snapshot(self, since=None, n=None, with_buttons=False, with_start=False):
+        """Copy the most recent samples
+
+        Args:
+            since (int, optional): Value of ``count`` to start from (e.g. taken at stimulus onset).
+            n (int, optional): Maximum number of most recent samples to return.
+            with_buttons (bool, optional): Also return the button states. Defaults to False.
+            with_start (bool, optional): Also return the ``count`` value of the first
+                returned sample, which is later than ``since`` if older samples were
+                already overwritten. Defaults to False.
+
+        Returns:
+            tuple: (times, temps) arrays of shape (k,) and (k, n_zones), followed
+            by the (k, 2) button states if ``with_buttons`` and the start if ``with_start``
+        """
+        if with_buttons and self.buttons is None:
+            raise ValueError('buffer was created without buttons')
+        end = self.count
+        start = max(end - self.capacity, 0)
+        if since is not None:
+            start = max(start, since)
+        if n is not None:
+            start = max(start, end - n)
+        idx = np.arange(start, end) % self.capacity
+        times = self.times[idx]
+        temps = self.temps[idx]
+        buttons = self.buttons[idx] if with_buttons else None
+
+        # Drop samples that the writer overwrote while they were being copied,
+        # including the slot it may be writing now (stored before count moves)
+        overwritten = self.count + 1 - self.capacity - start
+        if overwritten > 0:
+            times, temps = times[overwritten:], temps[overwritten:]
+            if with_buttons:
+                buttons = buttons[overwritten:]
+            start += overwritten
+        out = (times, temps) + ((buttons,) if with_buttons else ())
+        return out + (start,) if with_start else out
+
+
+class temp_stream_parser():
+    def __init__(self):
+        """Incremental parser for the temperature lines pushed by the TCSII
+
+        Bytes can be fed in arbitrary chunks; an incomplete trailing line is
+        kept until the rest of it arrives.
+        """
+        self._pending = bytearray()
+
+    def feed(self, data, rejected=None):
+        """Add received bytes and parse every completed line
+
+        Args:
+            data (bytes): Bytes read from the port
+            rejected (list, optional): If given, the other non-empty lines (e.g.
+                replies to queries) are appended to it as bytes.
+
+        Returns:
+            np.ndarray: (n, 6) temperatures in degrees for the well-formed lines
+        """
+        self._pending += data
+        end = max(self._pending.rfind(b'\n'), self._pending.rfind(b'\r'))
+        if end < 0:
+            return np.empty((0, len(ZONE_LABELS)), dtype=np.float32)
+        block = bytes(self._pending[:end + 1])
+        temps, valid = parse_temp_block(block)
+        del self._pending[:end + 1]
+        if rejected is not None and not valid.all():
+            lines = [line for line in re.split(rb'[\r\n]+', block) if line]
+            rejected.extend(line for line, ok in zip(lines, valid) if not ok)
+        return temps[valid]
+
+
+class _port_request():
+    """Command handed to the acquisition thread by :meth:`tcsii_serial.query`"""
+    __slots__ = ('command', 'reply', 'done', 'sent_at')
+
+    def __init__(self, command):
+        self.command = command
+        self.reply = b''
+        self.done = threading.Event()
+        self.sent_at = None
+
+
+_TRACE_MAGIC = b'TCSTRACE'
+_TRACE_HEADER_BYTES = 64 # magic, n_zones (uint32 at 8), sample count (uint64 at 16)
+
+
+def _trace_dtype(n_zones):
+    return np.dtype([('t', '<f8'), ('temps', '<f4', (n_zones,))])
+
+
+class temp_trace_recorder():
+    def __init__(self, path, capacity=65536, n_zones=6, flush_every=100):
+        """Append timestamped temperatures to a memory-mapped file
+
+        Samples are written straight into a preallocated file mapping, so the
+        recorded trace does not grow the process memory and every sample is in
+        the OS page cache as soon as it is appended: a crash of the experiment
+        loses nothing. The file doubles in size when full. Every ``flush_every``
+        samples only the newly written pages are flushed to disk, which bounds
+        the cost of each flush. The sample count in the header is updated after
+        each sample, so :func:`load_temp_trace` never reads a partial one.
+
+        Can be passed to :meth:`tcsii_serial.start_acquisition` as a sink.
+
+        Args:
+            path (str): Output file (overwritten)
+            capacity (int, optional): Initial number of samples. Defaults to 65536.
+            n_zones (int, optional): Temperatures per sample. Defaults to 6 (neutral + 5 zones).
+            flush_every (int, optional): Samples between disk flushes. Defaults to 100.
+        """
+        self.path = path
+        self.n_zones = n_zones
+        self.dtype = _trace_dtype(n_zones)
+        self.flush_every = flush_every
+        self.count = 0 # Samples written
+        self._flushed = 0 # Samples already flushed to disk
+        self._file = open(path, 'w+b')
+        self._map(max(int(capacity), 1))
+        self._mm[:8] = _TRACE_MAGIC
+        struct.pack_into('<I4xQ', self._mm, 8, n_zones, 0)
+
+    def _map(self, capacity):
+        self.capacity = capacity
+        self._file.truncate(_TRACE_HEADER_BYTES + capacity * self.dtype.itemsize)
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self._records = np.frombuffer(self._mm, dtype=self.dtype, count=capacity,
+                                      offset=_TRACE_HEADER_BYTES)
+
+    def _grow(self):
+        self.flush()
+        del self._records # Release the buffer export so the map can be closed
+        self._mm.close()
+        self._map(self.capacity * 2)
+
+    def append(self, t, temps):
+        """Write one sample (called from a single writer thread)"""
+        if self.count == self.capacity:
+            self._grow()
+        record = self._records[self.count]
+        record['t'] = t
+        record['temps'] = temps
+        self.count += 1
+        struct.pack_into('<Q', self._mm, 16, self.count) # Publish the sample
+        if self.count - self._flushed >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Flush the samples written since the last flush and the header"""
+        start = _TRACE_HEADER_BYTES + self._flushed * self.dtype.itemsize
+        start -= start % mmap.ALLOCATIONGRANULARITY
+        end = _TRACE_HEADER_BYTES + self.count * self.dtype.itemsize
+        if end > start:
+            self._mm.flush(start, end - start)
+        self._mm.flush(0, _TRACE_HEADER_BYTES)
+        self._flushed = self.count
+
+    def close(self):
+        """Flush, trim the file to the recorded samples and close it"""
+        if self._file.closed:
+            return
+        self.flush()
+        del self._records
+        self._mm.close()
+        self._file.truncate(_TRACE_HEADER_BYTES + self.count * self.dtype.itemsize)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_temp_trace(path):
+    """Read a file written by :class:`temp_trace_recorder` (also after a crash)
+
+    Returns:
+        tuple: (times, temps) arrays of shape (n,) and (n, n_zones)
+    """
+    with open(path, 'rb') as f:
+        header = f.read(_TRACE_HEADER_BYTES)
+    if len(header) < _TRACE_HEADER_BYTES or header[:8] != _TRACE_MAGIC:
+        raise ValueError('%s is not a temperature trace file' % path)
+    n_zones, count = struct.unpack_from('<I4xQ', header, 8)
+    records = np.fromfile(path, dtype=_trace_dtype(n_zones), count=count, offset=_TRACE_HEADER_BYTES)
+    return records['t'].copy(), records['temps'].copy()
+
+
+class ramp_fidelity_tracker():
+    def __init__(self, tolerance=0.5):
+        """Acquisition sink measuring how well each stimulation follows its programmed ramp
+
+        Metrics are updated sample by sample as the acquisition thread delivers them
+        (pass the tracker in ``sinks`` of :meth:`tcsii_serial.start_acquisition`), so a
+        trial's metrics are ready as soon as it ends, without re-reading the trace.
+
+        Args:
+            tolerance (float, optional): Distance in degrees from the target (baseline)
+                at which the target (baseline) counts as reached. Defaults to 0.5.
+        """
+        self.tolerance = tolerance
+        self._lock = threading.Lock()
+        self._trial = None
+
+    def arm(self, onset, target, baseline, surfaces, plateau_end_s, rise_rate=None, return_rate=None):
+        """Start measuring a stimulation
+
+        Args:
+            onset (float): Stimulation onset, in the acquisition clock
+            target (float): Programmed target temperature
+            baseline (float): Temperature the probe returns to
+            surfaces (list): Stimulated zones (1 to 5)
+            plateau_end_s (float): Time from onset at which the return starts (rise + plateau)
+            rise_rate (float, optional): Programmed rise rate in °C/s, reported next to the measured one
+            return_rate (float, optional): Programmed return rate in °C/s
+        """
+        direction = 1.0 if target >= baseline else -1.0
+        trial = {
+            'onset': onset, 'target': target, 'baseline': baseline, 'direction': direction,
+            'zones': np.asarray(surfaces, dtype=int), 'plateau_end': onset + plateau_end_s,
+            'rise_rate': rise_rate, 'return_rate': return_rate,
+            'phase': 'rise', 'start_temp': None, 'reached_at': None, 'return_start_temp': None,
+            'returned_at': None, 'peak': -np.inf,
+            # Running plateau statistics (Welford) and squared deviations of the stimulated zones
+            'n': 0, 'mean': 0.0, 'm2': 0.0, 'sq_dev': 0.0, 'n_dev': 0, 'max_dev': 0.0,
+        }
+        with self._lock:
+            self._trial = trial
+
+    def append(self, t, temps):
+        with self._lock:
+            trial = self._trial
+            if trial is None or t < trial['onset'] or trial['phase'] == 'done':
+                return
+            zone_temps = np.asarray(temps, dtype=float)[trial['zones']]
+            x = float(zone_temps.mean())
+            direction = trial['direction']
+            if trial['start_temp'] is None:
+                trial['start_temp'] = x
+            trial['peak'] = max(trial['peak'], direction * (x - trial['target']))
+
+            if trial['phase'] == 'rise' and direction * (x - trial['target']) >= -self.tolerance:
+                trial['phase'] = 'plateau'
+                trial['reached_at'] = t
+            if trial['phase'] in ('rise', 'plateau') and t >= trial['plateau_end']:
+                trial['phase'] = 'return'
+                trial['return_start_temp'] = x
+            if trial['phase'] == 'plateau':
+                trial['n'] += 1
+                delta = x - trial['mean']
+                trial['mean'] += delta / trial['n']
+                trial['m2'] += delta * (x - trial['mean'])
+                dev = zone_temps - trial['target']
+                trial['sq_dev'] += float(dev @ dev)
+                trial['n_dev'] += dev.size
+                trial['max_dev'] = max(trial['max_dev'], float(np.abs(dev).max()))
+            elif trial['phase'] == 'return' and direction * (x - trial['baseline']) <= self.tolerance:
+                trial['phase'] = 'done'
+                trial['returned_at'] = t
+
+    def metrics(self):
+        """Metrics of the armed stimulation so far
+
+        Returns:
+            dict: 'reached_target', 'time_to_target_s', 'rise_rate' (measured °C/s),
+                'rise_rate_programmed', 'overshoot' (beyond the target, °C),
+                'plateau_mean', 'plateau_sd', 'plateau_rms_dev' and 'plateau_max_dev'
+                (stimulated zones vs target), 'return_time_s' (from plateau end to
+                baseline), 'return_rate' and 'return_rate_programmed'. NaN when not reached.
+        """
+        with self._lock:
+            trial = self._trial
+            if trial is None:
+                return {}
+            trial = dict(trial)
+        nan = float('nan')
+        reached = trial['reached_at'] is not None
+        time_to_target = trial['reached_at'] - trial['onset'] if reached else nan
+        returned = trial['returned_at'] is not None
+        return_time = trial['returned_at'] - trial['plateau_end'] if returned else nan
+        # Rates over the part of the ramp until the tolerance band
+        rise_span = abs(trial['target'] - self.tolerance * trial['direction'] - trial['start_temp']) if reached else nan
+        return_span = (abs(trial['return_start_temp'] - trial['baseline'] - self.tolerance * trial['direction'])
+                       if returned else nan)
+        return {
+            'reached_target': reached,
+            'time_to_target_s': time_to_target,
+            'rise_rate': rise_span / time_to_target if reached and time_to_target > 0 else nan,
+            'rise_rate_programmed': nan if trial['rise_rate'] is None else trial['rise_rate'],
+            'overshoot': max(trial['peak'], 0.0) if trial['peak'] > -np.inf else nan,
+            'plateau_mean': trial['mean'] if trial['n'] else nan,
+            'plateau_sd': math.sqrt(trial['m2'] / (trial['n'] - 1)) if trial['n'] > 1 else nan,
+            'plateau_rms_dev': math.sqrt(trial['sq_dev'] / trial['n_dev']) if trial['n_dev'] else nan,
+            'plateau_max_dev': trial['max_dev'] if trial['n_dev'] else nan,
+            'return_time_s': return_time,
+            'return_rate': return_span / return_time if returned and return_time > 0 else nan,
+            'return_rate_programmed': nan if trial['return_rate'] is None else trial['return_rate'],
+        }
+
+    def finish(self):
+        """Stop measuring and return the :meth:`metrics` of the stimulation"""
+        metrics = self.metrics()
+        with self._lock:
+            self._trial = None
+        return metrics
+
 
 class tcsii_serial():
     def __init__(self, port, baseline=30, surfaces=0, max_temp=50, beep=False, trigger_in=True,
-                 temp_profile=False):
+                 temp_profile=False, hires=False, record_latency=False):
         """Connect to TSCII and set baseline and max temperature
 
         Args:
             port (str): Serial port name
             baseline (int, optional): Baseline temperature. Defaults to 30.
             surfaces (int or list): Surfaces to use. 0 for all surfaces. Defaults to 0.
+            hires (bool, optional): Send target and rates with the 1/100 degree
+                'Ot'/'Ov'/'Or' commands instead of 'C'/'V'/'R'. Defaults to False.
+            record_latency (bool, optional): Keep per-command latency histograms in
+                ``latency`` (write completion, or round trip for queries). Defaults to False.
         """        
         self.baseline = baseline # Baseline temperature
         self.max_temp = max_temp # Maximum temperature
+        self.hires = hires # 1/100 degree resolution for stimulation parameters
+        self._write_lock = threading.Lock() # Serialise writes from the acquisition thread and the caller
+        self._read_lock = threading.Lock() # Keep each query's write and reply read together (e.g. watchdog polls)
+        self._acq_thread = None
+        self._acq_stop = threading.Event()
+        self.acquisition_buffer = None
+        self.acquisition_mode = None
+        self._acq_requests = queue.Queue() # Commands sent by the acquisition thread on behalf of query()
+        self._sent_params = {} # Last parameter commands written, by parameter name
+        self.latency = latency_recorder() if record_latency else None
 
         if baseline > 45 or baseline < 30: # Check if baseline is in range
             Warning('Baseline temperature is out of 30-45 range')
         self.port = serial.Serial(port, baudrate=115200, timeout=0.1)  # Open port
-        self.port.write(('N' + self.format_temp(baseline)).encode()) # Set baseline on all surfaces
+        self._send('N' + self.format_temp(baseline)) # Set baseline on all surfaces
         # Set max temperature
-        self.port.write(('Om' + self.format_temp(self.max_temp)).encode()) # Set max temperature
-        self.port.write('F'.encode()) # Stop constant data stream
+        self._send('Om' + self.format_temp(self.max_temp)) # Set max temperature
+        self._send('F') # Stop constant data stream
         self.stim_set = False # Indicate that no stimulation parameters have been set.
         self.beep = beep # Beep on stim start
         self.trigger_in = trigger_in # Lauch on trigger in
         self.temp_profile = temp_profile
         if self.trigger_in:
-            self.port.write('Ose'.encode()) # Enable trigger in
+            self._send('Ose') # Enable trigger in
         else:
-            self.port.write('Osd'.encode()) # Disable trigger in
+            self._send('Osd') # Disable trigger in
         if self.temp_profile:
-            self.port.write('Ue11111'.encode())
+            self._send('Ue11111')
+        else:
+            self._send('Ue00000') # Profiles left enabled by an interrupted run would override 'C'/'V'/'R'/'D'
         if self.beep:
-            self.port.write('Z010100'.encode())
+            self._send('Z010100')
 
     def format_temp(self, temp, zero_fill_len=3):
         """Format temperature in 1/10 degrees
 
         Args:
-            temp (int): temperature in degrees Celsius
+            temp (float): temperature in degrees Celsius
 
         Returns:
             str: temperature in 1/10 degrees as a str
         """
-        temp = str(temp*10).zfill(zero_fill_len)
-        return temp
+        return encode_fixed(temp, 10, zero_fill_len)
+
+    def format_temp_hires(self, temp, zero_fill_len=4):
+        """Format temperature (or rate) in 1/100 degrees for the 'Ot'/'Ov'/'Or' commands
+
+        Args:
+            temp (float): temperature in degrees Celsius
+
+        Returns:
+            str: temperature in 1/100 degrees as a str
+        """
+        return encode_fixed(temp, 100, zero_fill_len)
 
     def format_ms(self, ms, zero_fill_len=5):
         """Format ms with leading zeros
@@ -115,40 +729,115 @@ class tcsii_serial():
         Returns:
             str: ms formatted with leading zeros
         """
-        ms = str(ms).zfill(zero_fill_len)
-        return ms
+        return encode_fixed(ms, 1, zero_fill_len)
     
 
-    
+    def _send(self, command, label=None):
+        """Write a command to the TCSII (thread safe)
+
+        Args:
+            command (str or bytes): Command to write
+            label (str, optional): Latency histogram to record the write completion
+                time in when latency recording is on. Defaults to the command type.
+        """
+        if isinstance(command, str):
+            command = command.encode()
+        with self._write_lock:
+            if self.latency is None:
+                self.port.write(command)
+                return
+            t0 = time.perf_counter()
+            self.port.write(command)
+            self.latency.record(label or _command_label(command), time.perf_counter() - t0)
+
+    def _query(self, command):
+        """Send a command and read its reply line, recording the round trip (thread safe)"""
+        with self._read_lock:
+            if self.latency is None:
+                self._send(command)
+                return self.port.readline()
+            t0 = time.perf_counter()
+            with self._write_lock:
+                self.port.write(command.encode() if isinstance(command, str) else command)
+            reply = self.port.readline()
+            self.latency.record(_command_label(command), time.perf_counter() - t0)
+            return reply
+
+    def query(self, command, timeout=0.5):
+        """Send a command and return its reply line, also while acquiring
+
+        During an acquisition the acquisition thread owns the replies, so the
+        command is handed to it: it is sent between two polls (or between two
+        reads of the pushed stream) and its reply is returned here. In 'stream'
+        mode only replies that are not temperature lines can be told apart
+        (e.g. 'Q', 'K'), so read temperatures from the buffer instead.
+
+        Args:
+            command (str or bytes): Valid command from TSCII manual
+            timeout (float, optional): Seconds to wait for the reply while acquiring. Defaults to 0.5.
+
+        Returns:
+            bytes: the reply line (b'' if the device did not answer)
+        """
+        if not self.acquiring:
+            return self._query(command)
+        request = _port_request(command)
+        self._acq_requests.put(request)
+        if not request.done.wait(timeout):
+            raise TimeoutError('no reply to %r within %s s' % (command, timeout))
+        return request.reply
+
+    def _next_request(self):
+        try:
+            return self._acq_requests.get_nowait()
+        except queue.Empty:
+            return None
+
+    def reset_latency(self):
+        """Restart the latency histograms (e.g. for a new run on a thermode kept open by the broker)"""
+        self.latency = latency_recorder()
+
+    def latency_report(self, percentiles=(50, 90, 99, 99.9)):
+        """Latency summary rows, see :meth:`latency_recorder.report` ([] when recording is off)
+
+        Plain dicts, so the report can also be fetched through the hardware broker.
+        """
+        return self.latency.report(percentiles) if self.latency is not None else []
+
+    def abort(self):
+        """Abort the current stimulation or follow mode and return to neutral ('A')"""
+        self._send('A')
+
     def custom_command(self, command):
         """Send a custom command to TSCII
 
         Args:
             command (str): Valid command from TSCII manual
         """        
-        self.port.write(command.encode())
+        self._sent_params.clear() # The command may change parameters behind the cache
+        self._send(command)
     
 
     def reset(self):
         # Reset stimulator (turn off an on)
         print('Resetting stimulator')
-        self.port.write('Oc'.encode()) # Reset stimulator
+        self._sent_params.clear()
+        self._send('Oc') # Reset stimulator
 
     def set_baseline(self, baseline):
         # Set baseline temperature
         if baseline > 45 or baseline < 30: # Check if baseline is in range
             Warning('Baseline temperature is out of 30-45 range')
         self.baseline=baseline
-        self.port.write(('N' + self.format_temp(baseline)).encode()) # Set baseline on all surfaces
+        self._send('N' + self.format_temp(baseline)) # Set baseline on all surfaces
 
     def print_temp(self):
         """Print current temperature"""        
         self.port.flush()
-        self.port.write('E'.encode()) # Display current temperature
-        print(self.port.read_until(str('\n').encode('utf-8')).decode()) # print temperature
+        print(self._query('E').decode()) # Display current temperature
 
     def set_stim(self, target, rise_rate, return_rate, dur_ms=None, dur_mode='fixed_stim', trigger_code=255, trigger_dur_ms=10,
-                 surfaces=0):
+                 surfaces=0, force=False):
         """Set the stimulation parameter for the TCSII
 
         Args:
@@ -165,126 +854,434 @@ class tcsii_serial():
             trigger_code (int, optional): trigger code. Defaults to 255.
             trigger_dur_ms (int, optional): trigger duration. Defaults to 10.
             beep (bool, optional): send beep on success. Defaults to False.
+            force (bool, optional): resend every parameter, even those unchanged since
+                the last call. Only the changed ones are sent otherwise. Defaults to False.
         """        
 
-        # Store parameters
-        self.stim_set = True
-        self.stim_target_temp = target
-        self.stim_rise_rate = rise_rate
-        self.stim_return_rate = return_rate
-        self.stim_trigger_code = trigger_code
-        self.stim_strigger_dur_ms = trigger_dur_ms
+        self.load_stim(self.compile_stim(target, rise_rate, return_rate, dur_ms=dur_ms, dur_mode=dur_mode,
+                                         trigger_code=trigger_code, trigger_dur_ms=trigger_dur_ms,
+                                         surfaces=surfaces),
+                       force=force)
 
-        # Duration for rise
-        self.stim_rise_dur_ms = int((self.stim_target_temp - self.baseline) / self.stim_rise_rate * 1000)
-        self.stim_return_dur_ms = int((self.stim_target_temp - self.baseline) / self.stim_return_rate * 1000)
+    def compile_stim(self, target, rise_rate, return_rate, dur_ms=None, dur_mode='fixed_stim', trigger_code=255,
+                     trigger_dur_ms=10, surfaces=0):
+        """Encode stimulation parameters into ready-to-send commands without sending them
 
-        # Total duration including plateau
+        Takes the same arguments as :meth:`set_stim`. Durations are computed from
+        the current baseline, so compile after :meth:`set_baseline`.
 
+        Returns:
+            dict: 'params' (attributes stored on the instance by :meth:`load_stim`)
+            and 'commands' (parameter name -> encoded command bytes)
+        """
+        params = {
+            'stim_set': True,
+            'stim_target_temp': target,
+            'stim_rise_rate': rise_rate,
+            'stim_return_rate': return_rate,
+            'stim_trigger_code': trigger_code,
+            'stim_strigger_dur_ms': trigger_dur_ms,
+            'stim_profile': False,
+        }
+
+        # Duration for rise
+        params['stim_rise_dur_ms'] = int((target - self.baseline) / rise_rate * 1000)
+        params['stim_return_dur_ms'] = int((target - self.baseline) / return_rate * 1000)
 
+        # Total duration including plateau
         if dur_mode == 'fixed_plateau':
-            self.stim_duration_ms = dur_ms + self.stim_rise_dur_ms # Add rise time so that selected duration applies only to plateau
+            params['stim_duration_ms'] = dur_ms + params['stim_rise_dur_ms'] # Add rise time so that selected duration applies only to plateau
         if dur_mode == 'fixed_total':
-           self.stim_duration_ms = dur_ms - self.stim_return_dur_ms # Remove return time so total includes return time
+            params['stim_duration_ms'] = dur_ms - params['stim_return_dur_ms'] # Remove return time so total includes return time
         if dur_mode == 'fixed_stim':
-           self.stim_duration_ms = dur_ms # By default, duration is rise + plateau
-        self.duration_mode = dur_mode
-    
-
-        # Send parameters to TSCII
-        self.port.write(('C0' + self.format_temp(self.stim_target_temp)).encode()) # Set the target temp
-        self.port.write(('V0' + self.format_temp(self.stim_rise_rate, zero_fill_len=4)).encode()) # Set the rise change rate
-        self.port.write(('R0' + self.format_temp(self.stim_return_rate, zero_fill_len=4)).encode()) # Set the rise change rate
-        self.port.write(('D0' + self.format_ms(self.stim_duration_ms, zero_fill_len=5)).encode()) # Set the rise change rate
-
+            params['stim_duration_ms'] = dur_ms # By default, duration is rise + plateau
+        params['duration_mode'] = dur_mode
 
         # Set surfaces
-        self.surfaces = surfaces # Surface to use
-        if type(surfaces) == list: # Check if all surfaces are used
-            self.all_surfaces = False
-
-        else:
-            self.all_surfaces = True
-
-        # SEt the surfauces
-        if self.all_surfaces:
+        params['surfaces'] = surfaces # Surface to use
+        params['all_surfaces'] = type(surfaces) != list # Check if all surfaces are used
+        if params['all_surfaces']:
             surf_ls = '11111'
-
         else:
             surf_ls = ''
             for i in range(1, 6):
                 surf_ls += '0' if i not in surfaces else '1'
 
-        self.port.write(('S' + surf_ls).encode()) # Set the surfaces
+        # Parameters to send to TSCII
+        if self.hires:
+            commands = {
+                'target': 'Ot0' + self.format_temp_hires(target), # Set the target temp
+                'rise': 'Ov0' + self.format_temp_hires(rise_rate, zero_fill_len=5), # Set the rise change rate
+                'return': 'Or0' + self.format_temp_hires(return_rate, zero_fill_len=5), # Set the return change rate
+            }
+        else:
+            commands = {
+                'target': 'C0' + self.format_temp(target), # Set the target temp
+                'rise': 'V0' + self.format_temp(rise_rate, zero_fill_len=4), # Set the rise change rate
+                'return': 'R0' + self.format_temp(return_rate, zero_fill_len=4), # Set the return change rate
+            }
+        commands['duration'] = 'D0' + self.format_ms(params['stim_duration_ms'], zero_fill_len=5) # Set the duration
+        commands['surfaces'] = 'S' + surf_ls # Set the surfaces
+        return {'params': params, 'commands': {k: v.encode() for k, v in commands.items()}}
+
+    def compile_stim_table(self, trials):
+        """Compile the stimulation commands of a whole run ahead of time
+
+        Args:
+            trials (list of dict): :meth:`set_stim` keyword arguments for each trial
+
+        Returns:
+            list: one :meth:`compile_stim` entry per trial, to pass to :meth:`load_stim`
+        """
+        return [self.compile_stim(**trial) for trial in trials]
+
+    def compile_profile(self, target, rise_rate, return_rate, dur_ms=None, dur_mode='fixed_stim', surfaces=0):
+        """Encode a stimulation as a user-defined profile on its surfaces
+
+        Same timing as :meth:`compile_stim` (rise, plateau, return to baseline),
+        but the waveform is stored on the thermode ('Uw') instead of in the
+        global 'C'/'V'/'R'/'D' parameters. Every surface keeps its own profile,
+        so once a run is uploaded with :meth:`upload_profiles`, :meth:`load_stim`
+        only selects the surfaces ('S') unless the surface's waveform changed.
+
+        Returns:
+            dict: same layout as :meth:`compile_stim`, for :meth:`load_stim`
+        """
+        compiled = self.compile_stim(target, rise_rate, return_rate, dur_ms=dur_ms, dur_mode=dur_mode,
+                                     surfaces=surfaces)
+        params = compiled['params']
+        params['stim_profile'] = True
+        plateau_ms = max(params['stim_duration_ms'] - params['stim_rise_dur_ms'], 0)
+        segments = [(params['stim_rise_dur_ms'], target),
+                    (plateau_ms, target),
+                    (params['stim_return_dur_ms'], self.baseline)]
+        zones = range(1, 6) if params['all_surfaces'] else surfaces
+        commands = {}
+        for z in zones:
+            areas = ''.join('1' if i == z else '0' for i in range(1, 6))
+            commands['profile_z%d' % z] = encode_profile(segments, self.baseline, areas).encode()
+        commands['surfaces'] = compiled['commands']['surfaces']
+        return {'params': params, 'commands': commands}
+
+    def compile_profile_table(self, trials):
+        """:meth:`compile_stim_table` for :meth:`compile_profile` stimulations"""
+        return [self.compile_profile(**trial) for trial in trials]
+
+    def upload_profiles(self, table):
+        """Upload a run compiled with :meth:`compile_profile_table` before it starts
+
+        Writes the first profile each surface will play and enables profile
+        mode on those surfaces ('Ue'), then stages the first trial. During the
+        run, ``load_stim(table[i])`` rewrites a surface's profile only when its
+        waveform differs from the previous trial on that surface, and the
+        trial itself is fired with :meth:`trigger` (or the trigger in).
+
+        Args:
+            table (list): output of :meth:`compile_profile_table`
+
+        Returns:
+            int: number of profile rewrites the run will need after this upload
+        """
+        first = {}
+        current = {}
+        rewrites = 0
+        for compiled in table:
+            for key, cmd in compiled['commands'].items():
+                if not key.startswith('profile_'):
+                    continue
+                if key not in first:
+                    first[key] = cmd
+                elif cmd != current[key]:
+                    rewrites += 1
+                current[key] = cmd
+        used = ''.join('1' if 'profile_z%d' % z in first else '0' for z in range(1, 6))
+        self._upload(first, force=True)
+        self._send('Ue' + used)
+        self.temp_profile = True
+        if table:
+            self.load_stim(table[0])
+        return rewrites
+
+    def disable_profiles(self):
+        """Return every surface to the 'C'/'V'/'R'/'D' parameters"""
+        self._send('Ue00000')
+        self.temp_profile = False
+        self._sent_params = {k: v for k, v in self._sent_params.items() if not k.startswith('profile_')}
+
+    def load_stim(self, compiled, force=False):
+        """Upload a stimulation prepared by :meth:`compile_stim`
+
+        Only the precomputed commands that changed since the last upload are
+        written, so this can be called early (e.g. during the ITI) to stage
+        the next trial.
+        """
+        for name, value in compiled['params'].items():
+            setattr(self, name, value)
+        self._upload(compiled['commands'], force=force)
+
+    def _upload(self, commands, force=False):
+        """Send only the parameter commands that differ from the last upload, in a single write
+
+        Args:
+            commands (dict): Parameter name -> full command bytes
+            force (bool, optional): Resend every command. Defaults to False.
+
+        Returns:
+            bytes: What was actually written (b'' if nothing changed)
+        """
+        changed = [cmd for key, cmd in commands.items()
+                   if force or self._sent_params.get(key) != cmd]
+        if changed:
+            payload = b''.join(changed)
+            self._send(payload, label='stim_params')
+            self._sent_params.update(commands)
+            return payload
+        return b''
 
 
     def trigger(self):
-        self.port.write('L'.encode()) # Trigger stimulation
+        self._send('L') # Trigger stimulation
         # Beep if beep is set
         if self.beep:
-              self.port.write('Z010100'.encode())
+              self._send('Z010100')
 
     def trigger_and_save_temp(self, duration_ms=None, 
                               frequency=1000, offset_s=1):
         elapsed = 0
-        all_outs = []
+        all_outs = bytearray()
         if self.beep:
-              self.port.write('Z010100'.encode())
+              self._send('Z010100')
 
 
         if duration_ms:
             dur = duration_ms
         else:
             dur = self.stim_duration_ms
-        self.port.write('L'.encode()) # Trigger stimulation
+        self._send('L') # Trigger stimulation
 
         # Read and print temperature at 100 Hz
 
         now = time.time()
         while elapsed < (dur/1000 + offset_s):
-            self.port.write('E'.encode())
-            out = self.port.readline().decode()
-            all_outs.append(out)
+            all_outs += self._query('E')
             elapsed = time.time() - now
 
-        # Format output
-        all_outs = [i.replace('\r', '').replace('\n', '') for i in all_outs]
-        outs = np.asarray([i.split('+') for i in all_outs]).astype(float)/10
+        # Format output (malformed replies become NaN rows)
+        outs, _ = parse_temp_block(all_outs)
+        outs = outs.astype(float)
 
-        self.read_outs = pd.DataFrame(outs, columns=['neutral', 'z1', 'z2', 'z3', 'z4', 'z5'])
+        self.read_outs = pd.DataFrame(outs, columns=ZONE_LABELS)
 
 
 
     def trigger_and_save_temp_rd(self, out_file=None, duration_ms=None,
                                  offset_s=1):
         elapsed = 0
-        all_outs = []
+        all_outs = bytearray()
         if self.beep:
-              self.port.write('Z010100'.encode())
+              self._send('Z010100')
 
 
         if duration_ms:
             dur = duration_ms
         else:
             dur = self.stim_duration_ms
-        self.port.write('L'.encode()) # Trigger stimulation
+        self._send('L') # Trigger stimulation
 
         # Read and print temperature at 100 Hz
 
         now = time.time()
         while elapsed < (dur/1000 + offset_s):
-            self.port.write('E'.encode())
-            out = self.port.readline().decode()
-            all_outs.append(out)
+            all_outs += self._query('E')
             elapsed = time.time() - now
 
-        # Format output
-        all_outs = [i.replace('\r', '').replace('\n', '') for i in all_outs]
-        outs = np.asarray([i.split('+') for i in all_outs]).astype(float)/10
+        # Format output (malformed replies become NaN rows)
+        outs, _ = parse_temp_block(all_outs)
+        outs = outs.astype(float)
 
-        pd.DataFrame(outs, columns=['neutral', 'z1', 'z2', 'z3', 'z4', 'z5']).to_csv(out_file)
+        pd.DataFrame(outs, columns=ZONE_LABELS).to_csv(out_file)
 
 
+    def start_acquisition(self, capacity=8192, interval_s=0.01, clock=time.perf_counter, mode='poll',
+                          stream_period_s=0.01, buttons=False, sinks=()):
+        """Sample temperatures in a background thread
+
+        The samples are stored in ``acquisition_buffer``, a :class:`temp_ring_buffer`.
+        The caller (e.g. a render loop) only needs :meth:`temperature_snapshot`,
+        which never waits on the serial port. Other commands can still be sent
+        while acquiring; methods that read replies themselves (print_temp,
+        trigger_and_*) must not be used.
+
+        Args:
+            capacity (int, optional): Ring buffer size in samples. Defaults to 8192.
+            interval_s (float, optional): Minimum time between 'E' polls. Defaults to 0.01.
+            clock (callable, optional): Timestamp source. Defaults to time.perf_counter.
+            mode (str, optional):
+                'poll' sends 'E' and waits for each reply (samples at any time)
+                'stream' enables the device's own 100 Hz display during stimulations ('Ob')
+                and parses the pushed lines, without a round trip per sample.
+                Defaults to 'poll'.
+            stream_period_s (float, optional): Cadence of the pushed lines, used to
+                timestamp lines received in the same chunk. Defaults to 0.01.
+            buttons (bool, optional): Poll with 'Og' instead of 'E' so every sample also
+                holds the 'stim'/'resp' button state, in the same round trip ('poll' mode
+                only). See :meth:`button_presses`. Defaults to False.
+            sinks (list, optional): Objects whose ``append(t, temps)`` also receives
+                every sample from the acquisition thread, e.g. a
+                :class:`temp_trace_recorder`. Defaults to ().
+
+        Returns:
+            temp_ring_buffer: the buffer being filled
+        """
+        if self.acquiring:
+            return self.acquisition_buffer
+        if mode not in ('poll', 'stream'):
+            raise ValueError('mode must be one of: poll, stream')
+        if buttons and mode != 'poll':
+            raise ValueError("buttons are only read in 'poll' mode")
+        self.acquisition_buffer = temp_ring_buffer(capacity, buttons=buttons)
+        self.acquisition_mode = mode
+        self._acq_stop.clear()
+        self.port.reset_input_buffer()
+        if mode == 'stream':
+            self._send('Ob') # Push temperatures during stimulations
+            target, args = self._stream_loop, (self.acquisition_buffer, stream_period_s, clock, sinks)
+        else:
+            target, args = self._acquisition_loop, (self.acquisition_buffer, interval_s, clock, buttons, sinks)
+        self._acq_thread = threading.Thread(target=target, args=args,
+                                            name='tcsii-acquisition', daemon=True)
+        self._acq_thread.start()
+        return self.acquisition_buffer
+
+    def _acquisition_loop(self, buffer, interval_s, clock, buttons=False, sinks=()):
+        next_poll = time.perf_counter()
+        while not self._acq_stop.is_set():
+            request = self._next_request()
+            while request is not None:
+                request.reply = self._query(request.command)
+                request.done.set()
+                request = self._next_request()
+            if buttons:
+                line = self._query('Og')
+                t = clock()
+                temps, state, valid = parse_temp_buttons_block(line)
+            else:
+                line = self._query('E')
+                t = clock()
+                temps, valid = parse_temp_block(line)
+                state = None
+            if valid.size and valid[0]:
+                buffer.append(t, temps[0], None if state is None else state[0])
+                for sink in sinks:
+                    sink.append(t, temps[0])
+            next_poll += interval_s
+            delay = next_poll - time.perf_counter()
+            if delay > 0:
+                self._acq_stop.wait(delay)
+            else:
+                next_poll = time.perf_counter() # Fell behind, do not try to catch up
+
+    def _stream_loop(self, buffer, stream_period_s, clock, sinks=()):
+        parser = temp_stream_parser()
+        pending = collections.deque() # Requests sent and waiting for their reply line
+        while not self._acq_stop.is_set():
+            request = self._next_request()
+            while request is not None:
+                self._send(request.command)
+                request.sent_at = time.perf_counter()
+                pending.append(request)
+                request = self._next_request()
+            while pending and time.perf_counter() - pending[0].sent_at > 1.0:
+                pending.popleft().done.set() # No reply, give up with b''
+
+            data = self.port.read(max(1, self.port.in_waiting)) # Returns after the port timeout if idle
+            if not data:
+                continue
+            t = clock()
+            replies = [] if pending else None
+            rows = parser.feed(data, replies)
+            for reply in replies or ():
+                if pending:
+                    request = pending.popleft()
+                    request.reply = reply
+                    request.done.set()
+            # Lines received together were pushed at the device cadence, the last one just now
+            n = len(rows)
+            for k, temps in enumerate(rows):
+                t_k = t - (n - 1 - k) * stream_period_s
+                buffer.append(t_k, temps)
+                for sink in sinks:
+                    sink.append(t_k, temps)
+
+    def stop_acquisition(self):
+        """Stop the acquisition thread
+
+        Returns:
+            temp_ring_buffer: the buffer that was filled (None if never started)
+        """
+        if self._acq_thread is not None:
+            self._acq_stop.set()
+            self._acq_thread.join(timeout=1.0)
+            self._acq_thread = None
+            if self.acquisition_mode == 'stream':
+                self._send('F') # Back to mute mode
+        return self.acquisition_buffer
+
+    @property
+    def acquiring(self):
+        return self._acq_thread is not None and self._acq_thread.is_alive()
+
+    def temperature_snapshot(self, since=None, n=None):
+        """Non-blocking copy of the acquired samples, see :meth:`temp_ring_buffer.snapshot`"""
+        if self.acquisition_buffer is None:
+            return np.empty(0), np.empty((0, len(ZONE_LABELS)), dtype=np.float32)
+        return self.acquisition_buffer.snapshot(since=since, n=n)
+
+    def button_presses(self, button='resp', since=None):
+        """Times at which a thermode button was pressed during a buttons acquisition
+
+        Presses are the released -> pressed transitions between consecutive
+        samples, so their resolution is the polling interval.
+
+        Args:
+            button (str, optional): 'stim' or 'resp'. Defaults to 'resp'.
+            since (int, optional): Value of ``acquisition_buffer.count`` to start from.
+
+        Returns:
+            np.ndarray: timestamps (acquisition clock) of the first sample showing each press
+        """
+        if button not in ('stim', 'resp'):
+            raise ValueError('button must be one of: stim, resp')
+        if self.acquisition_buffer is None or self.acquisition_buffer.buttons is None:
+            raise ValueError('acquisition was not started with buttons=True')
+        # Include the sample before ``since`` so a button already held then is not a new press
+        start = None if since is None else max(since - 1, 0)
+        times, _, state, first = self.acquisition_buffer.snapshot(since=start, with_buttons=True, with_start=True)
+        pressed = state[:, 0 if button == 'stim' else 1].astype(bool)
+        onsets = pressed & ~np.concatenate(([False], pressed[:-1]))
+        if since is not None and first < since and pressed.size:
+            onsets[0] = False # The sample before ``since``, not a press after it
+        return times[onsets]
+
+    def trigger_and_stream_temp(self, duration_ms=None, offset_s=1):
+        """Trigger the stimulation and record the pushed 100 Hz temperature stream
+
+        Same output as :meth:`trigger_and_save_temp` (``read_outs`` DataFrame)
+        but without sending 'E' for every sample.
+        """
+        if duration_ms:
+            dur = duration_ms
+        else:
+            dur = self.stim_duration_ms
+        buffer = self.start_acquisition(mode='stream')
+        self.trigger()
+        time.sleep(dur/1000 + offset_s)
+        self.stop_acquisition()
+
+        _, outs = buffer.snapshot()
+        self.read_outs = pd.DataFrame(outs.astype(float), columns=ZONE_LABELS)
+        return self.read_outs
+
     def set_rd_plateau(self, temp_plateau, temp_pic,
                    dur_plateau_1_10ms,
                    n_seg='006',
@@ -298,17 +1295,17 @@ class tcsii_serial():
                           dur_plateau_1_10ms + temp_plateau + rise_pic + temp_pic + dur_pic + \
                           temp_pic + rise_pic + temp_plateau + dur_plateau_2_10ms + temp_plateau
         print(string_to_send)
-        self.port.write(string_to_send.encode())
+        self._send(string_to_send)
 
 
     def trigger_and_plot_temp(self, frequency=100, offset_s=1, fig_each_zone=False,
                               duration_ms=None):
         elapsed = 0
-        all_outs = []
+        all_outs = bytearray()
         if self.beep:
-              self.port.write('Z010100'.encode())
+              self._send('Z010100')
 
-        self.port.write('L'.encode()) # Trigger stimulation
+        self._send('L') # Trigger stimulation
 
         # Read and print temperature at 100 Hz
         now = time.time()
@@ -317,14 +1314,12 @@ class tcsii_serial():
         else:
             dur = self.stim_duration_ms
         while elapsed < (dur/1000 + offset_s):
-            self.port.write('E'.encode())
-            out = self.port.readline().decode()
-            all_outs.append(out)
+            all_outs += self._query('E')
             elapsed = time.time() - now
 
-        # Format output
-        all_outs = [i.replace('\r', '').replace('\n', '') for i in all_outs]
-        outs = np.asarray([i.split('+') for i in all_outs]).astype(float)/10
+        # Format output (malformed replies become NaN rows)
+        outs, _ = parse_temp_block(all_outs)
+        outs = outs.astype(float)
 
         self.read_outs = outs
 
@@ -358,25 +1353,691 @@ class tcsii_serial():
                 self.last_fig.append(fig)
 
 
+class tcsii_watchdog():
+    def __init__(self, thermode, limit_temp=None, interval_s=0.1, max_missed=3, on_trip=None,
+                 clock=time.perf_counter):
+        """Abort the stimulation on a thermode fault, an over-limit temperature or an interpreter exit
+
+        A background thread checks the error state ('Q') and the temperatures
+        every ``interval_s``. While an acquisition runs, temperatures are taken
+        from its buffer (every sample since the last check) and 'Q' goes through
+        the acquisition thread (:meth:`tcsii_serial.query`), so each check adds
+        a single short command to the serial line. Without an acquisition 'Q' and
+        'E' are queried directly; queries hold the thermode's read lock, so a
+        reply cannot go to another thread's query. On a failed check 'A' is sent
+        at once from the watchdog thread, i.e. within about ``interval_s`` plus
+        one reply of the fault. While running, an atexit hook also sends 'A' if
+        the interpreter exits (e.g. ``core.quit()`` on escape).
+
+        The outcome is kept in ``status``, a dict with 'state' ('stopped', 'ok',
+        'error', 'over_temp', 'no_reply' or 'exit'), 'message', 'error_state',
+        'max_temp', 'checks', 'last_check', 'tripped_at' and 'abort_latency_s'.
+
+        Args:
+            thermode (tcsii_serial): Thermode to watch
+            limit_temp (float, optional): Abort above this temperature on any zone.
+                Defaults to the thermode's max_temp + 1.
+            interval_s (float, optional): Time between checks. Defaults to 0.1.
+            max_missed (int, optional): Consecutive unanswered 'Q' before aborting. Defaults to 3.
+            on_trip (callable, optional): Called with ``status`` after an abort.
+            clock (callable, optional): Timestamp source for ``status``. Defaults to time.perf_counter.
+        """
+        self.thermode = thermode
+        self.limit_temp = limit_temp if limit_temp is not None else thermode.max_temp + 1
+        self.interval_s = interval_s
+        self.max_missed = max_missed
+        self.on_trip = on_trip
+        self.clock = clock
+        self.status = {'state': 'stopped', 'message': '', 'error_state': None, 'max_temp': None,
+                       'checks': 0, 'last_check': None, 'tripped_at': None, 'abort_latency_s': None}
+        self._stop = threading.Event()
+        self._thread = None
+        self._mark = None # Acquisition sample count at the last check
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def tripped(self):
+        return self.status['tripped_at'] is not None
+
+    def start(self):
+        if self.running:
+            return self
+        self._stop.clear()
+        self.status['state'] = 'ok'
+        self._thread = threading.Thread(target=self._run, name='tcsii-watchdog', daemon=True)
+        self._thread.start()
+        atexit.register(self._at_exit)
+        return self
+
+    def stop(self):
+        """Stop checking (does not abort)"""
+        atexit.unregister(self._at_exit)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        if not self.tripped:
+            self.status['state'] = 'stopped'
+        return self.status
+
+    def _run(self):
+        missed = 0
+        while not self._stop.wait(self.interval_s):
+            try:
+                reply = self.thermode.query('Q').strip()
+            except (TimeoutError, serial.SerialException):
+                reply = b''
+            codes = [int(c) for c in reply.decode(errors='replace') if c.isdigit()]
+            missed = 0 if codes else missed + 1
+            temps = self._latest_temps()
+            self.status['checks'] += 1
+            self.status['last_check'] = self.clock()
+            if codes:
+                self.status['error_state'] = codes
+            if temps.size:
+                peak = float(np.nanmax(temps)) if not np.isnan(temps).all() else None
+                if peak is not None and (self.status['max_temp'] is None or peak > self.status['max_temp']):
+                    self.status['max_temp'] = peak
+
+            if any(code > 1 for code in codes):
+                self._trip('error', 'error state %s' % reply.decode(errors='replace'))
+            elif temps.size and np.nanmax(temps) > self.limit_temp:
+                self._trip('over_temp', '%.1f C above limit %.1f C' % (np.nanmax(temps), self.limit_temp))
+            elif missed >= self.max_missed:
+                self._trip('no_reply', 'no reply to Q for %d checks' % missed)
+            else:
+                continue
+            return
+
+    def _latest_temps(self):
+        """Temperatures since the last check (from the acquisition if it runs)"""
+        if self.thermode.acquiring:
+            buffer = self.thermode.acquisition_buffer
+            since, self._mark = self._mark, buffer.count
+            return buffer.snapshot(since=since)[1]
+        try:
+            temps, valid = parse_temp_block(self.thermode.query('E'))
+        except (TimeoutError, serial.SerialException):
+            return np.empty((0, len(ZONE_LABELS)), dtype=np.float32)
+        return temps[valid]
+
+    def _trip(self, state, message):
+        detected = time.perf_counter()
+        try:
+            self.thermode.abort()
+        except serial.SerialException:
+            pass
+        self.status['abort_latency_s'] = time.perf_counter() - detected
+        self.status.update(state=state, message=message, tripped_at=self.clock())
+        if self.on_trip is not None:
+            self.on_trip(self.status)
+
+    def _at_exit(self):
+        if self.running:
+            self._stop.set()
+            try:
+                self.thermode.abort()
+                self.thermode.disable_profiles() # The next run must not play this run's profiles
+            except Exception:
+                pass
+            self.status.update(state='exit', message='interpreter exit', tripped_at=self.clock())
+
+
+def sine_setpoints(center, amplitude, freq_hz, duration_s, rate_hz=50, phase=0.0):
+    """Sinusoidal setpoint waveform for :meth:`tcsii_follow_streamer.play`
+
+    Returns:
+        np.ndarray: (n,) setpoints in degrees, one per tick of ``rate_hz``
+    """
+    t = np.arange(int(round(duration_s * rate_hz))) / rate_hz
+    return center + amplitude * np.sin(2 * np.pi * freq_hz * t + phase)
+
+
+def random_walk_setpoints(start, step_sd, duration_s, low, high, rate_hz=50, rng=None):
+    """Bounded Gaussian random walk setpoint waveform (reflected at ``low``/``high``)
+
+    Args:
+        step_sd (float): Standard deviation of each tick's step in degrees
+
+    Returns:
+        np.ndarray: (n,) setpoints in degrees, one per tick of ``rate_hz``
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    n = int(round(duration_s * rate_hz))
+    walk = start + np.cumsum(np.concatenate(([0.0], rng.normal(0.0, step_sd, max(n - 1, 0)))))
+    # Fold the unbounded walk into [low, high]
+    span = high - low
+    folded = np.mod(walk - low, 2 * span)
+    return low + np.where(folded > span, 2 * span - folded, folded)
+
+
+class tcsii_follow_streamer():
+    def __init__(self, thermode, rate_hz=50, surfaces=0, speed=10.0, min_temp=10.0, max_temp=None,
+                 clock=time.perf_counter):
+        """Stream setpoints to the thermode in follow mode ('Od') from a dedicated thread
+
+        In follow mode the probe moves towards the last target ('C'/'Ot') at the
+        rise rate and stays there, so sending a new target every tick makes it
+        track a continuous waveform. Setpoints are sent on a fixed schedule of
+        ``rate_hz`` ticks (a late tick is skipped rather than sent in a burst);
+        a tick whose encoded setpoint did not change sends nothing.
+
+        Each tick logs the commanded setpoints next to the latest measured
+        temperatures of the thermode's acquisition, if one is running (see
+        :meth:`log`). While streaming, an atexit hook sends 'A' to leave follow mode.
+
+        Args:
+            thermode (tcsii_serial): Connected thermode
+            rate_hz (float, optional): Setpoint update rate. Defaults to 50.
+            surfaces (int or list, optional): Zones that follow (0 for all). Defaults to 0.
+            speed (float, optional): Rise and return rate in °C/s used to reach each setpoint. Defaults to 10.0.
+            min_temp (float, optional): Lower clip of the setpoints. Defaults to 10.0.
+            max_temp (float, optional): Upper clip of the setpoints. Defaults to the thermode's max_temp.
+            clock (callable, optional): Timestamp source of the log. Defaults to time.perf_counter.
+        """
+        self.thermode = thermode
+        self.rate_hz = rate_hz
+        self.surfaces = list(range(1, 6)) if type(surfaces) != list else surfaces
+        self.speed = speed
+        self.min_temp = min_temp
+        self.max_temp = max_temp if max_temp is not None else thermode.max_temp
+        self.clock = clock
+        self.late_ticks = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._encoded = {} # setpoint -> encoded target field
+        self._log_t = np.empty(0)
+        self._log_commanded = np.empty((0, 5), dtype=np.float32)
+        self._log_measured = np.empty((0, len(ZONE_LABELS)), dtype=np.float32)
+        self._log_n = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def play(self, setpoints, loop=False):
+        """Stream a precomputed waveform, one setpoint per tick
+
+        Args:
+            setpoints (array_like): (n,) setpoints for all following zones, or (n, 5) per zone
+            loop (bool, optional): Start over at the end instead of stopping. Defaults to False.
+        """
+        setpoints = np.clip(np.asarray(setpoints, dtype=float), self.min_temp, self.max_temp)
+        n = len(setpoints)
+        if not n:
+            raise ValueError('empty setpoint waveform')
+
+        def source(k, t):
+            if k >= n and not loop:
+                return None
+            return setpoints[k % n]
+        self._start(source, capacity=n if not loop else int(60 * self.rate_hz))
+        return self
+
+    def follow(self, source, duration_s=None):
+        """Stream setpoints computed on the fly (e.g. from a participant-controlled slider)
+
+        Args:
+            source (callable): Called every tick with the time in s since the start; returns
+                the setpoint (float, or 5 values per zone), or None to stop.
+            duration_s (float, optional): Stop after this time. Defaults to running until :meth:`stop`.
+        """
+        def tick_source(k, t):
+            if duration_s is not None and t >= duration_s:
+                return None
+            value = source(t)
+            return None if value is None else np.clip(np.asarray(value, dtype=float), self.min_temp, self.max_temp)
+        self._start(tick_source, capacity=int((duration_s or 60) * self.rate_hz) + 1)
+        return self
+
+    def stop(self):
+        """Stop streaming and leave follow mode ('A', back to neutral)"""
+        atexit.unregister(self._at_exit)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        self.thermode.abort()
+
+    def wait(self, timeout=None):
+        """Block until the waveform has been played (does not leave follow mode)"""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def log(self):
+        """Commanded and measured temperatures of every tick
+
+        Returns:
+            pd.DataFrame: 't', 'commanded_z1'..'commanded_z5' (NaN for zones not following)
+                and 'measured_<zone>' for ``ZONE_LABELS`` (NaN without acquisition)
+        """
+        n = self._log_n
+        df = pd.DataFrame({'t': self._log_t[:n]})
+        for z in range(5):
+            df['commanded_z%d' % (z + 1)] = self._log_commanded[:n, z]
+        for i, label in enumerate(ZONE_LABELS):
+            df['measured_' + label] = self._log_measured[:n, i]
+        return df
+
+    def _target_field(self, setpoint):
+        field = self._encoded.get(setpoint)
+        if field is None:
+            if len(self._encoded) >= _FIXED_POINT_LUT_MAX:
+                self._encoded.clear()
+            field = encode_fixed(setpoint, 100, 4) if self.thermode.hires else encode_fixed(setpoint, 10, 3)
+            self._encoded[setpoint] = field
+        return field
+
+    def _commands(self, setpoints, last):
+        """Encoded target commands of the zones whose setpoint changed since ``last``"""
+        prefix = 'Ot' if self.thermode.hires else 'C'
+        if setpoints.ndim == 0:
+            field = self._target_field(float(setpoints))
+            fields = {z: field for z in self.surfaces}
+            if fields != last:
+                return (prefix + '0' + field).encode(), fields
+            return b'', last
+        fields = {z: self._target_field(float(setpoints[z - 1])) for z in self.surfaces}
+        command = ''.join(prefix + str(z) + field for z, field in fields.items() if last.get(z) != field)
+        return command.encode(), fields
+
+    def _start(self, source, capacity):
+        if self.running:
+            raise RuntimeError('already streaming setpoints')
+        first = source(0, 0.0)
+        if first is None:
+            return
+        self._log_t = np.empty(capacity)
+        self._log_commanded = np.full((capacity, 5), np.nan, dtype=np.float32)
+        self._log_measured = np.full((capacity, len(ZONE_LABELS)), np.nan, dtype=np.float32)
+        self._log_n = 0
+        self.late_ticks = 0
+
+        # Parameters change behind the stimulation cache
+        self.thermode._sent_params.clear()
+        surfaces = ''.join('1' if z in self.surfaces else '0' for z in range(1, 6))
+        if self.thermode.hires:
+            rates = 'Ov0' + encode_fixed(self.speed, 100, 5) + 'Or0' + encode_fixed(self.speed, 100, 5)
+        else:
+            rates = 'V0' + encode_fixed(self.speed, 10, 4) + 'R0' + encode_fixed(self.speed, 10, 4)
+        command, fields = self._commands(np.asarray(first), {})
+        self.thermode._send(('S' + surfaces + rates).encode() + command + b'Od')
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(source, np.asarray(first), fields),
+                                         name='tcsii-follow', daemon=True)
+        self._thread.start()
+        atexit.register(self._at_exit)
+
+    def _run(self, source, setpoints, fields):
+        period = 1.0 / self.rate_hz
+        start = time.perf_counter()
+        k = 0
+        while True:
+            self._record(setpoints)
+            k += 1
+            deadline = start + k * period
+            delay = deadline - time.perf_counter()
+            if delay < 0:
+                # Late: skip to the current tick instead of catching up in a burst
+                skipped = int(-delay / period)
+                self.late_ticks += skipped
+                k += skipped
+                deadline = start + k * period
+                delay = deadline - time.perf_counter()
+            if delay > 0.002 and self._stop.wait(delay - 0.002):
+                return
+            while time.perf_counter() < deadline: # Spin the last 2 ms for a steady cadence
+                time.sleep(0) # Yield the GIL to the render loop while spinning
+            if self._stop.is_set():
+                return
+            setpoints = source(k, k * period)
+            if setpoints is None:
+                return
+            setpoints = np.asarray(setpoints)
+            command, fields = self._commands(setpoints, fields)
+            if command:
+                self.thermode._send(command, label='follow')
+
+    def _record(self, setpoints):
+        n = self._log_n
+        if n == len(self._log_t):
+            grow = max(n, 1)
+            self._log_t = np.concatenate((self._log_t, np.empty(grow)))
+            self._log_commanded = np.concatenate((self._log_commanded, np.full((grow, 5), np.nan, np.float32)))
+            self._log_measured = np.concatenate((self._log_measured,
+                                                 np.full((grow, len(ZONE_LABELS)), np.nan, np.float32)))
+        self._log_t[n] = self.clock()
+        zones = np.asarray(self.surfaces) - 1
+        self._log_commanded[n, zones] = setpoints if setpoints.ndim == 0 else setpoints[zones]
+        buffer = self.thermode.acquisition_buffer
+        if self.thermode.acquiring and buffer.count:
+            self._log_measured[n] = buffer.snapshot(n=1)[1][0]
+        self._log_n = n + 1
+
+    def _at_exit(self):
+        if self.running:
+            self._stop.set()
+            try:
+                self.thermode.abort()
+            except Exception:
+                pass
+
+
+class tcsii_multi():
+    def __init__(self, devices, names=None, clock=time.perf_counter, trigger_timeout_s=1.0):
+        """Drive several TCSII units as one (e.g. bilateral stimulation)
+
+        Each device gets its own I/O thread. :meth:`trigger_all` releases the
+        trigger threads from a barrier so the 'L' writes go out together
+        instead of one after the other, and the temperature streams of all
+        devices can be merged on a common time base.
+
+        Args:
+            devices (list of tcsii_serial): Connected thermodes, one per port
+            names (list of str, optional): Labels of the devices. Defaults to thermode1, thermode2, ...
+            clock (callable, optional): Timestamp source for triggers and acquisition.
+                Defaults to time.perf_counter.
+            trigger_timeout_s (float, optional): Longest wait of :meth:`trigger_all` and
+                :meth:`close` for the trigger threads. Defaults to 1.0.
+        """
+        self.devices = list(devices)
+        self.names = list(names) if names else ['thermode%d' % (i + 1) for i in range(len(self.devices))]
+        self.clock = clock
+        self.trigger_timeout_s = trigger_timeout_s
+        self._executor = ThreadPoolExecutor(max_workers=len(self.devices), thread_name_prefix='tcsii-multi')
+        self.trigger_times = [None] * len(self.devices) # Write completion of the last trigger_all
+        self._trigger_errors = [None] * len(self.devices)
+        self._go = threading.Barrier(len(self.devices) + 1)
+        self._done = threading.Barrier(len(self.devices) + 1)
+        self._closing = False
+        self._trigger_threads = [threading.Thread(target=self._trigger_worker, args=(i,),
+                                                  name='tcsii-trigger-%d' % i, daemon=True)
+                                 for i in range(len(self.devices))]
+        for thread in self._trigger_threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __getitem__(self, i):
+        return self.devices[i]
+
+    def _trigger_worker(self, i):
+        device = self.devices[i]
+        while True:
+            try:
+                self._go.wait()
+                if self._closing:
+                    return
+                try:
+                    device.trigger()
+                    self.trigger_times[i] = self.clock()
+                except Exception as e:
+                    self.trigger_times[i] = None
+                    self._trigger_errors[i] = e # Raised by trigger_all, the thread lives on
+                self._done.wait()
+            except threading.BrokenBarrierError:
+                return # trigger_all gave up on the trigger threads
+
+    def trigger_all(self):
+        """Start the stimulation on every device at the same time
+
+        Raises the exception of a device whose trigger failed (the others have
+        been triggered). If the trigger threads do not all complete within
+        ``trigger_timeout_s``, the barriers are aborted, the threads stop and
+        ``TimeoutError`` is raised; abort the devices and start a new group.
+
+        Returns:
+            list: time at which each device's 'L' write completed
+        """
+        if self._go.broken:
+            raise RuntimeError('trigger threads stopped after an earlier timeout')
+        self._trigger_errors = [None] * len(self.devices)
+        try:
+            self._go.wait(self.trigger_timeout_s)
+            self._done.wait(self.trigger_timeout_s)
+        except threading.BrokenBarrierError:
+            self._go.abort()
+            self._done.abort()
+            raise TimeoutError('trigger threads did not complete within %s s' % self.trigger_timeout_s)
+        for name, error in zip(self.names, self._trigger_errors):
+            if error is not None:
+                raise RuntimeError('trigger failed on %s: %s' % (name, error)) from error
+        return list(self.trigger_times)
+
+    def map(self, func, *per_device_args):
+        """Call ``func(device, *args)`` on every device in parallel
+
+        Args:
+            func (callable): Called with each device and its arguments
+            *per_device_args (list): One list per argument, holding a value per device
+
+        Returns:
+            list: results in device order (exceptions are raised)
+        """
+        futures = [self._executor.submit(func, device, *args)
+                   for device, args in zip(self.devices, zip(*per_device_args) if per_device_args
+                                           else [()] * len(self.devices))]
+        return [future.result() for future in futures]
+
+    def set_baseline(self, baseline):
+        self.map(lambda device: device.set_baseline(baseline))
+
+    def load_stim(self, compiled):
+        """Stage one :meth:`tcsii_serial.compile_stim` entry per device"""
+        self.map(lambda device, c: device.load_stim(c), compiled)
+
+    def abort(self):
+        self.map(lambda device: device.abort())
+
+    def disable_profiles(self):
+        self.map(lambda device: device.disable_profiles())
+
+    def start_acquisition(self, **kwargs):
+        """Start every device's acquisition on the shared clock (same arguments
+        as :meth:`tcsii_serial.start_acquisition`)"""
+        kwargs.setdefault('clock', self.clock)
+        return self.map(lambda device: device.start_acquisition(**kwargs))
+
+    def stop_acquisition(self):
+        return self.map(lambda device: device.stop_acquisition())
+
+    @property
+    def counts(self):
+        """Acquired sample count of each device, to pass as ``since`` to :meth:`temperature_snapshot`"""
+        return [device.acquisition_buffer.count if device.acquisition_buffer is not None else 0
+                for device in self.devices]
+
+    def temperature_snapshot(self, since=None, period_s=0.01):
+        """Merge the devices' acquired temperatures on a common time grid
+
+        Each device samples on its own schedule, so the traces are linearly
+        interpolated onto a regular grid covering the time span all devices
+        have samples for.
+
+        Args:
+            since (list of int, optional): Per-device sample counts (see :attr:`counts`)
+            period_s (float, optional): Grid spacing. Defaults to 0.01.
+
+        Returns:
+            tuple: (times, temps) with times of shape (k,) and temps of shape
+            (k, n_devices, n_zones)
+        """
+        since = since if since is not None else [None] * len(self.devices)
+        snapshots = [device.temperature_snapshot(since=mark) for device, mark in zip(self.devices, since)]
+        n_zones = len(ZONE_LABELS)
+        if any(times.size < 2 for times, _ in snapshots):
+            return np.empty(0), np.empty((0, len(self.devices), n_zones), dtype=np.float32)
+        start = max(times[0] for times, _ in snapshots)
+        end = min(times[-1] for times, _ in snapshots)
+        grid = start + np.arange(max(int(np.floor((end - start) / period_s)) + 1, 0)) * period_s
+        merged = np.empty((grid.size, len(self.devices), n_zones), dtype=np.float32)
+        for d, (times, temps) in enumerate(snapshots):
+            for z in range(n_zones):
+                merged[:, d, z] = np.interp(grid, times, temps[:, z])
+        return grid, merged
+
+    def close(self):
+        """Stop acquisitions and the I/O threads, and close the ports"""
+        self.stop_acquisition()
+        self._closing = True
+        if not self._go.broken:
+            try:
+                self._go.wait(self.trigger_timeout_s)
+            except threading.BrokenBarrierError:
+                pass
+        self._executor.shutdown(wait=True)
+        for device in self.devices:
+            device.port.close()
+
+
+def _zone_template(z):
+    return (
+        '[step{step}_zone%d]\n'
+        'enabled={enabled%d}\n'
+        'duration={duration:.3f}\n'
+        'wait={wait:.3f}\n'
+        'temperature={target:.3f}\n'
+        'speed={rise:.3f}\n'
+        'return={ret:.3f}\n'
+        'pointToPointEnabled=0\n'
+        'nbrPts=1\n'
+        'sec1=1.000\n'
+        'deg1=30.000\n'
+        '\n') % (z, z)
+
+
+def _const_temp_template(z):
+    return (
+        'constTemp%d={temp:.3f}\n'
+        'constTempSpeed%d={speed:.3f}\n'
+        'enableConsTemp%d={enabled%d}\n'
+        'ConstTempHold%d={duration:.3f}\n') % (z, z, z, z, z)
+
+
+# Text of each step type. A step is formatted once per distinct set of values and
+# split on its step number, so repeated steps only cost a join.
+_PROTOCOL_STEP_TEMPLATES = {
+    'stimulation': (
+        '[step{step}]\n'
+        'stepType=0\n'
+        'stepTypeText=STIMULATE\n'
+        '\n'
+        '[step{step}_stimulation]\n'
+        'baseline={baseline:.3f}\n'
+        'triggerVal={trig_val}\n'
+        'triggerDur={trig_dur:.3f}\n'
+        '\n' + ''.join(_zone_template(z) for z in range(1, 6))),
+    'wait_trigger_in': (
+        '[step{step}]\n'
+        'stepType=2\n'
+        'stepTypeText=WAIT\n'
+        'typeWait=3\n'
+        'typeWaitText=WAIT_TRIGGER\n'
+        'number=1\n'
+        '\n'),
+    'wait_duration': (
+        '[step{step}]\n'
+        'stepType=2\n'
+        'stepTypeText=WAIT\n'
+        'typeWait=0\n'
+        'typeWaitText=WAIT_DURATION\n'
+        'duration={duration:.3f}\n'
+        '\n'),
+    'wait_random_duration': (
+        '[step{step}]\n'
+        'stepType=2\n'
+        'stepTypeText=WAIT\n'
+        'typeWait=1\n'
+        'typeWaitText=WAIT_RANDOM_DURATION\n'
+        'minDuration={min_duration:.3f}\n'
+        'maxDuration={max_duration:.3f}\n'
+        'stepDuration={step_duration:.3f}\n'
+        '\n'),
+    'wait_response': (
+        '[step{step}]\n'
+        'stepType=2\n'
+        'stepTypeText=WAIT\n'
+        'typeWait=2\n'
+        'typeWaitText=WAIT_RESPONSE\n'
+        'timeOutResponse={time_out:.3f}\n'
+        '\n'),
+    'trigger_out': (
+        '[step{step}]\n'
+        'stepType=3\n'
+        'stepTypeText=TRIGGER_OUT\n'
+        'triggerVal={trig_val}\n'
+        'triggerDur={trig_dur:.3f}\n'
+        'triggerOffset={trig_offset:.3f}\n'
+        '\n'),
+    'baseline': (
+        '[step{step}]\n'
+        'stepType=6\n'
+        'stepTypeText=BASELINE\n'
+        'baseline={baseline:.3f}\n'
+        'adjustToSkin={adjust}\n'
+        '\n'),
+    'constant_temp': (
+        '[step{step}]\n'
+        'stepType=8\n'
+        'stepTypeText=SET_CONST_TEMP\n' + ''.join(_const_temp_template(z) for z in range(1, 6)) + '\n'),
+}
+
+
+_STEP_CACHE_MAX = 4096
+
+
+def _enabled_fields(zones):
+    return _enabled_fields_cached(tuple(zones))
+
+
+@functools.lru_cache(maxsize=64)
+def _enabled_fields_cached(zones):
+    return {'enabled%d' % z: 1 if z in zones else 0 for z in range(1, 6)}
+
+
 class tcsii_protocol_generator():
     def __init__(self, filename, recordTemperatures=1, generate_figure=False):
-        """Connect to TSCII and set baseline and max temperature
+        """Write a TCSII protocol file (``<filename>.protocol.ini``)
+
+        Steps are formatted from precomputed templates and streamed to a
+        temporary file as they are added, so memory use does not grow with
+        the number of steps. :meth:`export_protocol` writes the header, whose
+        step count is only known at the end, and moves the steps behind it.
 
         Args:
-            port (str): Serial port name
-            baseline (int, optional): Baseline temperature. Defaults to 30.
-            surfaces (int or list): Surfaces to use. 0 for all surfaces. Defaults to 0.
-        """        
+            filename (str): Output path without the '.protocol.ini' extension
+            recordTemperatures (int, optional): Value of the protocol's recordTemperatures. Defaults to 1.
+            generate_figure (bool, optional): Also save a flow diagram of the steps as
+                '<filename>.protocol.jpg'. Needs the optional ``schemdraw`` package. Defaults to False.
+        """
         self.filename = filename
         self.n_steps = 0
-        self.recordTemperatures=recordTemperatures
-        self.protocol = ['[protocol]', 'stepsNumber=0', 'recordTemperatures=' + str(recordTemperatures), '']
+        self.recordTemperatures = recordTemperatures
         self.generate_figure = generate_figure
-        if self.generate_figure:
-            self.schema = schemdraw.Drawing()
-            self.schema += Start().label(filename + '.protocol.ini')
-            self.schema += Arrow().down(self.schema.unit/4)
+        self._figure_steps = [] # (element, label) of each step, drawn at export
+        self._body = None # Temporary file receiving the steps
+        self._step_parts = {} # (step type, values) -> step text split on the step number
+
+    def _write_step(self, kind, **fields):
+        if self._body is None:
+            self._body = open(self.filename + '.protocol.ini.tmp', 'w')
+        key = (kind,) + tuple(fields.items())
+        parts = self._step_parts.get(key)
+        if parts is None:
+            if len(self._step_parts) >= _STEP_CACHE_MAX:
+                self._step_parts.clear()
+            parts = _PROTOCOL_STEP_TEMPLATES[kind].format(step='\0', **fields).split('\0')
+            self._step_parts[key] = parts
+        self.n_steps += 1
+        self._body.write(str(self.n_steps).join(parts))
 
+    def _add_figure_step(self, element, label):
+        self._figure_steps.append((element, 'step%d\n%s' % (self.n_steps, label)))
 
     def add_stimulation(self, target_temp, rise_rate, return_rate, 
                         duration_smmm, baseline=30.0, wait=0.000,  zones=[1, 2, 3, 4, 5], 
@@ -403,189 +2064,95 @@ class tcsii_protocol_generator():
         else:
             raise ValueError('duration_mode must be one of: fixed_plateau, fixed_total, fixed_stim')
 
-        # Format number to strings with 3 decimals
-        duration_smmm = f'{duration_smmm:.3f}'
-        target_temp = f'{target_temp:.3f}'
-        baseline = f'{baseline:.3f}'
-        wait = f'{wait:.3f}'
-        trig_out_dur = f'{trig_out_dur:.3f}'
-        trig_out_val = str(trig_out_val)
-        rise_rate = f'{rise_rate:.3f}'
-        return_rate = f'{return_rate:.3f}'
-
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=0')
-        self.protocol.append('stepTypeText=STIMULATE')
-        self.protocol.append('')
-        self.protocol.append('[step' + str(curr_step) + '_stimulation]')
-        self.protocol.append('baseline=' + baseline)
-        self.protocol.append('triggerVal=' + trig_out_val)
-        self.protocol.append('triggerDur=' + trig_out_dur)
-        self.protocol.append('')
-
-        for z in [1, 2, 3, 4, 5]:
-            self.protocol.append('[step' + str(curr_step) + '_zone' + str(z) + ']')
-            if z in zones:
-                self.protocol.append('enabled=1')
-            else:
-                self.protocol.append('enabled=0')
-            self.protocol.append('duration=' + duration_smmm)
-            self.protocol.append('wait=' + str(wait))
-            self.protocol.append('temperature=' + target_temp)
-            self.protocol.append('speed=' + rise_rate)
-            self.protocol.append('return=' + return_rate)
-            self.protocol.append('pointToPointEnabled=0')
-            self.protocol.append('nbrPts=1')
-            self.protocol.append('sec1=1.000')
-            self.protocol.append('deg1=30.000')
-            self.protocol.append('')
+        self._write_step('stimulation', baseline=baseline, trig_val=trig_out_val, trig_dur=trig_out_dur,
+                         duration=duration_smmm, wait=wait, target=target_temp, rise=rise_rate,
+                         ret=return_rate, **_enabled_fields(zones))
         if self.generate_figure:
-            self.schema += Box(w = 4).label("step" + str(curr_step) + "\nStimulation" + "\n" + "Target: " + target_temp + "\n" + "Total duration: " + str(total_duration))
-            self.schema += Arrow().down(schemdraw.Drawing().unit/4)
-
+            self._add_figure_step('Box', 'Stimulation\nTarget: %.3f\nTotal duration: %s'
+                                  % (target_temp, total_duration))
 
     def add_wait_trigger_in(self):
         """Add a wait trigger step to the protocol."""
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=2')
-        self.protocol.append('stepTypeText=WAIT')
-        self.protocol.append('typeWait=3')
-        self.protocol.append('typeWaitText=WAIT_TRIGGER')
-        self.protocol.append('number=1')
-        self.protocol.append('')
+        self._write_step('wait_trigger_in')
         if self.generate_figure:
-            self.schema += Box(w = 4).label("step" + str(curr_step) + "\n" + "Wait for trigger")
-            self.schema += Arrow().down(self.schema.unit/4)
-
+            self._add_figure_step('Box', 'Wait for trigger')
 
     def add_wait_duration(self, duration_s=1.00):
         """Add a wait duration step to the protocol."""
-        duration_s = f'{duration_s:.3f}'
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=2')
-        self.protocol.append('stepTypeText=WAIT')
-        self.protocol.append('typeWait=0')
-        self.protocol.append('typeWaitText=WAIT_DURATION')
-        self.protocol.append('duration=' + str(duration_s))
-        self.protocol.append('')
+        self._write_step('wait_duration', duration=duration_s)
         if self.generate_figure:
-            self.schema += Data(w = 4).label("step" + str(curr_step) + "\n" + "Wait for duration" + "\n Duration" + str(duration_s) + "s")
-            self.schema += Arrow().down(self.schema.unit/4)
-
+            self._add_figure_step('Data', 'Wait for duration\n Duration%.3fs' % duration_s)
 
     def add_wait_random_duration(self, min_duration_s=1.00, max_duration_s=3.00,
                                  step_duration_s=1.00):
         """Add random wait duration step to the protocol."""
-        min_duration_s = f'{min_duration_s:.3f}'
-        max_duration_s = f'{max_duration_s:.3f}'
-        step_duration_s = f'{step_duration_s:.3f}'
-        
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=2')
-        self.protocol.append('stepTypeText=WAIT')
-        self.protocol.append('typeWait=1')
-        self.protocol.append('typeWaitText=WAIT_RANDOM_DURATION')
-        self.protocol.append('minDuration=' + str(min_duration_s))
-        self.protocol.append('maxDuration=' + str(max_duration_s))
-        self.protocol.append('stepDuration=' + str(step_duration_s))
-        self.protocol.append('')
+        self._write_step('wait_random_duration', min_duration=min_duration_s, max_duration=max_duration_s,
+                         step_duration=step_duration_s)
         if self.generate_figure:
-            self.schema += Data(w = 4).label("step" + str(curr_step) + "\n" + "Wait for random duration" + "\n Min duration" + str(min_duration_s) + "s" + "\n Max duration" + str(max_duration_s) + "s" + "\n Step duration" + str(step_duration_s) + "s")
-            self.schema += Arrow().down(self.schema.unit/4)
+            self._add_figure_step('Data', 'Wait for random duration\n Min duration%.3fs\n Max duration%.3fs'
+                                  '\n Step duration%.3fs' % (min_duration_s, max_duration_s, step_duration_s))
 
     def add_wait_response(self, time_out_s=20.00):
         """Add a wait response step to the protocol."""
-        time_out_s = f'{time_out_s:.3f}'
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=2')
-        self.protocol.append('stepTypeText=WAIT')
-        self.protocol.append('typeWait=2')
-        self.protocol.append('typeWaitText=WAIT_RESPONSE')
-        self.protocol.append('timeOutResponse=' + str(time_out_s))
-        self.protocol.append('')
+        self._write_step('wait_response', time_out=time_out_s)
         if self.generate_figure:
-            self.schema += Data(w = 4).label("step" + str(curr_step) + "\n" + "Wait for reponse button" + "\n Timeout" + str(time_out_s) + "s")
-            self.schema += Arrow().down(self.schema.unit/4)
-            
+            self._add_figure_step('Data', 'Wait for reponse button\n Timeout%.3fs' % time_out_s)
+
     def add_trigger_out(self, trigger_val=255, trigger_dur_s=0.1,
                         trigger_offset_s=0.0):
         """Add a trigger out step to the protocol."""
-        trigger_dur_s = f'{trigger_dur_s:.3f}'
-        trigger_offset_s = f'{trigger_offset_s:.3f}'
-        trigger_val = str(trigger_val)
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=3')
-        self.protocol.append('stepTypeText=TRIGGER_OUT')
-        self.protocol.append('triggerVal=' + trigger_val)
-        self.protocol.append('triggerDur=' + trigger_dur_s)
-        self.protocol.append('triggerOffset=' + trigger_offset_s)
-        self.protocol.append('')
+        self._write_step('trigger_out', trig_val=trigger_val, trig_dur=trigger_dur_s, trig_offset=trigger_offset_s)
         if self.generate_figure:
-            self.schema += Data(w = 4).label("step" + str(curr_step) + "\n" + "Send trigger out" + "\n Value" + str(trigger_val) + "\n Duration" + str(trigger_dur_s) + "s" + "\n Offset" + str(trigger_offset_s) + "s")
-            self.schema += Arrow().down(self.schema.unit/4)
-            
+            self._add_figure_step('Data', 'Send trigger out\n Value%s\n Duration%.3fs\n Offset%.3fs'
+                                  % (trigger_val, trigger_dur_s, trigger_offset_s))
+
     def set_baseline(self, baseline_temp=30.0, adjust_to_skin=0):
         """Add a set baseline step to the protocol."""
-        baseline_temp = f'{baseline_temp:.3f}'
-        self.n_steps += 1
-        self.baseline = baseline_temp
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=6')
-        self.protocol.append('stepTypeText=BASELINE')
-        self.protocol.append('baseline=' + baseline_temp)
-        self.protocol.append('adjustToSkin=' + str(adjust_to_skin))
-        self.protocol.append('')
+        self.baseline = f'{baseline_temp:.3f}'
+        self._write_step('baseline', baseline=baseline_temp, adjust=adjust_to_skin)
         if self.generate_figure:
-            self.schema += Box(w = 4).label("step" + str(curr_step) + "\n" + "Set baseline" + "\n Temperature" + str(baseline_temp) + "°C")
-            self.schema += Arrow().down(self.schema.unit/4)
-    
+            self._add_figure_step('Box', 'Set baseline\n Temperature%s°C' % self.baseline)
+
     def set_constant_temp(self, constant_temp, duration_s, speed, zones):
         """Add a set constant temperature step to the protocol."""
-        constant_temp = f'{constant_temp:.3f}'
-        speed = f'{speed:.3f}'
-        duration_s = f'{duration_s:.3f}'
-        self.n_steps += 1
-        curr_step = self.n_steps
-        self.protocol.append('[step' + str(curr_step) + ']')
-        self.protocol.append('stepType=8')
-        self.protocol.append('stepTypeText=SET_CONST_TEMP')
-        for z in range(1,6):
-            self.protocol.append('constTemp' + str(z) +  '=' + constant_temp)
-            self.protocol.append('constTempSpeed' + str(z) + '='+ speed)
-            if z in zones:
-                self.protocol.append('enableConsTemp' + str(z) + '=1')
-            else:
-                self.protocol.append('enableConsTemp' + str(z) + '=0')
-            self.protocol.append('ConstTempHold' + str(z) + '=' + duration_s)
-        self.protocol.append('')
+        self._write_step('constant_temp', temp=constant_temp, speed=speed, duration=duration_s,
+                         **_enabled_fields(zones))
         if self.generate_figure:
-            self.schema += Box(w = 4).label("step" + str(curr_step) + "\n" + "Set constant temperature" + "\n Temperature" + str(constant_temp) + "°C" + "\n Duration" + str(duration_s) + "s" + "\n Speed" + str(speed) + "°C/s")
-            self.schema += Arrow().down(self.schema.unit/4)
+            self._add_figure_step('Box', 'Set constant temperature\n Temperature%.3f°C\n Duration%.3fs'
+                                  '\n Speed%.3f°C/s' % (constant_temp, duration_s, speed))
 
     def export_protocol(self):
         """Export protocol to file."""
-        self.protocol[1] = 'stepsNumber=' + str(self.n_steps)
-        with open(self.filename + ".protocol.ini", 'w') as f:
-            for line in self.protocol:
-                f.write(line + '\n')
-        f.close()
+        with open(self.filename + '.protocol.ini', 'w') as f:
+            f.write('[protocol]\nstepsNumber=%d\nrecordTemperatures=%s\n\n'
+                    % (self.n_steps, self.recordTemperatures))
+        if self._body is not None:
+            self._body.close()
+            # Already encoded steps are appended as bytes
+            with open(self._body.name, 'rb') as body, open(self.filename + '.protocol.ini', 'ab') as f:
+                shutil.copyfileobj(body, f, 1 << 20)
+            os.remove(self._body.name)
+            self._body = None
 
         if self.generate_figure:
-            self.schema += Ellipse(w = 4).label("End")
-            self.schema.save(self.filename + ".protocol.jpg")
+            self._save_figure()
+
+    def _save_figure(self):
+        """Draw the steps with schemdraw (imported here, only when a figure is requested)"""
+        try:
+            import schemdraw
+            from schemdraw import flow
+        except ImportError:
+            warnings.warn('schemdraw is not installed, protocol figure not generated')
+            return
+        schema = schemdraw.Drawing(show=False)
+        schema += flow.Start().label(self.filename + '.protocol.ini')
+        schema += flow.Arrow().down(schema.unit / 4)
+        for element, label in self._figure_steps:
+            schema += getattr(flow, element)(w=4).label(label)
+            schema += flow.Arrow().down(schema.unit / 4)
+        schema += flow.Ellipse(w=4).label('End')
+        schema.save(self.filename + '.protocol.jpg')
 
     def generate_from_lists(self, temp_list, 
                                         duration_smmm, zones, 
@@ -635,3 +2202,243 @@ class tcsii_protocol_generator():
                                  duration_smmm=duration, wait=wait,
                                  zones=zone, trig_out_val=trig_val, trig_out_dur=trigger_out_dur, duration_mode=duration_mode)
 
+
+_STEP_STIMULATE, _STEP_WAIT, _STEP_TRIGGER_OUT, _STEP_BASELINE, _STEP_CONST_TEMP = 0, 2, 3, 6, 8
+_WAIT_DURATION, _WAIT_RANDOM, _WAIT_RESPONSE, _WAIT_TRIGGER = 0, 1, 2, 3
+
+
+def _ini_section(body):
+    section = {}
+    for line in body.splitlines():
+        key, sep, value = line.partition('=')
+        if sep and key[:1] not in (';', '#'):
+            value = value.strip()
+            try:
+                section[key.strip()] = float(value) if '.' in value else int(value)
+            except ValueError:
+                section[key.strip()] = value
+    return section
+
+
+def load_protocol(path):
+    """Read a '.protocol.ini' file (as written by :class:`tcsii_protocol_generator`)
+
+    Returns:
+        dict: 'stepsNumber', 'recordTemperatures' and 'steps', a list with one dict per
+            step holding its own keys; stimulation steps also have 'stimulation' and
+            'zones' (5 dicts, zone 1 to 5).
+    """
+    with open(path) as f:
+        text = f.read()
+    sections = {}
+    parsed = {} # Section text -> keys; zones and stimulations of a protocol repeat a lot
+    for block in re.split(r'^\s*\[', text, flags=re.M)[1:]:
+        name, _, body = block.partition(']')
+        section = parsed.get(body)
+        if section is None:
+            section = parsed[body] = _ini_section(body)
+        sections[name.strip()] = dict(section)
+
+    header = sections.get('protocol', {})
+    n_steps = int(header.get('stepsNumber', 0))
+    steps = []
+    for i in range(1, n_steps + 1):
+        step = dict(sections.get('step%d' % i, {}))
+        if 'stepType' not in step:
+            raise ValueError('%s: step%d is missing' % (path, i))
+        if step['stepType'] == _STEP_STIMULATE:
+            step['stimulation'] = sections.get('step%d_stimulation' % i, {})
+            step['zones'] = [sections.get('step%d_zone%d' % (i, z), {}) for z in range(1, 6)]
+        steps.append(step)
+    return {'stepsNumber': n_steps,
+            'recordTemperatures': header.get('recordTemperatures', 0),
+            'steps': steps}
+
+
+def simulate_protocol(protocol, dt=0.01, trigger_wait_s=0.0, response_wait_s=None,
+                      random_wait='mean', start_temp=None):
+    """Predict the timeline of a protocol
+
+    Temperatures are piecewise linear: each enabled zone of a stimulation waits its
+    'wait', ramps towards 'temperature' at 'speed' for at most 'duration' (rise +
+    plateau), then returns to the step's baseline at 'return'. A constant temperature
+    step ramps to its temperature, holds it and ramps back at the same speed.
+    Baseline steps change the level instantly.
+
+    Args:
+        protocol (dict or str): Output of :func:`load_protocol`, or a file path
+        dt (float, optional): Sampling period in s of 'times'/'temps'; None only
+            returns the breakpoints. Defaults to 0.01.
+        trigger_wait_s (float, optional): Assumed time waiting for a trigger in. Defaults to 0.0.
+        response_wait_s (float, optional): Assumed time waiting for a response; None uses
+            the step's timeout. Defaults to None.
+        random_wait (str or np.random.Generator, optional): 'mean', 'min' or 'max' of
+            random waits, or a generator to draw them. Defaults to 'mean'.
+        start_temp (float, optional): Level before the first step. Defaults to the first baseline.
+
+    Returns:
+        dict: 'duration' (s), 'step_starts' and 'step_durations' (n_steps,),
+            'trigger_times'/'trigger_values' (trigger outs of stimulations and trigger
+            out steps), 'trigger_in_times' (start of the waits for a trigger in),
+            'breakpoints' (per zone (times, temps) of the piecewise linear
+            temperature), 'heat_load' (5,) in °C·s above
+            start_temp, and 'times'/'temps' sampled every dt.
+    """
+    if isinstance(protocol, str):
+        protocol = load_protocol(protocol)
+    steps = protocol['steps']
+    n = len(steps)
+    step_type = np.array([s['stepType'] for s in steps], dtype=np.int8).reshape(n)
+    wait_type = np.array([s.get('typeWait', -1) for s in steps], dtype=np.int8).reshape(n)
+
+    def column(key, mask, default=0.0):
+        values = np.zeros(n)
+        values[mask] = [float(steps[i].get(key, default)) for i in np.flatnonzero(mask)]
+        return values
+
+    # Level in effect after each step (baseline steps and stimulation baselines)
+    is_stim = step_type == _STEP_STIMULATE
+    is_base = step_type == _STEP_BASELINE
+    is_const = step_type == _STEP_CONST_TEMP
+    stim_base = np.zeros(n)
+    stim_base[is_stim] = [float(steps[i]['stimulation'].get('baseline', 0)) for i in np.flatnonzero(is_stim)]
+    base = np.where(is_base, column('baseline', is_base), np.where(is_stim, stim_base, np.nan))
+    if start_temp is None:
+        known = base[~np.isnan(base)]
+        start_temp = float(known[0]) if known.size else 32.0
+    has_level = ~np.isnan(base)
+    level = np.where(has_level, base, 0.0)
+    last = np.maximum.accumulate(np.where(has_level, np.arange(n), -1)) if n else np.zeros(0, int)
+    level = np.where(last >= 0, level[np.maximum(last, 0)], start_temp)
+    level_before = np.concatenate(([start_temp], level[:-1]))
+
+    # Step durations
+    durations = np.zeros(n)
+    is_wait = step_type == _STEP_WAIT
+    m = is_wait & (wait_type == _WAIT_DURATION)
+    durations[m] = column('duration', m)[m]
+    m = is_wait & (wait_type == _WAIT_TRIGGER)
+    durations[m] = trigger_wait_s
+    m = is_wait & (wait_type == _WAIT_RESPONSE)
+    durations[m] = column('timeOutResponse', m)[m] if response_wait_s is None else response_wait_s
+    m = is_wait & (wait_type == _WAIT_RANDOM)
+    if m.any():
+        lo, hi, step = column('minDuration', m)[m], column('maxDuration', m)[m], column('stepDuration', m, 1.0)[m]
+        n_choices = np.floor((hi - lo) / np.where(step > 0, step, 1) + 1e-9) + 1
+        if random_wait == 'mean':
+            durations[m] = lo + step * (n_choices - 1) / 2
+        elif random_wait == 'min':
+            durations[m] = lo
+        elif random_wait == 'max':
+            durations[m] = lo + step * (n_choices - 1)
+        else:
+            durations[m] = lo + step * random_wait.integers(0, n_choices.astype(int))
+
+    # Stimulations: (S, 5) zone parameters, 5 breakpoints per zone
+    stim_idx = np.flatnonzero(is_stim)
+    zone_table = np.array([[[float(zone.get(key, 0)) for key in ('enabled', 'wait', 'duration', 'temperature',
+                                                                  'speed', 'return')]
+                            for zone in steps[i]['zones']] for i in stim_idx]).reshape(len(stim_idx), 5, 6)
+    enabled, z_wait, z_dur, z_target, z_speed, z_return = np.moveaxis(zone_table, 2, 0)
+    enabled = enabled > 0
+    z_base = stim_base[stim_idx, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reach = np.abs(z_target - z_base) / z_speed
+        rise = np.where(np.isfinite(reach), np.minimum(reach, z_dur), z_dur)
+        peak = z_base + (z_target - z_base) * np.where(reach > 0, rise / reach, 1.0)
+        back = np.nan_to_num(np.abs(peak - z_base) / z_return)
+    peak = np.where(enabled, peak, z_base)
+    rise, back = np.where(enabled, rise, 0.0), np.where(enabled, back, 0.0)
+    z_end = z_wait + z_dur + back
+    durations[stim_idx] = np.where(enabled, z_end, 0.0).max(axis=1) if stim_idx.size else 0.0
+
+    # Constant temperature steps
+    const_idx = np.flatnonzero(is_const)
+    const_table = np.array([[[float(steps[i].get(key % z, 0)) for key in ('enableConsTemp%d', 'constTemp%d',
+                                                                           'constTempSpeed%d', 'ConstTempHold%d')]
+                             for z in range(1, 6)] for i in const_idx]).reshape(len(const_idx), 5, 4)
+    c_enabled, c_temp, c_speed, c_hold = np.moveaxis(const_table, 2, 0)
+    c_enabled = c_enabled > 0
+    c_base = level_before[const_idx, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        c_ramp = np.where(c_enabled, np.nan_to_num(np.abs(c_temp - c_base) / c_speed), 0.0)
+    c_temp = np.where(c_enabled, c_temp, c_base)
+    c_hold = np.where(c_enabled, c_hold, 0.0)
+    durations[const_idx] = (2 * c_ramp + c_hold).max(axis=1) if const_idx.size else 0.0
+
+    starts = np.concatenate(([0.0], np.cumsum(durations)[:-1])) if n else np.zeros(0)
+    total = float(durations.sum())
+
+    # Per step and zone: (S, 5, points) times and temperatures
+    t0 = starts[stim_idx, None]
+    stim_t = np.stack([np.broadcast_to(t0, z_wait.shape), t0 + z_wait, t0 + z_wait + rise,
+                       t0 + z_wait + z_dur, t0 + z_end], axis=2)
+    stim_v = np.stack([np.broadcast_to(z_base, peak.shape)] * 2 + [peak, peak, np.broadcast_to(z_base, peak.shape)],
+                      axis=2)
+    t0 = starts[const_idx, None]
+    const_t = np.stack([np.broadcast_to(t0, c_ramp.shape), t0 + c_ramp, t0 + c_ramp + c_hold,
+                        t0 + 2 * c_ramp + c_hold], axis=2)
+    const_v = np.stack([np.broadcast_to(c_base, c_temp.shape), c_temp, c_temp,
+                        np.broadcast_to(c_base, c_temp.shape)], axis=2)
+    base_idx = np.flatnonzero(is_base)
+    base_t = np.repeat(starts[base_idx, None], 2, axis=1)
+    base_v = np.stack([level_before[base_idx], level[base_idx]], axis=1)
+
+    # Breakpoints of each zone, put in time order by their (step, point) keys
+    end_level = level[-1] if n else start_temp
+    step_key = np.concatenate(([-1], np.repeat(stim_idx, 5), np.repeat(const_idx, 4), np.repeat(base_idx, 2), [n]))
+    point_key = np.concatenate(([0], np.tile(np.arange(5), stim_idx.size), np.tile(np.arange(4), const_idx.size),
+                                np.tile([0, 1], base_idx.size), [0]))
+    order = np.lexsort((point_key, step_key))
+    breakpoints = []
+    for z in range(5):
+        bp_t = np.concatenate(([0.0], stim_t[:, z].ravel(), const_t[:, z].ravel(), base_t.ravel(), [total]))
+        bp_v = np.concatenate(([start_temp], stim_v[:, z].ravel(), const_v[:, z].ravel(), base_v.ravel(),
+                               [end_level]))
+        breakpoints.append((bp_t[order], bp_v[order]))
+    heat_load = np.array([(0.5 * (v[1:] + v[:-1] - 2 * start_temp) * np.diff(t)).sum() for t, v in breakpoints])
+
+    trig_out = step_type == _STEP_TRIGGER_OUT
+    trigger_times = np.concatenate((starts[stim_idx], starts[trig_out] + column('triggerOffset', trig_out)[trig_out]))
+    trigger_values = np.concatenate((
+        np.array([int(steps[i]['stimulation'].get('triggerVal', 0)) for i in stim_idx], dtype=int),
+        column('triggerVal', trig_out)[trig_out].astype(int)))
+    order = np.argsort(trigger_times, kind='stable')
+
+    result = {
+        'duration': total,
+        'step_starts': starts,
+        'step_durations': durations,
+        'trigger_times': trigger_times[order],
+        'trigger_values': trigger_values[order],
+        'trigger_in_times': starts[is_wait & (wait_type == _WAIT_TRIGGER)],
+        'breakpoints': breakpoints,
+        'heat_load': heat_load,
+    }
+    if dt is not None:
+        times = np.arange(0.0, total + dt / 2, dt)
+        result['times'] = times
+        result['temps'] = np.column_stack([np.interp(times, t, v) for t, v in breakpoints])
+    return result
+
+
+def summarize_protocols(paths, **kwargs):
+    """Duration, trigger counts and heat load of a batch of protocol files
+
+    Args:
+        paths (list): '.protocol.ini' files
+        **kwargs: passed to :func:`simulate_protocol`
+
+    Returns:
+        pd.DataFrame: one row per file
+    """
+    kwargs['dt'] = None
+    rows = []
+    for path in paths:
+        protocol = load_protocol(path)
+        sim = simulate_protocol(protocol, **kwargs)
+        row = {'path': path, 'n_steps': protocol['stepsNumber'], 'duration_s': sim['duration'],
+               'n_trigger_out': sim['trigger_times'].size, 'n_trigger_in': sim['trigger_in_times'].size}
+        row.update({'heat_load_z%d' % z: load for z, load in enumerate(sim['heat_load'], 1)})
+        rows.append(row)
+    return pd.DataFrame(rows)
@@ -0,0 +1,244 @@
+"""
+asyncio variant of the TCSII driver.
+
+pyserial has no asynchronous API on Windows COM ports, so the blocking port
+calls run on a dedicated I/O thread and are exposed as coroutines. Commands
+go through a FIFO queue and each one has its own timeout. A blocking call
+cannot be cancelled, so a query bounds its reply read by its timeout (the port
+timeout is set for that call): when it fails, the I/O thread is already free
+for the commands behind it, and the input buffer is cleared before the next
+command so a late reply is not taken as the answer to it. Writes are only
+bounded on the asyncio side.
+
+Reads of the pushed temperature stream use a second thread, so writes such as
+'L' never wait on a pending read. While it runs, that thread is the only
+reader of the port: queries write their command and take their reply line from
+the stream (the non-temperature lines, in order).
+
+Encoding, parameter caching and parsing are shared with :class:`pytcsii.tcsii_serial`.
+
+Example:
+    async def main():
+        thermode = await tcsii_async.open('COM3', baseline=35)
+        await thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[1])
+        await asyncio.gather(thermode.trigger(), other_io())
+        async for t, temps in thermode.stream_temperatures(mode='stream'):
+            ...
+"""
+
+import asyncio
+import collections
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from pytcsii import tcsii_serial, temp_stream_parser, parse_temp_block
+
+
+class tcsii_async():
+    def __init__(self, device, default_timeout=0.5):
+        """Wrap an open :class:`tcsii_serial` (use :meth:`open` to create one without blocking)
+
+        Args:
+            device (tcsii_serial): Connected thermode
+            default_timeout (float, optional): Timeout in s of commands without an explicit one. Defaults to 0.5.
+        """
+        self.device = device
+        self.default_timeout = default_timeout
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tcsii-io')
+        self._read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tcsii-read')
+        self._queue = None
+        self._worker = None
+        self._stale = False # A query timed out; its reply may still arrive
+        self._stream_replies = None # While streaming: [future, sent time] of queries awaiting their line
+
+    @classmethod
+    async def open(cls, port, default_timeout=0.5, **kwargs):
+        """Connect to the TCSII off the event loop
+
+        Args:
+            port (str): Serial port name
+            **kwargs: passed to :class:`tcsii_serial`
+        """
+        loop = asyncio.get_running_loop()
+        device = await loop.run_in_executor(None, functools.partial(tcsii_serial, port, **kwargs))
+        return cls(device, default_timeout=default_timeout)
+
+    def _submit(self, func, timeout=None, bounded=False):
+        """Queue a blocking call for the I/O thread and return a future for its result
+
+        ``bounded`` calls return within their timeout by themselves and are not
+        wrapped in ``asyncio.wait_for``.
+        """
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((func, future, None if bounded else self._timeout(timeout)))
+        return future
+
+    def _timeout(self, timeout):
+        return self.default_timeout if timeout is None else timeout
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            func, future, timeout = await self._queue.get()
+            if future.done(): # Cancelled by the caller while queued
+                continue
+            try:
+                call = loop.run_in_executor(self._executor, func)
+                result = await (call if timeout is None else asyncio.wait_for(call, timeout))
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def command(self, command, timeout=None):
+        """Send a command that has no reply
+
+        Args:
+            command (str or bytes): Valid command from TSCII manual
+            timeout (float, optional): Seconds before raising TimeoutError.
+        """
+        await self._submit(functools.partial(self.device._send, command), timeout)
+
+    def _exchange(self, command, timeout):
+        """Send a query and read its reply within ``timeout`` (runs on the I/O thread)"""
+        port = self.device.port
+        if self._stale:
+            port.reset_input_buffer() # Late reply of a timed-out query
+            self._stale = False
+        saved = port.timeout
+        if saved != timeout:
+            port.timeout = timeout
+        try:
+            if command in ('K', b'K'): # CR + two digits, without a line end
+                self.device._send(command)
+                reply = port.read(3)
+                complete = len(reply) == 3
+            else:
+                reply = self.device._query(command)
+                complete = reply.endswith(b'\n')
+        finally:
+            if saved != timeout:
+                port.timeout = saved
+        if not complete:
+            # Nothing or a partial reply within the timeout; the rest may come later
+            port.reset_input_buffer()
+            self._stale = True
+            raise asyncio.TimeoutError('no reply to %r within %s s' % (command, timeout))
+        return reply
+
+    async def query(self, command, timeout=None):
+        """Send a command and return its reply line (bytes)
+
+        Raises ``asyncio.TimeoutError`` if no complete reply came within the
+        timeout. While :meth:`stream_temperatures` runs in 'stream' mode, only
+        replies that are not temperature lines can be told apart from the
+        stream (e.g. 'Q', 'K'), as with :meth:`tcsii_serial.query`.
+        """
+        timeout = self._timeout(timeout)
+        if self._stream_replies is None:
+            return await self._submit(functools.partial(self._exchange, command, timeout), bounded=True)
+        # The stream reader owns the port and hands the reply line over
+        entry = [asyncio.get_running_loop().create_future(), time.perf_counter()]
+        self._stream_replies.append(entry)
+        await self.command(command, timeout)
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry[0]), timeout)
+        except asyncio.TimeoutError:
+            entry[0].cancel() # Its line, if it still comes, is dropped by the reader
+            raise
+
+    async def set_stim(self, timeout=None, **kwargs):
+        """Awaitable :meth:`tcsii_serial.set_stim` (same keyword arguments)"""
+        await self.load_stim(self.device.compile_stim(**kwargs), timeout=timeout)
+
+    async def load_stim(self, compiled, force=False, timeout=None):
+        """Awaitable :meth:`tcsii_serial.load_stim`"""
+        await self._submit(functools.partial(self.device.load_stim, compiled, force=force), timeout)
+
+    async def set_baseline(self, baseline, timeout=None):
+        await self._submit(functools.partial(self.device.set_baseline, baseline), timeout)
+
+    async def trigger(self, timeout=None):
+        """Start the stimulation ('L')"""
+        await self._submit(self.device.trigger, timeout)
+
+    async def abort(self, timeout=None):
+        """Abort the current stimulation or follow mode ('A')"""
+        await self.command('A', timeout)
+
+    async def error_state(self, timeout=None):
+        """Return the 'Q' error state as a list of ints (0 = OK), one per zone + neutral"""
+        reply = (await self.query('Q', timeout)).strip()
+        return [int(c) for c in reply.decode(errors='replace') if c.isdigit()]
+
+    async def read_temperatures(self, timeout=None):
+        """Return the current temperatures ('E') in degrees, None if the reply is malformed"""
+        temps, valid = parse_temp_block(await self.query('E', timeout))
+        if valid.size and valid[0]:
+            return temps[0]
+        return None
+
+    async def stream_temperatures(self, mode='poll', interval_s=0.01, clock=time.perf_counter):
+        """Asynchronous iterator of (timestamp, temperatures) samples
+
+        Args:
+            mode (str, optional): 'poll' queries 'E' every ``interval_s``; 'stream'
+                enables the 100 Hz display during stimulations ('Ob') and parses the
+                pushed lines. Defaults to 'poll'.
+            interval_s (float, optional): Polling interval. Defaults to 0.01.
+            clock (callable, optional): Timestamp source. Defaults to time.perf_counter.
+        """
+        if mode == 'stream':
+            loop = asyncio.get_running_loop()
+            port = self.device.port
+            parser = temp_stream_parser()
+            pending = self._stream_replies = collections.deque()
+            await self.command('Ob')
+            try:
+                while True:
+                    data = await loop.run_in_executor(
+                        self._read_executor, lambda: port.read(max(1, port.in_waiting)))
+                    t = clock()
+                    replies = [] if pending else None
+                    rows = parser.feed(data, replies)
+                    for reply in replies or ():
+                        if pending:
+                            future = pending.popleft()[0]
+                            if not future.done(): # Else the reply of a timed-out query
+                                future.set_result(reply)
+                    while pending and pending[0][0].done() and time.perf_counter() - pending[0][1] > 1.0:
+                        pending.popleft() # Timed out and no reply came, as in tcsii_serial
+                    for temps in rows:
+                        yield t, temps
+            finally:
+                self._stream_replies = None
+                for future, _ in pending:
+                    future.cancel()
+                await self.command('F') # Back to mute mode
+        elif mode == 'poll':
+            while True:
+                temps = await self.read_temperatures()
+                if temps is not None:
+                    yield clock(), temps
+                await asyncio.sleep(interval_s)
+        else:
+            raise ValueError('mode must be one of: poll, stream')
+
+    async def close(self):
+        """Stop the command worker and close the port"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        await asyncio.get_running_loop().run_in_executor(self._executor, self.device.port.close)
+        self._executor.shutdown(wait=False)
+        self._read_executor.shutdown(wait=False)
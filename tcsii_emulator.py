@@ -0,0 +1,410 @@
+"""
+Pseudo-terminal TCSII emulator (Linux/macOS).
+
+Opens a pty and answers the serial protocol documented at the top of
+``pytcsii.py``, so the real :class:`pytcsii.tcsii_serial` code paths can be
+exercised, timed and regression-tested without the device:
+
+    with tcsii_emulator() as emu:
+        thermode = tcsii_serial(emu.port, baseline=35)
+        ...
+
+Each zone is modelled as a rate-limited setpoint (the ramp the device commands
+at the configured rise/return rates, or a 'Uw' profile) followed by a
+first-order probe lag. Replies are sent after a configurable latency, and the
+'Oa' (1 Hz between stimulations) and 'Ob' (100 Hz during stimulations)
+displays are pushed like the device does.
+
+Reply formats: temperatures as '+'-separated integers ending with CR LF
+(1/10 degrees for 'E', 1/100 degrees for 'Oe'), 'Og' appends the two button
+digits as a seventh field, 'K' replies CR + the two button digits.
+"""
+
+import argparse
+import heapq
+import os
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+# Argument length after the command letter(s); None = variable ('Uw')
+_COMMANDS = {
+    b'H': 0, b'?': 0, b'G': 0, b'P': 0, b'L': 0, b'A': 0, b'F': 0, b'B': 0, b'E': 0, b'K': 0, b'Q': 0,
+    b'N': 3, b'S': 5, b'C': 4, b'V': 5, b'R': 5, b'D': 6, b'T': 6, b'Y': 4, b'I': 1, b'Z': 6,
+    b'Oa': 0, b'Ob': 0, b'Oc': 0, b'Od': 0, b'Oe': 0, b'Oo': 0, b'Og': 0, b'Ol': 0,
+    b'Om': 3, b'Ov': 6, b'Or': 6, b'Ot': 5, b'Os': 1, b'Of': 1, b'Oi': 1,
+    b'Ur': 0, b'Ue': 5, b'Uw': None,
+    b'Xr': 0, b'Xw': 12,
+}
+_PREFIXES = {b'O', b'U', b'X'}
+
+
+class tcsii_emulator():
+    def __init__(self, neutral=30.0, tau_s=0.1, reply_latency_s=0.002, latency_jitter_s=0.0,
+                 stream_period_s=0.01, tick_s=0.001, seed=None):
+        """Create the emulator (call :meth:`start` or use it as a context manager)
+
+        Args:
+            neutral (float, optional): Initial neutral temperature. Defaults to 30.0.
+            tau_s (float, optional): Time constant of the probe first-order lag. Defaults to 0.1.
+            reply_latency_s (float, optional): Delay before each reply. Defaults to 0.002.
+            latency_jitter_s (float, optional): SD of a gaussian jitter added to the delay. Defaults to 0.
+            stream_period_s (float, optional): Period of the 'Ob' display. Defaults to 0.01.
+            tick_s (float, optional): Physics update period. Defaults to 0.001.
+            seed (int, optional): Seed of the jitter generator.
+        """
+        self.tau_s = tau_s
+        self.reply_latency_s = reply_latency_s
+        self.latency_jitter_s = latency_jitter_s
+        self.stream_period_s = stream_period_s
+        self.tick_s = tick_s
+        self._rng = np.random.default_rng(seed)
+
+        # Device state (index 0 = neutral, 1-5 = zones)
+        self.neutral = neutral
+        self.max_temp = 60.0
+        self.temps = np.full(6, neutral) # Measured probe temperatures
+        self.setpoints = np.full(6, neutral) # Commanded (ramped) temperatures
+        self.target = np.full(6, 40.0)
+        self.rise_rate = np.full(6, 1.0)
+        self.return_rate = np.full(6, 1.0)
+        self.duration_ms = np.full(6, 1000.0)
+        self.enabled = np.ones(6, dtype=bool)
+        self.profiles = {z: [] for z in range(1, 6)} # zone -> [(duration_s, temp), ...]
+        self.profile_enabled = np.zeros(6, dtype=bool)
+        self.display_between = True # 'Oa'
+        self.display_during = True # 'Ob'
+        self.follow_mode = False
+        self.buttons = '00' # 'stim', 'resp'
+        self.error_state = '000000'
+
+        self._stim_start = None
+        self._stop_on_response = False
+        self._next_stream = 0.0
+        self._next_between = 0.0
+
+        self.commands = [] # (receive time, command bytes) of every parsed command
+        self._rx = bytearray()
+        self._replies = [] # heap of (due time, seq, bytes)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+
+    # --- Lifecycle ---
+    def start(self):
+        """Open the pty and start serving; ``port`` is the path to open with pyserial"""
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd) # No echo or newline translation
+        self.port = os.ttyname(self.slave_fd)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._serve, name='tcsii-emulator', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- Test hooks ---
+    def press_button(self, stim=False, resp=False):
+        """Set the 'stim'/'resp' button state reported by 'K' and 'Og'"""
+        with self._lock:
+            self.buttons = ('1' if stim else '0') + ('1' if resp else '0')
+            if resp and self._stop_on_response and self._stim_start is not None:
+                self._begin_return(time.perf_counter())
+
+    def set_error(self, index, code=2):
+        """Report an error for neutral (0) or a zone (1-5) in the 'Q' reply"""
+        with self._lock:
+            state = list(self.error_state)
+            state[index] = str(code)
+            self.error_state = ''.join(state)
+
+    @property
+    def stimulating(self):
+        return self._stim_start is not None
+
+    # --- Serving loop ---
+    def _serve(self):
+        last = time.perf_counter()
+        while not self._stop.is_set():
+            readable, _, _ = select.select([self.master_fd], [], [], self.tick_s)
+            now = time.perf_counter()
+            with self._lock:
+                if readable:
+                    try:
+                        data = os.read(self.master_fd, 4096)
+                    except OSError:
+                        break
+                    self._rx += data
+                    self._parse(now)
+                self._step(now, now - last)
+                self._push_displays(now)
+                out = bytearray()
+                while self._replies and self._replies[0][0] <= now:
+                    out += heapq.heappop(self._replies)[2]
+            last = now
+            if out:
+                os.write(self.master_fd, bytes(out))
+
+    def _reply(self, now, data, latency=True):
+        delay = 0.0
+        if latency:
+            delay = self.reply_latency_s
+            if self.latency_jitter_s:
+                delay = max(0.0, delay + self._rng.normal(0, self.latency_jitter_s))
+        self._seq += 1
+        heapq.heappush(self._replies, (now + delay, self._seq, data))
+
+    def _parse(self, now):
+        buf = self._rx
+        while buf:
+            if buf[0] in b'\r\n ':
+                del buf[:1]
+                continue
+            first = bytes(buf[:1])
+            if first in _PREFIXES:
+                if len(buf) < 2:
+                    return # Wait for the second letter
+                key = bytes(buf[:2])
+            else:
+                key = first
+            if key not in _COMMANDS:
+                del buf[:1] # Unknown byte, resynchronise
+                continue
+            n_args = _COMMANDS[key]
+            if n_args is None: # 'Uw' + areas(5) + n segments(3) + n * 6
+                if len(buf) < len(key) + 8:
+                    return
+                n_args = 8 + 6 * int(buf[len(key) + 5:len(key) + 8])
+            if len(buf) < len(key) + n_args:
+                return # Incomplete command
+            args = bytes(buf[len(key):len(key) + n_args]).decode()
+            self.commands.append((now, bytes(buf[:len(key) + n_args])))
+            del buf[:len(key) + n_args]
+            self._execute(now, key.decode(), args)
+
+    # --- Commands ---
+    @staticmethod
+    def _zones(selector):
+        return list(range(1, 6)) if selector == '0' else [int(selector)]
+
+    def _execute(self, now, cmd, args):
+        if cmd == '?':
+            self._reply(now, b'TCS\r\n')
+        elif cmd == 'N':
+            self.neutral = int(args) / 10
+            if not self.stimulating and not self.follow_mode:
+                self.setpoints[:] = self.neutral
+        elif cmd == 'G':
+            self._reply(now + 2.0, ('N%03d\r\n' % round(self.temps[0] * 10)).encode())
+        elif cmd == 'S':
+            self.enabled[1:] = [c == '1' for c in args]
+        elif cmd in ('C', 'Ot'):
+            scale = 10 if cmd == 'C' else 100
+            self.target[self._zones(args[0])] = min(int(args[1:]) / scale, self.max_temp)
+        elif cmd in ('V', 'Ov'):
+            self.rise_rate[self._zones(args[0])] = int(args[1:]) / (10 if cmd == 'V' else 100)
+        elif cmd in ('R', 'Or'):
+            self.return_rate[self._zones(args[0])] = int(args[1:]) / (10 if cmd == 'R' else 100)
+        elif cmd == 'D':
+            self.duration_ms[self._zones(args[0])] = int(args[1:])
+        elif cmd == 'Om':
+            self.max_temp = int(args) / 10
+        elif cmd in ('L', 'Ol'):
+            self._stim_start = now
+            self._stop_on_response = cmd == 'Ol'
+            self._next_stream = now
+        elif cmd == 'A':
+            if self.follow_mode:
+                self._stim_start = now # Return to neutral at the return rates
+            self.follow_mode = False
+            self._begin_return(now)
+        elif cmd == 'Od':
+            self.follow_mode = True
+        elif cmd == 'Oc':
+            self._soft_reset()
+        elif cmd == 'F':
+            self.display_between = self.display_during = False
+        elif cmd == 'Oa':
+            self.display_between = True
+        elif cmd == 'Ob':
+            self.display_during = True
+        elif cmd == 'E':
+            self._reply(now, self._temp_line(10))
+        elif cmd == 'Oe':
+            self._reply(now, self._temp_line(100))
+        elif cmd == 'Og':
+            self._reply(now, self._temp_line(10)[:-2] + ('+' + self.buttons + '\r\n').encode())
+        elif cmd == 'K':
+            self._reply(now, ('\r' + self.buttons).encode()) # No line end
+        elif cmd == 'Q':
+            self._reply(now, (self.error_state + '\r\n').encode())
+        elif cmd == 'B':
+            self._reply(now, b'4.10V 95%\r\n')
+        elif cmd == 'P':
+            lines = ['N%03d' % round(self.neutral * 10)]
+            for z in range(1, 6):
+                lines.append('%d: C%03d V%04d R%04d D%05d %s' % (
+                    z, round(self.target[z] * 10), round(self.rise_rate[z] * 10),
+                    round(self.return_rate[z] * 10), self.duration_ms[z], 'on' if self.enabled[z] else 'off'))
+            self._reply(now, ('\r\n'.join(lines) + '\r\n').encode())
+        elif cmd == 'Ue':
+            self.profile_enabled[1:] = [c == '1' for c in args]
+        elif cmd == 'Uw':
+            areas, n_seg = args[:5], int(args[5:8])
+            segments = [(int(args[8 + 6 * i:11 + 6 * i]) / 100, int(args[11 + 6 * i:14 + 6 * i]) / 10)
+                        for i in range(n_seg)]
+            for z, flag in enumerate(areas, start=1):
+                if flag == '1':
+                    self.profiles[z] = segments
+        elif cmd == 'Ur':
+            lines = ['%d %d %d %s' % (z, self.profile_enabled[z], len(self.profiles[z]),
+                                      ' '.join('%03d%03d' % (round(d * 100), round(t * 10)) for d, t in self.profiles[z]))
+                     for z in range(1, 6)]
+            self._reply(now, ('\r\n'.join(lines) + '\r\n').encode())
+        elif cmd == 'Xr':
+            self._reply(now, (time.strftime('%H%M%S%d%m%y') + '\r\n').encode())
+        elif cmd == 'H':
+            self._reply(now, b'TCSII emulator\r\n')
+        # Other commands (T, Y, I, Z, Os, Of, Oi, Oo, Xw) only change settings the model ignores
+
+    def _soft_reset(self):
+        """'Oc': back to power-on state (stimulation stopped, displays enabled)"""
+        self._stim_start = None
+        self.follow_mode = False
+        self.display_between = self.display_during = True
+        self.setpoints[:] = self.neutral
+
+    def _begin_return(self, now):
+        if self._stim_start is not None:
+            # Shift the start so every active zone is past its duration
+            self._stim_start = min(self._stim_start, now - self.duration_ms.max() / 1000 - 1e-6)
+
+    def _temp_line(self, scale):
+        width = 3 if scale == 10 else 4
+        values = np.rint(self.temps * scale).astype(int)
+        return ('+'.join(str(v).zfill(width) for v in values) + '\r\n').encode()
+
+    # --- Physics ---
+    def _step(self, now, dt):
+        if dt <= 0:
+            return
+        if self.follow_mode:
+            for z in range(1, 6):
+                if self.enabled[z]:
+                    self._ramp(z, self.target[z], self.rise_rate[z], dt)
+        elif self._stim_start is not None:
+            elapsed = now - self._stim_start
+            active = False
+            for z in range(1, 6):
+                if not self.enabled[z]:
+                    continue
+                if self.profile_enabled[z] and self.profiles[z]:
+                    active |= self._play_profile(z, elapsed)
+                elif elapsed * 1000 < self.duration_ms[z]:
+                    self._ramp(z, self.target[z], self.rise_rate[z], dt)
+                    active = True
+                else:
+                    active |= not self._ramp(z, self.neutral, self.return_rate[z], dt)
+            if not active:
+                self._stim_start = None
+        self.setpoints[0] = self.neutral
+        # First-order probe response towards the commanded temperature
+        self.temps += (self.setpoints - self.temps) * (1 - np.exp(-dt / self.tau_s))
+
+    def _ramp(self, z, goal, rate, dt):
+        """Move the setpoint of zone z towards goal at rate; True once reached"""
+        step = max(rate, 0.01) * dt
+        diff = goal - self.setpoints[z]
+        if abs(diff) <= step:
+            self.setpoints[z] = goal
+            return True
+        self.setpoints[z] += step if diff > 0 else -step
+        return False
+
+    def _play_profile(self, z, elapsed):
+        """Linear interpolation through the 'Uw' segments; False once finished"""
+        start_temp = self.neutral
+        t0 = 0.0
+        for duration, temp in self.profiles[z]:
+            if elapsed < t0 + duration:
+                frac = (elapsed - t0) / duration if duration else 1.0
+                self.setpoints[z] = start_temp + (temp - start_temp) * frac
+                return True
+            t0 += duration
+            start_temp = temp
+        self.setpoints[z] = start_temp
+        return False
+
+    def _push_displays(self, now):
+        if self._stim_start is not None:
+            if self.display_during and now >= self._next_stream:
+                self._reply(now, self._temp_line(10), latency=False)
+                self._next_stream = max(self._next_stream + self.stream_period_s, now - self.stream_period_s)
+        elif self.display_between and now >= self._next_between:
+            self._reply(now, self._temp_line(10), latency=False)
+            self._next_between = now + 1.0
+
+
+def benchmark(duration_s=5.0, reply_latency_s=0.002):
+    """Measure the real tcsii_serial paths against the emulator and print a summary"""
+    from pytcsii import tcsii_serial
+
+    with tcsii_emulator(neutral=35.0, reply_latency_s=reply_latency_s) as emu:
+        thermode = tcsii_serial(emu.port, baseline=35)
+        time.sleep(0.1)
+        thermode.port.reset_input_buffer() # Drop the display line pushed before 'F'
+
+        # Polled 'E' round trips
+        rtts = []
+        t_end = time.perf_counter() + duration_s
+        while time.perf_counter() < t_end:
+            t0 = time.perf_counter()
+            thermode._send('E')
+            thermode.port.readline()
+            rtts.append(time.perf_counter() - t0)
+        rtts = np.asarray(rtts) * 1000
+        print(f"'E' round trip: n={rtts.size} rate={rtts.size / duration_s:.0f} Hz "
+              f"median={np.median(rtts):.2f} ms p99={np.percentile(rtts, 99):.2f} ms max={rtts.max():.2f} ms")
+
+        # Background acquisition, both modes, during a stimulation
+        for mode in ('poll', 'stream'):
+            thermode.set_stim(target=45, rise_rate=10, return_rate=10, dur_ms=int(duration_s * 500), surfaces=0)
+            buffer = thermode.start_acquisition(mode=mode)
+            thermode.trigger()
+            time.sleep(duration_s / 2)
+            thermode.stop_acquisition()
+            times, temps = buffer.snapshot()
+            intervals = np.diff(times) * 1000 if times.size > 1 else np.array([np.nan])
+            print(f"acquisition ({mode}): n={times.size} median interval={np.median(intervals):.2f} ms "
+                  f"max zone temp={np.nanmax(temps[:, 1:]) if times.size else float('nan'):.1f} C")
+            time.sleep(1.5) # Let the probe return to neutral
+        thermode.port.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pytcsii against the TCSII emulator.')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per measurement (default: 5)')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='Emulated reply latency (default: 2 ms)')
+    args = parser.parse_args()
+    benchmark(args.duration, args.latency_ms / 1000)
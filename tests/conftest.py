@@ -0,0 +1,21 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pytest
+import serial
+import pytcsii
+from pytcsii import tcsii_serial
+
+
+@pytest.fixture
+def loop_thermode(monkeypatch):
+    """tcsii_serial on a loopback port: everything written can be read back."""
+    monkeypatch.setattr(
+        pytcsii.serial, "Serial",
+        lambda *args, **kwargs: serial.serial_for_url("loop://", timeout=0.1),
+    )
+    thermode = tcsii_serial("loop", baseline=35)
+    thermode.port.reset_input_buffer()
+    yield thermode
+    thermode.port.close()
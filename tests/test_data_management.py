@@ -0,0 +1,109 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pandas as pd
+import pytest
+import data_management as dm
+
+
+EXP_INFO = {"participant": "sub0001", "date": "2025_01_01_1200"}
+
+
+def test_save_latency_report_next_to_run_files(tmp_path):
+    report = [{"command": "E", "n": 3, "p50_ms": 1.5}]
+    dm.save_latency_report(EXP_INFO, "ThermalPainEEGFMRI_run1", report, str(tmp_path))
+
+    path = tmp_path / "data" / "sub0001" / "sub0001_ThermalPainEEGFMRI_run1_2025_01_01_1200_ThermodeLatency.csv"
+    df = pd.read_csv(path)
+    assert df["command"].tolist() == ["E"]
+    assert df["p50_ms"].tolist() == [1.5]
+
+
+def test_fill_temperature_traces_from_sample_ranges():
+    data = dm.create_data_collector()
+    data["stim_start_time"] = [1.0, 5.0]
+    data["temperature_sample_range"] = [[0, 2], [3, 5]]
+    times = np.arange(6, dtype=float) + 0.5
+    temps = np.arange(36, dtype=np.float32).reshape(6, 6)
+
+    dm.fill_temperature_traces(data, times, temps)
+    assert [t.tolist() for t in data["temperature_times"]] == [[-0.5, 0.5], [-1.5, -0.5]]
+    assert data["temperature_traces"][1][0].tolist() == temps[3].tolist()
+
+
+def test_temperature_trace_codec_round_trip():
+    times = np.arange(200) * 0.01 - 0.5
+    temps = np.round(np.linspace(32, 45, 200)[:, None] + np.arange(6) * 0.1, 1).astype(np.float32)
+    temps[7, 3] = np.nan
+
+    blob = dm.encode_temperature_trace(times, temps)
+    assert len(blob) < times.nbytes + temps.nbytes // 4
+    dec_times, dec_temps = dm.decode_temperature_trace(blob)
+    assert np.allclose(dec_times, times, atol=1e-6)
+    assert np.isnan(dec_temps[7, 3])
+    assert np.array_equal(np.nan_to_num(dec_temps), np.nan_to_num(temps))
+
+    empty_times, empty_temps = dm.decode_temperature_trace(dm.encode_temperature_trace([], np.zeros((0, 6))))
+    assert empty_times.shape == (0,) and empty_temps.shape == (0, 6)
+
+
+def test_backup_stores_encoded_traces(tmp_path):
+    data = dm.create_data_collector()
+    data["trial_number"] = [1, 2]
+    data["stim_start_time"] = [1.0, 5.0]
+    data["temperature_sample_range"] = [[0, 3], [3, 6]]
+    times = np.arange(6) * 0.01
+    temps = np.full((6, 6), 32.5, dtype=np.float32)
+    dm.fill_temperature_traces(data, times, temps)
+    dm.save_all_data(EXP_INFO, "ThermalPainEEGFMRI_run1", data, str(tmp_path))
+
+    path = tmp_path / "data" / "sub0001" / "sub0001_ThermalPainEEGFMRI_run1_2025_01_01_1200_BACKUP.npz"
+    with np.load(path) as backup:  # Traces load without pickle
+        assert backup["temperature_trace_offsets"].size == 3
+    loaded = dm.load_backup(path)
+    assert loaded["trial_number"] == [1, 2]
+    assert loaded["temperature_traces"][1].shape == (3, 6)
+    assert loaded["temperature_traces"][1][0, 0] == np.float32(32.5)
+    assert np.allclose(loaded["temperature_times"][1], times[3:] - 5.0)
+
+
+def test_save_trigger_log(tmp_path):
+    log = np.zeros(2, dtype=[("code", "u1"), ("intended", "f8"), ("actual", "f8"), ("duration", "f8"), ("ok", "?")])
+    log["code"] = [4, 0]
+    log["actual"] = [1.0, 2.0]
+    log["duration"] = [0.0005, 0.001]
+    log["ok"] = True
+    dm.save_trigger_log(EXP_INFO, "ThermalPainEEGFMRI_run1", log, str(tmp_path))
+
+    df = pd.read_csv(tmp_path / "data" / "sub0001" / "sub0001_ThermalPainEEGFMRI_run1_2025_01_01_1200_TriggerLog.csv",
+                     dtype={"code": str})
+    assert df["code"].tolist() == ["04", "00"]
+    assert df["write_duration_ms"].tolist() == [0.5, 1.0]
+
+
+def test_save_trigger_jitter_raw_and_stats(tmp_path):
+    records = {"code": np.array([2, 4], dtype=np.uint8), "flip_time": np.array([1.0, 2.0]),
+               "callback_time": np.array([1.0001, 2.0001]), "write_done": np.array([1.0005, 2.0012]),
+               "ok": np.array([True, True])}
+    dm.save_trigger_jitter(EXP_INFO, "ThermalPainEEGFMRI_run1", records, {"n": 2, "p50_ms": 0.85}, str(tmp_path))
+
+    base = tmp_path / "data" / "sub0001" / "sub0001_ThermalPainEEGFMRI_run1_2025_01_01_1200"
+    raw = pd.read_csv(f"{base}_TriggerJitter.csv")
+    assert raw["delay_ms"].tolist() == pytest.approx([0.5, 1.2])
+    assert pd.read_csv(f"{base}_TriggerJitterStats.csv")["n"].tolist() == [2]
+
+
+def test_save_frame_timing_raw_and_summary(tmp_path):
+    records = {"routine": np.array(["ITI", "ITI"], dtype=object), "trial": np.array([1, 1]),
+               "flip_time": np.array([1.0, 1.05]), "interval_ms": np.array([np.nan, 50.0]),
+               "onset": np.array([True, False]), "dropped": np.array([False, True])}
+    summary = [{"routine": "ITI", "frames": 2, "dropped": 1, "p50_ms": 50.0}]
+    dm.save_frame_timing(EXP_INFO, "ThermalPainEEGFMRI_run1", records, summary, str(tmp_path))
+
+    base = tmp_path / "data" / "sub0001" / "sub0001_ThermalPainEEGFMRI_run1_2025_01_01_1200"
+    raw = pd.read_csv(f"{base}_FrameTiming.csv")
+    assert raw["dropped"].tolist() == [0, 1]
+    assert raw["interval_ms"].isna().tolist() == [True, False]
+    assert pd.read_csv(f"{base}_FrameTimingSummary.csv")["dropped"].tolist() == [1]
@@ -0,0 +1,58 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+import pytest
+from frame_timing import FrameProfiler
+
+
+class ScriptedWindow:
+    """Returns preset flip times, at a 100 Hz frame period."""
+
+    monitorFramePeriod = 0.01
+
+    def __init__(self, times):
+        self.times = iter(times)
+
+    def flip(self):
+        return next(self.times)
+
+
+def test_frames_tagged_by_routine_and_trial():
+    # ITI: 4 frames with one dropped; stimulus: late onset frame, then regular frames
+    times = [0.0, 0.01, 0.02, 0.05, 0.09, 0.10, 0.11]
+    profiler = FrameProfiler()
+    win = profiler.attach(ScriptedWindow(times))
+    profiler.begin("ITI", trial=1)
+    for _ in range(4):
+        win.flip()
+    profiler.begin("stimulus", trial=1)
+    for _ in range(3):
+        win.flip()
+
+    records = profiler.records()
+    assert records["routine"].tolist() == ["ITI"] * 4 + ["stimulus"] * 3
+    assert records["trial"].tolist() == [1] * 7
+    assert records["flip_time"].tolist() == times
+    assert records["onset"].tolist() == [True, False, False, False, True, False, False]
+
+    summary = {row["routine"]: row for row in profiler.summary()}
+    assert set(summary) == {"ITI", "stimulus"}  # The untouched 'setup' routine is left out
+    assert summary["ITI"]["frames"] == 4
+    assert summary["ITI"]["intervals"] == 3
+    assert summary["ITI"]["dropped"] == 1
+    assert summary["ITI"]["max_ms"] == pytest.approx(30.0)
+    assert summary["stimulus"]["onset_dropped"] == 1
+    assert summary["stimulus"]["dropped"] == 0
+    assert summary["stimulus"]["p50_ms"] == pytest.approx(10.0)
+
+
+def test_arrays_grow_past_capacity():
+    profiler = FrameProfiler(frame_period=0.01, capacity=4)
+    win = profiler.attach(ScriptedWindow(np.arange(10) * 0.01))
+    profiler.begin("VAS", trial=2)
+    for _ in range(10):
+        win.flip()
+    [row] = profiler.summary()
+    assert row["frames"] == 10 and row["dropped"] == 0
@@ -0,0 +1,120 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import socket
+import threading
+import time
+import pytest
+import serial
+
+from hardware_broker import HardwareBroker, BrokerClient, BrokerError, REQUEST, REPLY, OP_HELLO, OP_CALL
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="requires Unix sockets")
+
+
+@pytest.fixture
+def broker(tmp_path, loop_thermode):
+    trigger_port = serial.serial_for_url("loop://", timeout=0.1)
+    # No polling: the loopback port would read back the polled commands
+    server = HardwareBroker(str(tmp_path / "broker.sock"), thermode=loop_thermode, trigger_port=trigger_port,
+                            poll_interval_s=None)
+    server._bind()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, loop_thermode, trigger_port
+    if thread.is_alive():
+        BrokerClient(server.address).shutdown()
+    thread.join(timeout=1.0)
+
+
+def test_client_uses_devices_held_by_broker(broker):
+    server, thermode, trigger_port = broker
+    client = BrokerClient(server.address)
+    assert client.rcs is None
+
+    client.trigger_port.write(b"\x05")
+    assert trigger_port.read(1) == b"\x05"
+    assert client.trigger_port.is_open
+
+    client.thermode.load_stim(client.thermode.compile_stim(
+        target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[1]))
+    assert thermode.surfaces == [1]
+    assert client.thermode.stim_duration_ms == 10000
+    client.thermode.beep = False
+    assert thermode.beep is False
+
+    with pytest.raises(BrokerError, match="ValueError"):
+        client.thermode.compile_profile(target=45, rise_rate=0.001, return_rate=5, dur_ms=10000)
+
+    client.trigger_port.close()  # Only the client lets go
+    client.release()
+    assert trigger_port.is_open
+
+
+def test_latency_report_through_broker(broker):
+    server, thermode, _ = broker
+    client = BrokerClient(server.address)
+    client.thermode.reset_latency()  # The histograms hold a lock and cannot be pickled
+    client.thermode.abort()
+    rows = client.thermode.latency_report()
+    assert [row["command"] for row in rows] == ["A"]
+    assert rows[0]["n"] == 1
+    client.release()
+
+
+def test_unclean_disconnect_aborts_and_resets(broker):
+    server, thermode, trigger_port = broker
+    client = BrokerClient(server.address)
+    thermode.port.reset_input_buffer()
+    client._sock.close()  # Script died without releasing
+
+    assert thermode.port.read(8) == b"AUe00000"  # Abort, and no profile left for the next run
+    assert trigger_port.read(1) == b"\x00"
+    BrokerClient(server.address).release()  # Still serving the next run
+
+
+def test_rejects_clients_without_the_key(broker):
+    server, thermode, trigger_port = broker
+    assert os.stat(server.address).st_mode & 0o777 == 0o600
+    assert os.stat(server.key_path).st_mode & 0o777 == 0o600
+
+    for request in (REQUEST.pack(OP_CALL, 0, 4) + b"junk", REQUEST.pack(OP_HELLO, 0, 32) + b"\0" * 32):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(server.address)
+        sock.sendall(request)
+        status, length = REPLY.unpack(sock.recv(REPLY.size))
+        assert status != 0 and sock.recv(length) == b"unauthorized"
+        sock.close()
+
+    thermode.port.reset_input_buffer()
+    BrokerClient(server.address).release()  # Still serving, no fail-safe fired
+    assert thermode.port.read(thermode.port.in_waiting) == b"Ue00000"  # Only the release
+    assert trigger_port.in_waiting == 0
+
+
+@pytest.mark.skipif(not hasattr(os, "openpty"), reason="requires a pty")
+def test_watchdog_queries_answered_without_a_serial_read(tmp_path):
+    from pytcsii import tcsii_serial
+    from tcsii_emulator import tcsii_emulator
+
+    with tcsii_emulator(neutral=35.0, reply_latency_s=0.05) as emu:
+        thermode = tcsii_serial(emu.port, baseline=35)
+        time.sleep(0.05)
+        thermode.port.reset_input_buffer()
+        server = HardwareBroker(str(tmp_path / "broker.sock"), thermode=thermode, poll_interval_s=0.02)
+        server._bind()
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        client = BrokerClient(server.address)
+        try:
+            emu.set_error(2, 3)
+            time.sleep(0.3)
+            t0 = time.perf_counter()
+            reply = client.thermode.query("Q")
+            elapsed = time.perf_counter() - t0
+            assert reply.strip() == b"003000"
+            assert elapsed < 0.04  # Well below the emulator's 50 ms reply latency
+        finally:
+            client.shutdown()
+            thread.join(timeout=1.0)
@@ -0,0 +1,394 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import threading
+import types
+import numpy as np
+import pytest
+from pytcsii import (
+    temp_ring_buffer,
+    temp_stream_parser,
+    parse_temp_block,
+    parse_temp_buttons_block,
+    encode_fixed,
+    encode_profile,
+    latency_histogram,
+    latency_recorder,
+    temp_trace_recorder,
+    load_temp_trace,
+    tcsii_protocol_generator,
+    load_protocol,
+    simulate_protocol,
+    ramp_fidelity_tracker,
+    tcsii_multi,
+)
+
+
+def written(thermode):
+    return thermode.port.read(thermode.port.in_waiting)
+
+
+def test_ring_buffer_snapshot_since_mark():
+    buf = temp_ring_buffer(capacity=8)
+    for i in range(3):
+        buf.append(i, np.full(6, 30 + i))
+    mark = buf.count
+    for i in range(3, 6):
+        buf.append(i, np.full(6, 30 + i))
+
+    times, temps = buf.snapshot(since=mark)
+    assert times.tolist() == [3, 4, 5]
+    assert temps.shape == (3, 6)
+    assert temps[:, 0].tolist() == [33, 34, 35]
+
+
+def test_ring_buffer_wraps_and_keeps_latest():
+    buf = temp_ring_buffer(capacity=4)
+    for i in range(10):
+        buf.append(i, np.full(6, i))
+
+    times, temps = buf.snapshot()
+    # The oldest slot is the next one written, possibly half-overwritten already
+    assert times.tolist() == [7, 8, 9]
+    # Marks older than the buffer only return what is still stored
+    times, _ = buf.snapshot(since=2)
+    assert times.tolist() == [7, 8, 9]
+    times, _ = buf.snapshot(n=2)
+    assert times.tolist() == [8, 9]
+
+
+def test_stream_parser_handles_split_lines_and_garbage():
+    parser = temp_stream_parser()
+    rows = parser.feed(b"320+321+322+32")
+    assert rows.shape == (0, 6)
+    rows = parser.feed(b"3+324+325\r\nbad line\r\n330+331+332+333+334+335\r\n336")
+    assert rows.shape == (2, 6)
+    assert rows[0, 3] == pytest.approx(32.3)
+    assert rows[1, 5] == pytest.approx(33.5)
+
+
+def test_parse_temp_block_masks_malformed_lines():
+    buf = bytearray(b"320+321+322+323+324+325\r\n"
+                    b"320+3x1+322+323+324+325\r\n"
+                    b"\r\n"
+                    b"330+331+332\r\n"
+                    b"400+401+402+403+404+405")
+    temps, valid = parse_temp_block(buf)
+    assert valid.tolist() == [True, False, False, True]
+    assert temps.dtype == np.float32
+    assert temps[0].tolist() == pytest.approx([32.0, 32.1, 32.2, 32.3, 32.4, 32.5])
+    assert np.isnan(temps[1]).all()
+    assert temps[3, 5] == pytest.approx(40.5)
+
+    raw, _ = parse_temp_block(bytes(buf), raw=True)
+    assert raw.dtype == np.int16
+    assert raw[3].tolist() == [400, 401, 402, 403, 404, 405]
+
+
+def test_parse_temp_buttons_block():
+    temps, buttons, valid = parse_temp_buttons_block(
+        b"320+321+322+323+324+325+10\r\n"
+        b"320+321+322+323+324+325+01\r\n"
+        b"320+321+322+323+324+325+02\r\n"
+        b"320+321+322+323+324+325\r\n")
+    assert valid.tolist() == [True, True, False, False]
+    assert buttons[:2].tolist() == [[1, 0], [0, 1]]
+    assert temps[1, 5] == pytest.approx(32.5)
+    assert np.isnan(temps[3]).all()
+
+
+def test_parse_temp_block_masks_fields_wider_than_int16():
+    # 5 digits would wrap to a negative temperature in int16
+    temps, valid = parse_temp_block(b"40000+3210+3220+3230+3240+3250\r\n3200+3210+3220+3230+3240+3250\r\n", scale=100)
+    assert valid.tolist() == [False, True]
+    assert np.isnan(temps[0]).all()
+    assert temps[1, 0] == pytest.approx(32.0)
+
+
+def test_parse_temp_block_empty():
+    temps, valid = parse_temp_block(b"")
+    assert temps.shape == (0, 6)
+    assert valid.shape == (0,)
+
+
+def test_set_stim_sends_only_changed_parameters_in_one_write(loop_thermode):
+    loop_thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[1])
+    first = written(loop_thermode)
+    assert first.startswith(b"C0")
+    assert first.endswith(b"S10000")
+
+    loop_thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[2])
+    assert written(loop_thermode) == b"S01000"
+
+    loop_thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[2])
+    assert written(loop_thermode) == b""
+
+    loop_thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[2], force=True)
+    assert written(loop_thermode) == first.replace(b"S10000", b"S01000")
+
+
+def test_compiled_stim_table_loads_precomputed_bytes(loop_thermode):
+    table = loop_thermode.compile_stim_table([
+        {"target": 45, "rise_rate": 3, "return_rate": 5, "dur_ms": 10000, "surfaces": [1]},
+        {"target": 45, "rise_rate": 3, "return_rate": 5, "dur_ms": 10000, "surfaces": [3]},
+    ])
+    assert written(loop_thermode) == b""  # Compiling sends nothing
+    assert table[1]["commands"]["surfaces"] == b"S00100"
+
+    loop_thermode.load_stim(table[0])
+    assert written(loop_thermode).endswith(b"S10000")
+    assert loop_thermode.stim_duration_ms == 10000
+    loop_thermode.load_stim(table[1])
+    assert written(loop_thermode) == b"S00100"
+    assert loop_thermode.surfaces == [3]
+
+
+def test_encode_fixed_rounds_deterministically():
+    assert encode_fixed(44.3, 10, 3) == "443"
+    assert encode_fixed(10.333333333333334, 10, 4) == "0103"
+    assert encode_fixed(0.05, 10, 4) == "0001"  # half up
+    assert encode_fixed(44.35, 100, 4) == "4435"
+    assert encode_fixed(35.0, 10, 3) == "350"
+    assert encode_fixed(10500, 1, 5) == "10500"
+    with pytest.raises(ValueError):
+        encode_fixed(100.0, 10, 3)
+
+
+def test_hires_stim_uses_hundredth_degree_commands(loop_thermode):
+    loop_thermode.hires = True
+    commands = loop_thermode.compile_stim(target=44.3, rise_rate=3.1, return_rate=4.65, dur_ms=10500)["commands"]
+    assert commands["target"] == b"Ot04430"
+    assert commands["rise"] == b"Ov000310"
+    assert commands["return"] == b"Or000465"
+    assert commands["duration"] == b"D010500"
+
+
+def test_latency_histogram_percentiles_within_precision():
+    hist = latency_histogram(precision=0.01)
+    for ms in range(1, 101):
+        hist.record(ms / 1000)
+    assert hist.n == 100
+    assert hist.percentile(50) == pytest.approx(0.050, rel=0.011)
+    assert hist.percentile(99) == pytest.approx(0.099, rel=0.011)
+    assert hist.percentile(100) == pytest.approx(0.100)
+
+
+def test_latency_recording_per_command_type(loop_thermode):
+    loop_thermode.latency = latency_recorder()
+    loop_thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[1])
+    loop_thermode.trigger()
+    rows = {row["command"]: row for row in loop_thermode.latency.report()}
+    assert rows["stim_params"]["n"] == 1
+    assert rows["L"]["n"] == 1
+    assert rows["L"]["p50_ms"] >= 0
+
+
+def test_encode_profile_splits_long_segments():
+    cmd = encode_profile([(3000, 45.0), (12000, 45.0), (2000, 35.0)], 35.0, areas="01000")
+    assert cmd.startswith("Uw01000004")
+    assert cmd[10:] == "300450" "600450" "600450" "200350"
+    # Rounded on cumulative time: 3 x 3.333 s -> 333 + 334 + 333
+    assert encode_profile([(10000 / 3, 40.0)] * 3, 35.0)[10:] == "333400" "334400" "333400"
+    with pytest.raises(ValueError):
+        encode_profile([(10, 36.0)] * 1000, 35.0)
+
+
+def test_profile_run_restages_only_changed_surfaces(loop_thermode):
+    trial = {"rise_rate": 5, "return_rate": 5, "dur_ms": 4000}
+    table = loop_thermode.compile_profile_table([
+        dict(trial, target=45, surfaces=[1]),
+        dict(trial, target=45, surfaces=[2]),
+        dict(trial, target=45, surfaces=[1]),
+        dict(trial, target=46, surfaces=[1]),
+    ])
+    assert loop_thermode.upload_profiles(table) == 1
+    upload = written(loop_thermode)
+    assert upload.count(b"Uw") == 2
+    assert upload.endswith(b"Ue11000S10000")
+
+    loop_thermode.load_stim(table[1])
+    assert written(loop_thermode) == b"S01000"
+    loop_thermode.load_stim(table[2])
+    assert written(loop_thermode) == b"S10000"
+    loop_thermode.load_stim(table[3])
+    assert written(loop_thermode) == table[3]["commands"]["profile_z1"]
+    assert loop_thermode.stim_profile
+
+
+def test_trace_recorder_grows_and_survives_unclosed_file(tmp_path):
+    path = str(tmp_path / "trace.bin")
+    recorder = temp_trace_recorder(path, capacity=4, flush_every=3)
+    for i in range(10):
+        recorder.append(i * 0.01, np.full(6, 30 + i))
+    assert recorder.capacity == 16
+
+    # Readable while still open, as after a crash
+    times, temps = load_temp_trace(path)
+    assert times.size == 10
+    assert temps[9].tolist() == [39.0] * 6
+
+    recorder.close()
+    assert os.path.getsize(path) == 64 + 10 * 32
+    times, _ = load_temp_trace(path)
+    assert times[-1] == pytest.approx(0.09)
+
+
+ZONE_TEXT = (
+    "[step3_zone{z}]\nenabled={e}\nduration=10.000\nwait=0.000\ntemperature=45.000\nspeed=3.000\n"
+    "return=5.000\npointToPointEnabled=0\nnbrPts=1\nsec1=1.000\ndeg1=30.000\n\n"
+)
+
+
+def test_protocol_generator_streams_steps_to_ini(tmp_path):
+    name = str(tmp_path / "run1")
+    gen = tcsii_protocol_generator(name)
+    gen.set_baseline(32)
+    gen.add_wait_trigger_in()
+    gen.add_stimulation(45, 3, 5, 10, baseline=32, zones=[2], duration_mode="fixed_stim")
+    gen.export_protocol()
+
+    expected = (
+        "[protocol]\nstepsNumber=3\nrecordTemperatures=1\n\n"
+        "[step1]\nstepType=6\nstepTypeText=BASELINE\nbaseline=32.000\nadjustToSkin=0\n\n"
+        "[step2]\nstepType=2\nstepTypeText=WAIT\ntypeWait=3\ntypeWaitText=WAIT_TRIGGER\nnumber=1\n\n"
+        "[step3]\nstepType=0\nstepTypeText=STIMULATE\n\n"
+        "[step3_stimulation]\nbaseline=32.000\ntriggerVal=255\ntriggerDur=0.300\n\n"
+        + "".join(ZONE_TEXT.format(z=z, e=int(z == 2)) for z in range(1, 6))
+    )
+    with open(name + ".protocol.ini") as f:
+        assert f.read() == expected
+    assert os.listdir(tmp_path) == ["run1.protocol.ini"]  # Temporary step file removed
+
+
+def test_protocol_generator_reuses_step_text_with_new_numbers(tmp_path):
+    name = str(tmp_path / "long")
+    gen = tcsii_protocol_generator(name)
+    gen.generate_from_lists(45, 10, [1], 3, 5, n_trials=500)
+    gen.export_protocol()
+    with open(name + ".protocol.ini") as f:
+        text = f.read()
+    assert "stepsNumber=1001" in text
+    assert text.count("stepTypeText=STIMULATE") == 500
+    assert "[step1001_zone5]" in text and "[step1002" not in text
+
+
+def test_protocol_figure_is_optional(tmp_path):
+    name = str(tmp_path / "fig")
+    gen = tcsii_protocol_generator(name, generate_figure=True)
+    gen.set_baseline(32)
+    try:
+        import schemdraw  # noqa: F401
+    except ImportError:
+        with pytest.warns(UserWarning):
+            gen.export_protocol()
+    else:
+        gen.export_protocol()
+    assert os.path.exists(name + ".protocol.ini")
+
+
+def test_protocol_round_trip_and_timeline(tmp_path):
+    name = str(tmp_path / "sim")
+    gen = tcsii_protocol_generator(name)
+    gen.set_baseline(32)
+    gen.add_wait_trigger_in()
+    gen.add_stimulation(45, 3, 5, 10, baseline=32, zones=[2], duration_mode="fixed_stim")
+    gen.add_wait_duration(2.0)
+    gen.add_trigger_out(7, 0.1, 0.5)
+    gen.set_constant_temp(40, 3, 2, [1])
+    gen.export_protocol()
+
+    protocol = load_protocol(name + ".protocol.ini")
+    assert protocol["stepsNumber"] == 6
+    assert protocol["steps"][2]["zones"][1]["temperature"] == 45.0
+    assert [z["enabled"] for z in protocol["steps"][2]["zones"]] == [0, 1, 0, 0, 0]
+
+    sim = simulate_protocol(protocol, dt=0.1, trigger_wait_s=1.0)
+    # Stimulation: 10 s rise + plateau, 13 / 5 s return; constant step: 2 x 4 s ramps + 3 s hold
+    assert sim["step_durations"].tolist() == pytest.approx([0, 1, 12.6, 2, 0, 11])
+    assert sim["duration"] == pytest.approx(26.6)
+    assert sim["trigger_times"].tolist() == pytest.approx([1.0, 16.1])
+    assert sim["trigger_values"].tolist() == [255, 7]
+    assert sim["trigger_in_times"].tolist() == [0.0]
+
+    temps = sim["temps"]
+    assert temps.shape == (267, 5)
+    assert temps[:, 1].max() == pytest.approx(45.0)
+    assert temps[np.searchsorted(sim["times"], 3.0), 1] == pytest.approx(38.0)  # 2 s into the rise
+    assert temps[:, 0].max() == pytest.approx(40.0)
+    assert (temps[:, 2:] == 32).all()
+    # Exact area of the trapezoid: 13 x (4.33 / 2 + 5.67 + 2.6 / 2)
+    assert sim["heat_load"][1] == pytest.approx(13 * (13 / 6 + 10 - 13 / 3 + 1.3))
+
+
+def test_ramp_fidelity_tracker_measures_trial_online():
+    tracker = ramp_fidelity_tracker(tolerance=0.5)
+    tracker.append(0.5, np.full(6, 32.0))  # Before any trial: ignored
+    tracker.arm(1.0, target=45, baseline=32, surfaces=[2], plateau_end_s=10, rise_rate=3, return_rate=5)
+    for k in range(1600):
+        t = 1.0 + k * 0.01
+        rel = t - 1.0
+        zone = min(32 + 3 * rel, 45.5) if rel < 10 else max(45.5 - 5 * (rel - 10), 32)
+        temps = np.full(6, 32.0)
+        temps[2] = zone
+        tracker.append(t, temps)
+
+    m = tracker.finish()
+    assert m["reached_target"]
+    assert m["time_to_target_s"] == pytest.approx(12.5 / 3, abs=0.011)
+    assert m["rise_rate"] == pytest.approx(3, rel=0.01)
+    assert m["overshoot"] == pytest.approx(0.5)
+    assert m["plateau_mean"] > 45.0
+    assert m["plateau_max_dev"] == pytest.approx(0.5)
+    assert m["return_time_s"] == pytest.approx(13 / 5, abs=0.011)
+    assert m["return_rate"] == pytest.approx(5, rel=0.01)
+    assert tracker.metrics() == {}
+
+
+class TriggerOnlyDevice:
+    def __init__(self, trigger=lambda: None):
+        self.trigger = trigger
+        self.port = types.SimpleNamespace(close=lambda: None)
+
+    def stop_acquisition(self):
+        pass
+
+
+def test_multi_trigger_error_is_raised_and_threads_survive():
+    calls = []
+
+    def failing():
+        calls.append("fail")
+        raise OSError("port gone")
+
+    multi = tcsii_multi([TriggerOnlyDevice(), TriggerOnlyDevice(failing)], names=["left", "right"])
+    with pytest.raises(RuntimeError, match="right: port gone"):
+        multi.trigger_all()
+    with pytest.raises(RuntimeError):
+        multi.trigger_all()  # Same threads, still answering
+    assert calls == ["fail", "fail"]
+    multi.close()
+
+
+def test_multi_trigger_times_out_on_a_stuck_device():
+    release = threading.Event()
+    multi = tcsii_multi([TriggerOnlyDevice(), TriggerOnlyDevice(release.wait)], trigger_timeout_s=0.05)
+    with pytest.raises(TimeoutError):
+        multi.trigger_all()
+    with pytest.raises(RuntimeError, match="earlier timeout"):
+        multi.trigger_all()
+    release.set()
+    multi.close()  # Returns instead of waiting on the broken barrier
+
+
+def test_button_press_kept_when_sample_before_since_is_overwritten(loop_thermode):
+    buf = loop_thermode.acquisition_buffer = temp_ring_buffer(capacity=4, buttons=True)
+    for i, resp in enumerate([0, 1, 1, 0, 1, 1]): # Samples 3-5 are kept
+        buf.append(i, np.full(6, 30.0), (0, resp))
+    assert loop_thermode.button_presses("resp", since=4).tolist() == [4]
+    assert loop_thermode.button_presses("resp", since=5).tolist() == [] # Held since sample 4
+
+    for i, resp in enumerate([1, 1, 0], start=6): # Samples 6-8 are kept
+        buf.append(i, np.full(6, 30.0), (0, resp))
+    # Sample 5 is gone, so the press at the clamped start cannot be told from a held button
+    assert loop_thermode.button_presses("resp", since=6).tolist() == [6]
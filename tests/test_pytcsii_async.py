@@ -0,0 +1,110 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import asyncio
+import pytest
+from pytcsii_async import tcsii_async
+
+
+def test_async_commands_run_in_order(loop_thermode):
+    async def run():
+        thermode = tcsii_async(loop_thermode)
+        await asyncio.gather(
+            thermode.set_stim(target=45, rise_rate=3, return_rate=5, dur_ms=10000, surfaces=[2]),
+            thermode.trigger(),
+        )
+        port = loop_thermode.port
+        data = port.read(port.in_waiting)
+        await thermode.close()
+        return data
+
+    data = asyncio.run(run())
+    assert data.startswith(b"C0450")
+    assert data.endswith(b"S01000L")
+
+
+def test_async_query_times_out_without_blocking_queue(loop_thermode):
+    async def run():
+        thermode = tcsii_async(loop_thermode)
+        # The loopback port never ends the line, so readline waits for its own timeout
+        with pytest.raises(asyncio.TimeoutError):
+            await thermode.query("E", timeout=0.01)
+        await thermode.abort(timeout=1.0)
+        await thermode.close()
+
+    asyncio.run(run())
+
+
+@pytest.mark.skipif(not hasattr(os, "openpty"), reason="requires a pty")
+def test_late_reply_of_timed_out_query_is_dropped():
+    from pytcsii import tcsii_serial
+    from tcsii_emulator import tcsii_emulator
+
+    async def run():
+        with tcsii_emulator(neutral=35.0, reply_latency_s=0.15) as emu:
+            thermode = tcsii_async(tcsii_serial(emu.port, baseline=35))
+            await asyncio.sleep(0.1)
+            thermode.device.port.reset_input_buffer()
+            with pytest.raises(asyncio.TimeoutError):
+                await thermode.query("Q", timeout=0.01)
+            await asyncio.sleep(0.25)  # The 'Q' reply arrives after the port timeout
+            temps = await thermode.read_temperatures(timeout=0.5)
+            await thermode.close()
+            return temps
+
+    temps = asyncio.run(run())
+    assert temps is not None and temps[1:] == pytest.approx([35.0] * 5, abs=0.2)
+
+
+@pytest.mark.skipif(not hasattr(os, "openpty"), reason="requires a pty")
+def test_query_reply_taken_from_stream_reader():
+    from pytcsii import tcsii_serial
+    from tcsii_emulator import tcsii_emulator
+
+    async def run():
+        with tcsii_emulator(neutral=35.0) as emu:
+            thermode = tcsii_async(tcsii_serial(emu.port, baseline=35))
+            samples = []
+
+            async def consume():
+                async for t, temps in thermode.stream_temperatures(mode="stream"):
+                    samples.append(temps)
+
+            task = asyncio.create_task(consume())
+            await asyncio.sleep(0.05)
+            await thermode.set_stim(target=40, rise_rate=10, return_rate=10, dur_ms=500, surfaces=0)
+            await thermode.trigger()
+            reply = await thermode.query("Q", timeout=0.5)
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await thermode.close()
+            return reply, samples
+
+    reply, samples = asyncio.run(run())
+    assert reply == b"000000"
+    assert len(samples) > 5
+
+
+@pytest.mark.skipif(not hasattr(os, "openpty"), reason="requires a pty")
+def test_button_query_does_not_shift_later_replies():
+    from pytcsii import tcsii_serial, parse_temp_block
+    from tcsii_emulator import tcsii_emulator
+
+    async def run():
+        with tcsii_emulator(neutral=35.0) as emu:
+            thermode = tcsii_async(tcsii_serial(emu.port, baseline=35))
+            await asyncio.sleep(0.1)
+            thermode.device.port.reset_input_buffer()
+            emu.press_button(resp=True)
+            buttons = await thermode.query("K", timeout=0.5)
+            temps = await thermode.query("E", timeout=0.5)
+            await thermode.close()
+            return buttons, temps
+
+    buttons, temps = asyncio.run(run())
+    assert buttons == b"\r01"
+    values, valid = parse_temp_block(temps)
+    assert valid.all() and values[0] == pytest.approx([35.0] * 6, abs=0.2)
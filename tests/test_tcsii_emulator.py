@@ -0,0 +1,226 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import threading
+import time
+import numpy as np
+import pytest
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "openpty"), reason="requires a pty")
+
+from pytcsii import tcsii_serial, tcsii_multi, tcsii_watchdog, tcsii_follow_streamer, sine_setpoints, parse_temp_block
+from tcsii_emulator import tcsii_emulator
+
+
+@pytest.fixture
+def emulated():
+    with tcsii_emulator(neutral=35.0, tau_s=0.02) as emu:
+        thermode = tcsii_serial(emu.port, baseline=35)
+        time.sleep(0.05)
+        thermode.port.reset_input_buffer()
+        yield emu, thermode
+        thermode.stop_acquisition()
+        thermode.port.close()
+
+
+def query_temps(thermode):
+    thermode._send("E")
+    temps, valid = parse_temp_block(thermode.port.readline())
+    assert valid.all()
+    return temps[0]
+
+
+def test_emulator_heats_only_enabled_zone_at_rise_rate(emulated):
+    emu, thermode = emulated
+    assert query_temps(thermode) == pytest.approx([35.0] * 6)
+
+    thermode.set_stim(target=40, rise_rate=20, return_rate=20, dur_ms=400, surfaces=[2])
+    thermode.trigger()
+    time.sleep(0.15)
+    temps = query_temps(thermode)
+    assert 36.0 < temps[2] < 39.0  # ~20 C/s minus the probe lag
+    assert temps[1] == pytest.approx(35.0)
+
+    time.sleep(0.7)  # Plateau ends at 400 ms, return takes 250 ms
+    assert query_temps(thermode)[2] == pytest.approx(35.0, abs=0.2)
+    assert not emu.stimulating
+
+
+def test_emulator_stream_mode_pushes_100hz(emulated):
+    emu, thermode = emulated
+    thermode.set_stim(target=38, rise_rate=10, return_rate=10, dur_ms=500, surfaces=0)
+    buffer = thermode.start_acquisition(mode="stream")
+    thermode.trigger()
+    time.sleep(0.5)
+    thermode.stop_acquisition()
+
+    times, temps = buffer.snapshot()
+    assert 35 <= times.size <= 60
+    assert np.median(np.diff(times)) == pytest.approx(0.01, abs=0.003)
+    assert temps[:, 1].max() > 37.0
+    time.sleep(0.05)  # Let the emulator parse the last command
+    assert emu.commands[-1][1] == b"F"  # Stream muted again
+
+
+def test_buttons_acquisition_logs_presses_with_temperatures(emulated):
+    emu, thermode = emulated
+    buffer = thermode.start_acquisition(interval_s=0.01, buttons=True)
+    time.sleep(0.1)
+    emu.press_button(resp=True)
+    time.sleep(0.1)
+    emu.press_button()
+    time.sleep(0.1)
+    thermode.stop_acquisition()
+
+    times, temps, buttons = buffer.snapshot(with_buttons=True)
+    assert temps[:, 0] == pytest.approx(35.0)
+    assert buttons[:, 0].max() == 0
+    presses = thermode.button_presses("resp")
+    assert presses.size == 1
+    assert times[0] + 0.05 < presses[0] < times[-1] - 0.05
+    assert {cmd for _, cmd in emu.commands} >= {b"Og"}
+
+
+def test_button_reply_has_no_line_end(emulated):
+    emu, thermode = emulated
+    emu.press_button(stim=True)
+    thermode._send("K")
+    time.sleep(0.05)
+    assert thermode.port.read(thermode.port.in_waiting) == b"\r10"
+    assert query_temps(thermode) == pytest.approx([35.0] * 6)
+
+
+def test_uploaded_profile_fires_with_trigger_only(emulated):
+    emu, thermode = emulated
+    table = thermode.compile_profile_table([
+        {"target": 40, "rise_rate": 20, "return_rate": 20, "dur_ms": 400, "surfaces": [3]},
+    ])
+    thermode.upload_profiles(table)
+    time.sleep(0.05)
+    n_before = len(emu.commands)
+    thermode.trigger()
+    time.sleep(0.3)
+    temps = query_temps(thermode)
+    assert temps[3] > 39.0
+    assert temps[1] == pytest.approx(35.0)
+    assert [cmd for _, cmd in emu.commands[n_before:]] == [b"L", b"E"]
+
+
+def test_multi_thermode_triggers_together_and_merges_streams():
+    with tcsii_emulator(neutral=35.0, tau_s=0.02) as emu1, tcsii_emulator(neutral=35.0, tau_s=0.02) as emu2:
+        multi = tcsii_multi([tcsii_serial(emu1.port, baseline=35), tcsii_serial(emu2.port, baseline=35)])
+        try:
+            multi.load_stim([
+                multi[0].compile_stim(target=40, rise_rate=20, return_rate=20, dur_ms=300, surfaces=[1]),
+                multi[1].compile_stim(target=38, rise_rate=20, return_rate=20, dur_ms=300, surfaces=[2]),
+            ])
+            multi.start_acquisition(interval_s=0.01)
+            time.sleep(0.05)
+            times = multi.trigger_all()
+            # Loose bound: the write completion times also hold the scheduling noise of two pty writes
+            assert abs(times[0] - times[1]) < 0.05
+            time.sleep(0.3)
+
+            grid, temps = multi.temperature_snapshot()
+            assert temps.shape == (grid.size, 2, 6)
+            assert np.diff(grid) == pytest.approx(0.01)
+            assert temps[:, 0, 1].max() > 39.0
+            assert temps[:, 1, 2].max() == pytest.approx(38.0, abs=0.3)
+            assert temps[:, 1, 1].max() == pytest.approx(35.0)
+        finally:
+            multi.close()
+
+
+def test_concurrent_queries_get_their_own_replies(emulated):
+    emu, thermode = emulated
+    emu.set_error(3, 2)
+    replies = []
+
+    def poll_errors():
+        for _ in range(20):
+            replies.append(thermode.query("Q"))
+
+    poller = threading.Thread(target=poll_errors)
+    poller.start()
+    temps = [thermode.query("E") for _ in range(20)]
+    poller.join()
+    assert all(reply.strip() == b"000200" for reply in replies)
+    assert all(parse_temp_block(line)[1].all() for line in temps)
+
+
+def test_query_is_routed_through_stream_acquisition(emulated):
+    emu, thermode = emulated
+    thermode.start_acquisition(mode="stream")
+    emu.set_error(3, 2)
+    assert thermode.query("Q").strip() == b"000200"
+
+
+def test_watchdog_aborts_on_error_state(emulated):
+    emu, thermode = emulated
+    thermode.set_stim(target=40, rise_rate=5, return_rate=20, dur_ms=2000, surfaces=[1])
+    watchdog = tcsii_watchdog(thermode, interval_s=0.02).start()
+    thermode.trigger()
+    time.sleep(0.1)
+    assert watchdog.status["state"] == "ok" and watchdog.status["checks"] > 0
+    emu.set_error(1, 3)
+    time.sleep(0.15)
+    assert watchdog.tripped and watchdog.status["state"] == "error"
+    assert b"A" in [cmd for _, cmd in emu.commands]
+    watchdog.stop()
+
+
+def test_profiles_do_not_outlive_an_interrupted_run(emulated):
+    emu, thermode = emulated
+    thermode.upload_profiles(thermode.compile_profile_table([
+        dict(target=45, rise_rate=5, return_rate=5, dur_ms=4000, surfaces=[1])]))
+    watchdog = tcsii_watchdog(thermode, interval_s=0.02).start()
+    time.sleep(0.05)
+    assert emu.profile_enabled[1]
+    watchdog._at_exit()  # Escape -> core.quit()
+    time.sleep(0.05)
+    assert not emu.profile_enabled.any()
+
+    emu.profile_enabled[1:] = True  # Left enabled by a run that died without the hook
+    tcsii_serial(emu.port, baseline=35).port.close()
+    time.sleep(0.05)
+    assert not emu.profile_enabled.any()
+
+
+def test_watchdog_aborts_over_limit_during_acquisition(emulated):
+    emu, thermode = emulated
+    thermode.set_stim(target=40, rise_rate=20, return_rate=20, dur_ms=2000, surfaces=[2])
+    thermode.start_acquisition(interval_s=0.01)
+    watchdog = tcsii_watchdog(thermode, limit_temp=37.0, interval_s=0.02).start()
+    thermode.trigger()
+    time.sleep(0.4)
+    assert watchdog.status["state"] == "over_temp"
+    assert 37.0 < watchdog.status["max_temp"] < 38.5
+    assert b"A" in [cmd for _, cmd in emu.commands]
+    watchdog.stop()
+
+
+def test_follow_streamer_tracks_waveform_and_logs_measured(emulated):
+    emu, thermode = emulated
+    thermode.start_acquisition(interval_s=0.01)
+    streamer = tcsii_follow_streamer(thermode, rate_hz=50, surfaces=[1], speed=50)
+    streamer.play(sine_setpoints(37.0, 2.0, 1.0, 1.0, rate_hz=50))
+    streamer.wait(timeout=2.0)
+    assert emu.follow_mode
+    log = streamer.log()
+    streamer.stop()
+
+    assert len(log) == 50
+    assert np.median(np.diff(log["t"])) == pytest.approx(0.02, abs=0.002)
+    assert log["commanded_z1"].max() == pytest.approx(39.0, abs=0.05)
+    assert log["commanded_z2"].isna().all()
+    # The probe follows the setpoint with a lag of a few ticks
+    measured = log["measured_z1"].to_numpy()
+    commanded = log["commanded_z1"].to_numpy()
+    assert np.nanmax(measured) > 38.0
+    assert np.nanmean(np.abs(measured[10:] - commanded[5:-5])) < 0.5
+    assert log["measured_z2"].dropna().between(34.9, 35.1).all()
+
+    time.sleep(0.3)
+    assert not emu.follow_mode
+    assert thermode.temperature_snapshot(n=1)[1][0, 1] == pytest.approx(35.0, abs=0.3)
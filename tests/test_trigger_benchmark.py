@@ -0,0 +1,46 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import pytest
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "openpty"), reason="requires a pty")
+
+import serial
+from trigger_benchmark import TriggerLoopback, benchmark
+
+
+def test_loopback_stamps_every_byte():
+    with TriggerLoopback() as loop:
+        port = serial.Serial(loop.port, baudrate=2000000)
+        start = time.perf_counter()
+        for code in (b"\x02", b"\x04", b"\x00"):
+            port.write(code)
+            time.sleep(0.005)
+        assert loop.wait_for(3)
+        codes, times = loop.received()
+        port.close()
+    assert codes.tolist() == [2, 4, 0]
+    assert (times >= start).all() and (times[1:] > times[:-1]).all()
+
+
+def open_port(path, baudrate):
+    return serial.Serial(path, baudrate=baudrate)
+
+
+def test_benchmark_matches_every_write():
+    results = benchmark(n_pulses=20, interval_s=0.005, phases=("write", "level", "pulse", "loaded"),
+                        open_port=open_port, verbose=False)
+    assert set(results) == {"write", "level", "pulse", "loaded"}
+    for name, phase in results.items():
+        assert phase["lost"] == 0
+        assert phase["latency"]["n"] == (40 if name in ("pulse", "loaded") else 20)
+    assert results["loaded"]["width_error"]["n"] == 20
+
+
+def test_benchmark_blocking_pulses():
+    pytest.importorskip("psychopy")
+    results = benchmark(n_pulses=20, interval_s=0.005, phases=("blocking",), verbose=False)
+    assert results["blocking"]["lost"] == 0
+    assert results["blocking"]["width_error"]["n"] == 20
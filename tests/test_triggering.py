@@ -0,0 +1,103 @@
+import os, sys
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import time
+import pytest
+import serial
+
+import triggering
+
+
+@pytest.fixture
+def loop_port():
+    port = serial.serial_for_url("loop://", timeout=0.1)
+    yield port
+    port.close()
+
+
+def test_scheduled_pulse_returns_immediately_and_logs_writes(loop_port):
+    scheduler = triggering.TriggerScheduler(loop_port, clock=time.perf_counter)
+    start = time.perf_counter()
+    scheduler.pulse(b"\x04", 0.02, at=start + 0.01, reset_code=b"\x00")
+    assert time.perf_counter() - start < 0.005
+    assert scheduler.pending == 2
+
+    scheduler.flush()
+    scheduler.close()
+    assert loop_port.read(2) == b"\x04\x00"
+    log = scheduler.write_log()
+    assert log["code"].tolist() == [4, 0]
+    assert log["intended"].tolist() == pytest.approx([start + 0.01, start + 0.03])
+    assert (log["actual"] >= log["intended"]).all()
+
+
+def test_scheduler_orders_by_deadline(loop_port):
+    scheduler = triggering.TriggerScheduler(loop_port, clock=time.perf_counter)
+    now = time.perf_counter()
+    scheduler.set_level(b"\x02", at=now + 0.03)
+    scheduler.set_level(b"\x01", at=now + 0.01)
+    scheduler.close()
+    assert loop_port.read(2) == b"\x01\x02"
+
+
+def test_send_event_pulse_with_scheduler(loop_port):
+    scheduler = triggering.TriggerScheduler(loop_port, clock=time.perf_counter)
+    triggering.send_event_pulse(loop_port, b"\x01", b"\x00", scheduler=scheduler)
+    scheduler.close()
+    assert loop_port.read(2) == b"\x01\x00"
+
+
+def test_bus_logs_writes_and_counts_unavailable_port(loop_port, capsys):
+    bus = triggering.TriggerBus(loop_port, clock=time.perf_counter, capacity=2)
+    assert bus.send("STIM_ON")
+    bus.send(b"\x00", intended=1.5)
+    bus.send(b"\x02")  # Past the preallocated capacity
+    assert loop_port.read(3) == b"\x04\x00\x02"
+    log = bus.write_log()
+    assert log["code"].tolist() == [4, 0, 2]
+    assert log["intended"][1] == 1.5
+    assert (log["duration"] >= 0).all() and log["ok"].all()
+
+    closed = triggering.TriggerBus(None, clock=time.perf_counter)
+    for _ in range(100):
+        assert not closed.send("RESET")
+    assert closed.unavailable == 100
+    assert capsys.readouterr().out.count("SKIPPED") == 1  # Rate limited
+    assert not closed.write_log()["ok"].any()
+
+
+class FakeWindow:
+    """Runs callOnFlip callbacks right after the flip time stamp, as PsychoPy does."""
+
+    def __init__(self):
+        self.callbacks = []
+
+    def callOnFlip(self, function, *args):
+        self.callbacks.append((function, args))
+
+    def flip(self):
+        now = time.perf_counter()
+        for function, args in self.callbacks:
+            function(*args)
+        self.callbacks.clear()
+        return now
+
+
+def test_flip_monitor_pairs_triggers_with_flip_times(loop_port):
+    bus = triggering.TriggerBus(loop_port, clock=time.perf_counter)
+    monitor = triggering.FlipTriggerMonitor(bus, capacity=1)
+    win = monitor.attach(FakeWindow())
+    for code in (b"\x02", b"\x04"):
+        win.callOnFlip(monitor.send, code)
+        flip_time = win.flip()
+        win.flip()  # Later flips do not overwrite the trigger's flip
+
+    records = monitor.records()
+    assert records["code"].tolist() == [2, 4]
+    assert records["flip_time"][1] == flip_time
+    assert (records["write_done"] >= records["flip_time"]).all()
+    stats = monitor.stats()
+    assert stats["n"] == 2
+    assert 0 <= stats["p50_ms"] <= stats["max_ms"] < 50
+    assert bus.write_log()["code"].tolist() == [2, 4]
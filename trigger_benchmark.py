@@ -0,0 +1,270 @@
+# trigger_benchmark.py
+"""
+Loopback trigger-latency benchmark (Linux/macOS).
+
+Opens a pty pair, hands the slave end to the real trigger path
+(``hardware_setup.initialize_trigger_port`` at 2,000,000 baud, wrapped in a
+``triggering.TriggerBus``) and time stamps every byte that comes out of the
+master end. Since the bus logs its writes in order and each trigger is one
+byte, the n-th received byte belongs to the n-th logged write, which gives
+per-write latencies:
+
+    write    direct ``TriggerBus.send`` calls, call to byte received
+    level    ``TriggerScheduler.set_level`` queued ahead, deadline to byte received
+    pulse    ``send_event_pulse`` through the scheduler, as the scripts call it
+    loaded   the same, while a render-loop stand-in keeps another thread busy
+             in Python code most of each frame (GIL contention)
+    blocking ``send_event_pulse`` without a scheduler (``core.wait`` pulse)
+
+For the pulse phases the received code-to-reset interval is compared with the
+requested width. A pty has no baud-rate pacing, so the numbers cover the
+software path (Python, pyserial, scheduler thread, kernel) and not the
+adapter's USB latency.
+
+    python trigger_benchmark.py --pulses 2000
+
+The 'blocking' phase needs PsychoPy (``core.wait``). The others run on
+``time.perf_counter`` and also run without PsychoPy when the port is opened
+by an ``open_port`` other than ``hardware_setup.initialize_trigger_port``.
+"""
+
+import argparse
+import os
+import select
+import threading
+import time
+import tty
+
+import numpy as np
+
+
+class TriggerLoopback:
+    def __init__(self, clock=time.perf_counter, capacity=16384):
+        """Pty pair whose master end records every received byte
+
+        Args:
+            clock (callable, optional): Time base of the stamps; use the bus clock. Defaults to time.perf_counter.
+            capacity (int, optional): Initial size of the receive arrays (grown when full). Defaults to 16384.
+        """
+        self.clock = clock
+        self._codes = np.zeros(capacity, dtype=np.uint8)
+        self._times = np.zeros(capacity)
+        self._n = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+
+    # --- Lifecycle ---
+    def start(self):
+        """Open the pty and start reading; ``port`` is the path to open with pyserial"""
+        self.master_fd, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        tty.setraw(self.master_fd) # Bytes come out as written, one per trigger
+        self.port = os.ttyname(self.slave_fd)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._read, name='trigger-loopback', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1.0)
+            self._thread = None
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # --- Reader ---
+    def _read(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self.master_fd], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master_fd, 4096)
+            except OSError: # Slave closed
+                continue
+            t = self.clock()
+            with self._lock:
+                n = self._n + len(data)
+                if n > len(self._codes):
+                    size = max(n, 2 * len(self._codes))
+                    self._codes = np.concatenate((self._codes, np.zeros(size - len(self._codes), dtype=np.uint8)))
+                    self._times = np.concatenate((self._times, np.zeros(size - len(self._times))))
+                self._codes[self._n:n] = np.frombuffer(data, dtype=np.uint8)
+                self._times[self._n:n] = t # Bytes read together share a stamp
+                self._n = n
+
+    def received(self):
+        """Copies of the received codes and their receive times"""
+        with self._lock:
+            return self._codes[:self._n].copy(), self._times[:self._n].copy()
+
+    def wait_for(self, n, timeout=1.0):
+        """Wait until ``n`` bytes have been received (False on timeout)"""
+        end = time.perf_counter() + timeout
+        while self._n < n:
+            if time.perf_counter() > end:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._n = 0
+
+
+def _summary(values_ms):
+    values_ms = np.asarray(values_ms, dtype=float)
+    if not values_ms.size:
+        return {'n': 0}
+    p50, p95, p99 = np.percentile(values_ms, [50, 95, 99])
+    return {'n': int(values_ms.size), 'mean_ms': float(values_ms.mean()), 'min_ms': float(values_ms.min()),
+            'p50_ms': float(p50), 'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(values_ms.max())}
+
+
+def _format(stats):
+    if not stats['n']:
+        return 'n=0'
+    return (f"n={stats['n']} median={stats['p50_ms']:.3f} ms p95={stats['p95_ms']:.3f} ms "
+            f"p99={stats['p99_ms']:.3f} ms max={stats['max_ms']:.3f} ms")
+
+
+def _render_load(stop, frame_s=1 / 60, busy_fraction=0.8):
+    """Stand-in for the render loop: pure-Python work for most of each frame,
+    then a sleep standing for the wait on the vertical blank (GIL released)"""
+    while not stop.is_set():
+        end = time.perf_counter() + frame_s * busy_fraction
+        while time.perf_counter() < end:
+            sum(range(200))
+        time.sleep(frame_s * (1 - busy_fraction))
+
+
+PHASES = ('write', 'level', 'pulse', 'loaded', 'blocking')
+
+
+def benchmark(n_pulses=1000, interval_s=0.005, baudrate=2000000, phases=PHASES, open_port=None, verbose=True):
+    """Drive the trigger path through a loopback pty and report latencies
+
+    Args:
+        n_pulses (int, optional): Writes (or pulses) per phase. Defaults to 1000.
+        interval_s (float, optional): Spacing of the writes; must exceed the pulse width. Defaults to 0.005.
+        baudrate (int, optional): Baud rate given to ``initialize_trigger_port``. Defaults to 2000000.
+        phases (tuple, optional): Phases to run, in order. Defaults to all of ``PHASES``.
+        open_port (callable, optional): ``open_port(path, baudrate=...)`` returning the
+            opened port. Defaults to ``hardware_setup.initialize_trigger_port``.
+        verbose (bool, optional): Print the summary. Defaults to True.
+
+    Returns:
+        dict: Per phase, ``latency`` statistics in ms (and ``width_error`` for the
+        pulse phases), plus ``lost`` (bytes logged as written but not received).
+    """
+    import config
+    import triggering
+
+    if open_port is None:
+        import hardware_setup as hw
+        open_port = hw.initialize_trigger_port
+    pulse_s = config.TRIGGER_PULSE_SECS
+    if interval_s <= pulse_s:
+        raise ValueError('interval_s must exceed config.TRIGGER_PULSE_SECS')
+    codes = [config.TRIG_ITI_START, config.TRIG_STIM_ON, config.TRIG_PAIN_Q_ON, config.TRIG_VAS_ON]
+    results = {}
+
+    with TriggerLoopback() as loop:
+        port = open_port(loop.port, baudrate=baudrate)
+        if port is None:
+            raise RuntimeError(f'could not open {loop.port}')
+        bus = triggering.TriggerBus(port, clock=loop.clock, capacity=4 * n_pulses + 16)
+        scheduler = triggering.TriggerScheduler(bus)
+
+        loop.wait_for(1, timeout=0.2) # Initial reset written by initialize_trigger_port
+
+        def run_phase(name, drive, pulses):
+            time.sleep(0.05) # Let the previous phase's last bytes arrive
+            loop.clear()
+            first = len(bus.write_log())
+            drive()
+            scheduler.flush(timeout=n_pulses * interval_s + 1.0)
+            log = bus.write_log()[first:]
+            loop.wait_for(len(log), timeout=1.0)
+            received, times = loop.received()
+            n = min(len(log), len(received))
+            if not np.array_equal(received[:n], log['code'][:n]):
+                raise RuntimeError(f'{name}: received bytes do not match the write log')
+            phase = {'latency': _summary((times[:n] - log['intended'][:n]) * 1000),
+                     'lost': int(len(log) - n)}
+            if pulses:
+                widths = times[1:n:2] - times[0:n - 1:2]
+                phase['width_error'] = _summary((widths - pulse_s) * 1000)
+            results[name] = phase
+
+        def direct_writes():
+            for i in range(n_pulses):
+                bus.send(codes[i % len(codes)])
+                time.sleep(interval_s)
+
+        def levels():
+            start = loop.clock() + 0.01
+            for i in range(n_pulses):
+                scheduler.set_level(codes[i % len(codes)], at=start + i * interval_s)
+
+        def scheduled_pulses():
+            for i in range(n_pulses):
+                triggering.send_event_pulse(bus, codes[i % len(codes)], config.TRIG_RESET, scheduler=scheduler)
+                time.sleep(interval_s)
+
+        def loaded_pulses():
+            stop = threading.Event()
+            load = threading.Thread(target=_render_load, args=(stop,), name='render-load', daemon=True)
+            load.start()
+            try:
+                scheduled_pulses()
+                scheduler.flush(timeout=1.0)
+            finally:
+                stop.set()
+                load.join(timeout=1.0)
+
+        def blocking_pulses():
+            for i in range(n_pulses):
+                triggering.send_event_pulse(bus, codes[i % len(codes)], config.TRIG_RESET)
+                time.sleep(interval_s - pulse_s)
+
+        try:
+            drives = {'write': (direct_writes, False), 'level': (levels, False),
+                      'pulse': (scheduled_pulses, True), 'loaded': (loaded_pulses, True),
+                      'blocking': (blocking_pulses, True)}
+            for name in phases:
+                run_phase(name, *drives[name])
+        finally:
+            scheduler.close()
+            bus.close()
+
+    if verbose:
+        print(f"Trigger loopback at {baudrate} baud, {n_pulses} writes/pulses per phase, {pulse_s * 1000:.1f} ms pulses")
+        for name, phase in results.items():
+            print(f"{name:>8} latency: {_format(phase['latency'])}" + (f" lost={phase['lost']}" if phase['lost'] else ''))
+            if 'width_error' in phase:
+                print(f"{'':>8} width error: {_format(phase['width_error'])}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the trigger path through a loopback pty.')
+    parser.add_argument('--pulses', type=int, default=1000, help='Writes or pulses per phase (default: 1000)')
+    parser.add_argument('--interval-ms', type=float, default=5.0, help='Spacing of the writes (default: 5 ms)')
+    parser.add_argument('--baudrate', type=int, default=2000000, help='Trigger port baud rate (default: 2000000)')
+    parser.add_argument('--phases', nargs='+', choices=PHASES, default=PHASES, help='Phases to run (default: all)')
+    args = parser.parse_args()
+    benchmark(args.pulses, args.interval_ms / 1000, args.baudrate, phases=tuple(args.phases))
@@ -1,11 +1,30 @@
 # triggering.py
 
-from psychopy import core
+import heapq
+import itertools
+import threading
+import time
+
+import numpy as np
 import config
 
-def send_event_pulse(port, code_to_pulse, reset_code):
-    """Sends a short trigger pulse followed by a reset."""
+def _monotonic_clock():
+    """PsychoPy's monotonic clock, imported on first use so the classes below
+    can run on another clock without PsychoPy."""
+    from psychopy import core
+    return core.monotonicClock.getTime
+
+def send_event_pulse(port, code_to_pulse, reset_code, scheduler=None):
+    """Sends a short trigger pulse followed by a reset.
+
+    With a :class:`TriggerScheduler` the pulse is queued and the call returns
+    at once; otherwise the caller waits ``config.TRIGGER_PULSE_SECS``.
+    """
+    if scheduler is not None:
+        scheduler.pulse(code_to_pulse, config.TRIGGER_PULSE_SECS, reset_code=reset_code)
+        return
     if port and port.is_open:
+        from psychopy import core
         try:
             port.write(code_to_pulse)
             core.wait(config.TRIGGER_PULSE_SECS)
@@ -14,3 +33,258 @@ def send_event_pulse(port, code_to_pulse, reset_code):
             print(f"ERROR writing pulse trigger {code_to_pulse.hex()}: {e}")
     else:
         print(f"SKIPPED pulse trigger {code_to_pulse.hex()} (port not available/open).")
+
+TRIGGER_LOG_DTYPE = np.dtype([
+    ('code', np.uint8),     # First byte written
+    ('intended', np.float64), # Requested time (time of the call if none was given)
+    ('actual', np.float64), # Time the write returned
+    ('duration', np.float64), # Time spent in the write
+    ('ok', np.bool_),       # False if the port was unavailable or the write failed
+])
+
+class TriggerBus:
+    """Single owner of the trigger port.
+
+    Wraps the port returned by ``hardware_setup.initialize_trigger_port`` (which
+    may be ``None``). Codes are the ``config.TRIG_*`` bytes, looked up once, and
+    can be sent by name (``bus.send('STIM_ON')``) or as bytes. Every write is
+    recorded in a preallocated array (see ``TRIGGER_LOG_DTYPE``) that
+    ``data_management.save_trigger_log`` saves with the run data. Writes to an
+    unavailable port are counted and reported at most every ``report_every_s``
+    instead of printed on every frame.
+    """
+
+    def __init__(self, port, clock=None, capacity=8192, report_every_s=10.0):
+        self.port = port
+        self.clock = clock if clock is not None else _monotonic_clock()
+        self.codes = {name[5:]: getattr(config, name) for name in dir(config) if name.startswith('TRIG_')}
+        self.report_every_s = report_every_s
+        self.unavailable = 0 # Writes skipped because the port was not open
+        self.errors = 0 # Writes that raised
+        self._log = np.zeros(capacity, dtype=TRIGGER_LOG_DTYPE)
+        self._n = 0
+        self._lock = threading.Lock() # The scheduler thread and the main thread both write
+        self._last_report = None
+
+    @property
+    def is_open(self):
+        return self.port is not None and self.port.is_open
+
+    def send(self, code, intended=None):
+        """Write a code (bytes or ``config.TRIG_*`` name without the prefix).
+
+        Returns True if the write went out.
+        """
+        if isinstance(code, str):
+            code = self.codes[code]
+        with self._lock:
+            start = self.clock()
+            ok = self.is_open
+            if ok:
+                try:
+                    self.port.write(code)
+                except Exception as e:
+                    ok = False
+                    self.errors += 1
+                    self._report(start, f"ERROR writing trigger {code.hex()}: {e}")
+            else:
+                self.unavailable += 1
+                self._report(start, f"SKIPPED trigger {code.hex()} (port not available/open)")
+            end = self.clock()
+            self._record(code[0], start if intended is None else intended, end, end - start, ok)
+        return ok
+
+    write = send
+
+    def _report(self, now, message):
+        if self._last_report is None or now - self._last_report >= self.report_every_s:
+            self._last_report = now
+            print(f"{message}; {self.unavailable} skipped and {self.errors} failed so far.")
+
+    def _record(self, code, intended, actual, duration, ok):
+        if self._n == len(self._log):
+            self._log = np.concatenate((self._log, np.zeros(len(self._log), dtype=TRIGGER_LOG_DTYPE)))
+        self._log[self._n] = (code, intended, actual, duration, ok)
+        self._n += 1
+
+    def write_log(self):
+        """Copy of the logged writes (structured array, see ``TRIGGER_LOG_DTYPE``)."""
+        with self._lock:
+            return self._log[:self._n].copy()
+
+    def close(self, reset_code=config.TRIG_RESET):
+        """Reset the trigger lines and close the port."""
+        if self.is_open:
+            self.send(reset_code)
+            self.port.close()
+
+class TriggerScheduler:
+    """Write trigger codes at requested times from a background thread.
+
+    Requests ("pulse code X for N s at time T", "set level X at T") go into a
+    deadline queue and return immediately, so the render loop never waits for
+    a pulse to end. The thread sleeps until shortly before the next deadline
+    and then polls the clock for the last ``spin_s``, yielding the GIL between
+    polls so the render loop keeps running. A write therefore goes out once
+    the thread gets the GIL back after its deadline: typically well under a
+    millisecond late, but up to the interpreter's switch interval (5 ms by
+    default, ``sys.getswitchinterval``) while another thread is busy in Python
+    code. Times use ``clock`` (``core.monotonicClock.getTime`` by default, the
+    time base of the experiment scripts).
+
+    Writes go through a :class:`TriggerBus` (``port`` itself, or one wrapping
+    it), whose log holds each write's intended and actual time.
+    """
+
+    def __init__(self, port, clock=None, spin_s=0.001):
+        self.bus = port if isinstance(port, TriggerBus) else TriggerBus(port, clock=clock)
+        self.clock = clock if clock is not None else self.bus.clock
+        self.spin_s = spin_s
+        self._queue = [] # (deadline, sequence, code)
+        self._sequence = itertools.count() # Keeps writes with equal deadlines in request order
+        self._wake = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='trigger-scheduler', daemon=True)
+        self._thread.start()
+
+    def set_level(self, code, at=None):
+        """Write ``code`` at time ``at`` (now if None) and keep it."""
+        self._push([(self.clock() if at is None else at, code)])
+
+    def pulse(self, code, duration_s, at=None, reset_code=config.TRIG_RESET):
+        """Write ``code`` at time ``at`` (now if None) and ``reset_code`` ``duration_s`` later."""
+        start = self.clock() if at is None else at
+        self._push([(start, code), (start + duration_s, reset_code)])
+
+    def _push(self, writes):
+        with self._wake:
+            for deadline, code in writes:
+                heapq.heappush(self._queue, (deadline, next(self._sequence), code))
+            self._wake.notify()
+
+    @property
+    def pending(self):
+        """Number of writes still queued."""
+        with self._wake:
+            return len(self._queue)
+
+    def flush(self, timeout=1.0):
+        """Wait until every queued write has been made (or ``timeout`` s)."""
+        end = time.perf_counter() + timeout
+        while self.pending and time.perf_counter() < end:
+            time.sleep(0.0005)
+
+    def close(self, flush=True):
+        """Stop the thread, after the queued writes unless ``flush`` is False."""
+        if flush:
+            self.flush()
+        with self._wake:
+            self._running = False
+            self._wake.notify()
+        self._thread.join(timeout=1.0)
+
+    def _run(self):
+        while True:
+            with self._wake:
+                while self._running:
+                    if self._queue:
+                        delay = self._queue[0][0] - self.clock()
+                        if delay <= self.spin_s:
+                            break
+                        self._wake.wait(delay - self.spin_s) # Woken early by sooner requests
+                    else:
+                        self._wake.wait()
+                if not self._running:
+                    return
+                deadline, _, code = self._queue[0]
+            while self.clock() < deadline:
+                time.sleep(0) # Yield the GIL instead of holding it while spinning
+            with self._wake:
+                # A sooner request may have arrived while spinning; it is next in the heap
+                deadline, _, code = heapq.heappop(self._queue)
+            self.bus.send(code, intended=deadline)
+
+    def write_log(self):
+        """Log of the bus the scheduler writes to."""
+        return self.bus.write_log()
+
+class FlipTriggerMonitor:
+    """Measure the delay from each screen flip to its flip-locked trigger.
+
+    :meth:`attach` wraps ``win.flip`` so the time stamp it returns is kept;
+    ``win.callOnFlip`` callbacks send their trigger with :meth:`send` instead
+    of ``TriggerBus.send``. For each such trigger the monitor stores the flip
+    time, the time the callback ran and the time the port write returned, so
+    ``write_done - flip_time`` is the flip-to-trigger delay of the run
+    (summarised by :meth:`stats`, saved by ``data_management.save_trigger_jitter``).
+    """
+
+    def __init__(self, bus, capacity=1024):
+        self.bus = bus
+        self.clock = bus.clock
+        self._code = np.zeros(capacity, dtype=np.uint8)
+        self._flip = np.full(capacity, np.nan)
+        self._callback = np.zeros(capacity)
+        self._written = np.zeros(capacity)
+        self._ok = np.zeros(capacity, dtype=np.bool_)
+        self._n = 0
+        self._pending = [] # Triggers sent during the flip that has not returned yet
+
+    def attach(self, win):
+        """Wrap ``win.flip`` to collect flip times (returns the window)."""
+        flip = win.flip
+
+        def timed_flip(*args, **kwargs):
+            flip_time = flip(*args, **kwargs)
+            if self._pending:
+                self._flip[self._pending] = flip_time if flip_time is not None else np.nan
+                self._pending.clear()
+            return flip_time
+
+        win.flip = timed_flip
+        return win
+
+    def send(self, code):
+        """Send a flip-locked trigger from a ``win.callOnFlip`` callback."""
+        callback_time = self.clock()
+        ok = self.bus.send(code, intended=callback_time)
+        written = self.clock()
+        n = self._n
+        if n == len(self._callback):
+            self._code = np.concatenate((self._code, np.zeros(n, dtype=np.uint8)))
+            self._flip = np.concatenate((self._flip, np.full(n, np.nan)))
+            self._callback = np.concatenate((self._callback, np.zeros(n)))
+            self._written = np.concatenate((self._written, np.zeros(n)))
+            self._ok = np.concatenate((self._ok, np.zeros(n, dtype=np.bool_)))
+        code = self.bus.codes[code] if isinstance(code, str) else code
+        self._code[n] = code[0]
+        self._callback[n] = callback_time
+        self._written[n] = written
+        self._ok[n] = ok
+        self._pending.append(n)
+        self._n = n + 1
+        return ok
+
+    def records(self):
+        """Raw arrays of every flip-locked trigger (times in s)."""
+        n = self._n
+        return {'code': self._code[:n].copy(),
+                'flip_time': self._flip[:n].copy(),
+                'callback_time': self._callback[:n].copy(),
+                'write_done': self._written[:n].copy(),
+                'ok': self._ok[:n].copy()}
+
+    def stats(self):
+        """Flip-to-trigger delay statistics in ms (written triggers with a flip time)."""
+        n = self._n
+        keep = self._ok[:n] & ~np.isnan(self._flip[:n])
+        delay = (self._written[:n] - self._flip[:n])[keep] * 1000
+        write = (self._written[:n] - self._callback[:n])[keep] * 1000
+        if not delay.size:
+            return {'n': 0}
+        p50, p95, p99 = np.percentile(delay, [50, 95, 99])
+        return {'n': int(delay.size), 'mean_ms': float(delay.mean()), 'sd_ms': float(delay.std()),
+                'min_ms': float(delay.min()), 'p50_ms': float(p50), 'p95_ms': float(p95),
+                'p99_ms': float(p99), 'max_ms': float(delay.max()),
+                'write_p50_ms': float(np.median(write)), 'write_max_ms': float(write.max()),
+                'over_1ms': int((delay > 1.0).sum())}